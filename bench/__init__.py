@@ -0,0 +1 @@
+""" Benchmarks of whole syncs against local fake backends. See bench/run.py. """
@@ -0,0 +1,617 @@
+""" Local stand-ins for the reMarkable, Drive, and Notion backends, so that whole syncs can run without a network.
+
+Everything lives in one World: the items on the fake reMarkable, the files on the fake Drive, and the blocks on the
+fake Notion. install() puts a fake rmcl package and fake drive and notional modules in place of the real ones, with
+the same call surfaces the sync uses. Every call costs the World's latency, and Drive and Notion calls go through
+the real throttle.Scheduler, so injected rate limits are paced and retried exactly like real ones. """
+from collections import Counter
+from datetime import datetime, timezone
+from functools import partial
+import io
+import itertools
+import json
+import random
+import struct
+import sys
+import threading
+import time
+import types
+import uuid
+import zipfile
+
+import trio
+
+import throttle
+
+# Seconds a fake service asks a throttled client to wait
+RETRY_AFTER = 0.05
+
+# Same limits as the real Drive and Notion modules
+BATCH_LIMIT = 100
+FETCH_CHUNK = 100
+APPEND_LIMIT = 100
+PAGE_SIZE = 100
+
+# Fixed timestamp for every file inside a document's zip, so that the same content always makes the same blob
+ZIP_TIME = (2021, 1, 1, 0, 0, 0)
+
+# How long rmcl trusts its item index before get_by_id() refreshes it, in seconds
+FILE_LIST_VALIDITY = 5 * 60
+
+# Version 5 .lines header, padded to the length rmrl expects
+LINES_HEADER = b'reMarkable .lines file, version=5          '
+
+
+class FakeError(Exception):
+    """ What a fake service raises for an injected error or a request it can't make sense of. """
+
+
+class World:
+    """ The state of all three fake services, plus the knobs for how they misbehave.
+
+    `latency` is in seconds per call. `errors` and `throttles` are the chances that any one Drive or Notion call
+    fails outright or is rate limited. """
+    def __init__(self, latency=0.0, errors=0.0, throttles=0.0, seed=0):
+        self.latency = latency
+        self.errors = errors
+        self.throttles = throttles
+        self.random = random.Random(seed)
+        self.ids = itertools.count()
+        self.lock = threading.RLock()
+
+        # Calls per service and method, e.g. 'drive.files.insert'. Retries of throttled calls count again.
+        self.calls = Counter()
+        self.throttled = 0
+
+        # reMarkable metadata dicts by ID, each document's pages by ID, and document blobs by download URL
+        self.rm = dict()
+        self.pages = dict()
+        self.blobs = dict()
+
+        # Drive files and Notion blocks by ID
+        self.drive_root = self.new_id('drive')
+        self.drive = {self.drive_root: dict(title='remarkable', parents=[], trashed=False, size=0, folder=True)}
+        self.notion_root = self.new_id('notion')
+        self.notion = {self.notion_root: dict(type='page', title='Remarkable', parent=None, content=[], alive=True)}
+
+    def new_id(self, prefix):
+        return f"{prefix}-{next(self.ids):08d}"
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def roll(self, chance):
+        with self.lock:
+            return self.random.random() < chance
+
+    def send(self, scheduler, service, endpoint, name, fn):
+        """ Make a blocking call to a Drive or Notion endpoint: wait out the latency, then either get throttled, fail,
+        or run `fn` on the World and return its result. """
+        def request():
+            self.count(f"{service}.{name}")
+            time.sleep(self.latency)
+            if self.roll(self.throttles):
+                with self.lock:
+                    self.throttled += 1
+                return True, None
+            if self.roll(self.errors):
+                return False, FakeError(f"Injected error in {service} {name}")
+            with self.lock:
+                return False, fn()
+
+        throttled, result = scheduler.send(service, endpoint, request,
+                                           lambda response: (response[0], str(RETRY_AFTER)))
+        if throttled:
+            raise FakeError(f"{service} {name} was still throttled after {throttle.THROTTLE_RETRIES} retries")
+        if isinstance(result, FakeError):
+            raise result
+        return result
+
+    async def rm_call(self, name):
+        """ Charge a reMarkable API call. These never fail; the sync has no retry logic for them to exercise. """
+        self.count(f"rm.{name}")
+        await trio.sleep(self.latency)
+
+    # What happens on the reMarkable, as the generator and scenarios see it
+
+    def add_folder(self, name, parent=''):
+        id_ = str(uuid.uuid4())
+        self.rm[id_] = dict(ID=id_, VissibleName=name, Version=1, Parent=parent, Type='CollectionType',
+                            ModifiedClient=self.now())
+        return id_
+
+    def add_document(self, name, parent='', pages=1):
+        id_ = str(uuid.uuid4())
+        self.pages[id_] = [(str(uuid.uuid4()), self.random.randrange(2 ** 32)) for _ in range(pages)]
+        self.rm[id_] = dict(ID=id_, VissibleName=name, Version=1, Parent=parent, Type='DocumentType',
+                            ModifiedClient=self.now())
+        self.blobs[self.url(id_)] = self.notebook(id_)
+        return id_
+
+    def edit_document(self, id_):
+        """ Redraw one page of a document, which makes a new version with new content. """
+        pages = self.pages[id_]
+        index = self.random.randrange(len(pages))
+        pages[index] = (pages[index][0], self.random.randrange(2 ** 32))
+        self.rm[id_]['Version'] += 1
+        self.rm[id_]['ModifiedClient'] = self.now()
+        self.blobs[self.url(id_)] = self.notebook(id_)
+
+    def rename(self, id_, name):
+        """ Rename an item, which makes a new version with the same content. """
+        self.rm[id_]['VissibleName'] = name
+        self.bump(id_)
+
+    def move(self, id_, parent):
+        self.rm[id_]['Parent'] = parent
+        self.bump(id_)
+
+    def bump(self, id_):
+        """ Make a new version of an item, keeping its content. """
+        blob = self.blobs.get(self.url(id_))
+        self.rm[id_]['Version'] += 1
+        self.rm[id_]['ModifiedClient'] = self.now()
+        if blob:
+            self.blobs[self.url(id_)] = blob
+
+    def delete(self, id_):
+        del self.rm[id_]
+
+    @staticmethod
+    def now():
+        return datetime.now(timezone.utc).isoformat()
+
+    def url(self, id_):
+        return f"fake://{id_}/{self.rm[id_]['Version']}"
+
+    def notebook(self, id_):
+        """ The zip of a notebook, laid out like the reMarkable cloud stores it, with one short stroke per page. """
+        pages = self.pages[id_]
+        files = {f"{id_}.content": json.dumps(dict(fileType='notebook', pages=[page for page, _ in pages],
+                                                   pageCount=len(pages))).encode(),
+                 f"{id_}.pagedata": b'Blank\n' * len(pages)}
+        for page, seed in pages:
+            files[f"{id_}/{page}.rm"] = self.lines(seed)
+            files[f"{id_}/{page}-metadata.json"] = json.dumps(dict(layers=[dict(name='Layer 1')])).encode()
+
+        blob = io.BytesIO()
+        with zipfile.ZipFile(blob, 'w', zipfile.ZIP_DEFLATED) as raw:
+            for name, data in files.items():
+                raw.writestr(zipfile.ZipInfo(name, ZIP_TIME), data)
+        return blob.getvalue()
+
+    @staticmethod
+    def lines(seed):
+        """ A one-layer, one-stroke .lines page. The seed decides where the stroke goes. """
+        rng = random.Random(seed)
+        segments = [(rng.uniform(100, 1300), rng.uniform(100, 1700), 0, 0, 2, 0.5) for _ in range(20)]
+        return (LINES_HEADER + struct.pack('<BBH', 1, 0, 0) + struct.pack('<I', 1)
+                + struct.pack('<IIIfII', 2, 0, 0, 2.0, 0, len(segments))
+                + b''.join(struct.pack('<ffffff', *segment) for segment in segments))
+
+
+# rmcl
+
+class Item:
+    """ Same properties as rmcl's Item, backed by a metadata dict from the fake listing. """
+    DOCUMENT = 'DocumentType'
+    FOLDER = 'CollectionType'
+    world = None
+
+    def __init__(self, metadata):
+        self._metadata = dict(metadata)
+
+    @property
+    def id(self):
+        return self._metadata['ID']
+
+    @property
+    def name(self):
+        return self._metadata['VissibleName']
+
+    @property
+    def version(self):
+        return self._metadata['Version']
+
+    @property
+    def parent(self):
+        return self._metadata['Parent']
+
+    @property
+    def mtime(self):
+        return datetime.fromisoformat(self._metadata['ModifiedClient'])
+
+    @staticmethod
+    async def get_by_id(id_):
+        return await (await get_client()).get_by_id(id_)
+
+    @classmethod
+    def from_metadata(cls, metadata):
+        return Document(metadata) if metadata['Type'] == cls.DOCUMENT else Folder(metadata)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} "{self.name}">'
+
+
+class Document(Item):
+    async def download_url(self):
+        await self.world.rm_call('get_metadata')
+        return f"fake://{self.id}/{self.version}"
+
+    async def raw(self):
+        url = await self.download_url()
+        await self.world.rm_call('get_blob')
+        return io.BytesIO(self.world.blobs[url])
+
+    async def raw_size(self):
+        url = await self.download_url()
+        await self.world.rm_call('get_blob_size')
+        return len(self.world.blobs[url])
+
+    async def type(self):
+        return 'notebook'
+
+
+class Folder(Item):
+    def __init__(self, metadata):
+        super().__init__(metadata)
+        self.children = []
+
+
+class VirtualFolder(Folder):
+    def __init__(self, name, id_, parent_id=None):
+        super().__init__(dict(ID=id_, VissibleName=name, Version=0, Parent=parent_id, Type=Item.FOLDER))
+
+
+class Client:
+    """ rmcl's API client: the item index, refreshed by update_items() the same way rmcl does it, plus raw requests. """
+    def __init__(self, world):
+        self.world = world
+        root = VirtualFolder('', '')
+        trash = VirtualFolder('.trash', 'trash', root.id)
+        self.by_id = {root.id: root, trash.id: trash}
+        self.refresh_deadline = None
+
+    async def get_by_id(self, id_):
+        if not self.refresh_deadline or time.monotonic() > self.refresh_deadline:
+            await self.update_items()
+        return self.by_id[id_]
+
+    async def update_items(self):
+        await self.world.rm_call('update_items')
+        listing = [dict(metadata) for metadata in self.world.rm.values()]
+
+        # Like rmcl, keep the objects for items whose version hasn't changed
+        old_ids = set(self.by_id) - {'', 'trash'}
+        for metadata in listing:
+            old = self.by_id.get(metadata['ID'])
+            old_ids.discard(metadata['ID'])
+            if not old or old.version != metadata['Version']:
+                self.by_id[metadata['ID']] = Item.from_metadata(metadata)
+        for id_ in old_ids:
+            del self.by_id[id_]
+
+        for item in self.by_id.values():
+            if isinstance(item, Folder):
+                item.children = []
+        for item in self.by_id.values():
+            parent = self.by_id.get(item.parent)
+            if isinstance(parent, Folder):
+                parent.children.append(item)
+        self.refresh_deadline = time.monotonic() + FILE_LIST_VALIDITY
+
+    async def request(self, method, url, headers=None):
+        """ A GET for (a byte range of) a document blob. """
+        await self.world.rm_call('request')
+        blob = self.world.blobs.get(url)
+        if blob is None:
+            return types.SimpleNamespace(status_code=404, content=b'')
+
+        byte_range = (headers or {}).get('Range', '').replace('bytes=', '')
+        if byte_range.startswith('-'):
+            blob = blob[-int(byte_range[1:]):]
+        elif byte_range:
+            start, end = byte_range.split('-')
+            blob = blob[int(start):int(end) + 1]
+        return types.SimpleNamespace(status_code=206 if byte_range else 200, content=blob)
+
+
+# Drive
+
+class FakeDrive:
+    """ Same methods as drive.Drive. The names counted for each call are those of the API calls Drive makes. """
+    world = None
+
+    def __init__(self, sessions=None, scheduler=None, settings_file=None):
+        self.scheduler = scheduler if scheduler else throttle.scheduler
+        self.ROOT = self.call('metadata', 'ListFile', lambda: self.world.drive_root)
+
+    def call(self, endpoint, name, fn):
+        return self.world.send(self.scheduler, 'drive', endpoint, name, fn)
+
+    def add(self, parent_id, name, size=0, folder=False):
+        if parent_id not in self.world.drive:
+            raise FakeError(f"Drive parent {parent_id} not found")
+        id_ = self.world.new_id('drive')
+        self.world.drive[id_] = dict(title=name, parents=[parent_id], trashed=False, size=size, folder=folder)
+        return dict(id=id_, title=name, embedLink=f"https://drive.fake/{id_}/preview")
+
+    def file(self, id_):
+        if id_ not in self.world.drive:
+            raise FakeError(f"Drive file {id_} not found")
+        return self.world.drive[id_]
+
+    def upload_pdf(self, parent_id, name, pdf):
+        size = len(pdf.read())
+        return self.call('upload', 'files.insert', partial(self.add, parent_id, name, size))
+
+    def create_folder(self, parent_id, name):
+        return self.call('metadata', 'CreateFile.Upload', partial(self.add, parent_id, name, folder=True))
+
+    def delete(self, id_):
+        self.call('metadata', 'CreateFile.Trash', partial(self.trash, id_))
+
+    def trash(self, id_):
+        """ Trash an item along with everything beneath it, as Drive does. """
+        self.file(id_)['trashed'] = True
+        for child_id, item in self.world.drive.items():
+            if id_ in item['parents'] and not item['trashed']:
+                self.trash(child_id)
+
+    def rename(self, id_, name):
+        self.call('metadata', 'CreateFile.FetchMetadata', partial(self.file, id_))
+        self.call('metadata', 'CreateFile.Upload', lambda: self.file(id_).update(title=name))
+
+    def list_tree(self, root_id=None):
+        """ One files.list call per level of folders, since fake trees never fill more than a page per level. """
+        items = dict()
+        level = {root_id if root_id else self.ROOT}
+        while level:
+            listed = self.call('metadata', 'files.list', partial(self.children, level))
+            items.update(listed)
+            level = {id_ for id_, item in listed.items() if item['folder']}
+        return items
+
+    def children(self, parents):
+        return {id_: dict(name=item['title'], parent=next(parent for parent in item['parents'] if parent in parents),
+                          folder=item['folder'])
+                for id_, item in self.world.drive.items()
+                if not item['trashed'] and parents.intersection(item['parents'])}
+
+    def apply_batch(self, mutations):
+        results = []
+        for start in range(0, len(mutations), BATCH_LIMIT):
+            results.extend(self.call('batch', 'batch', partial(self.patch_all, mutations[start:start + BATCH_LIMIT])))
+        return results
+
+    def patch_all(self, mutations):
+        results = []
+        for mutation in mutations:
+            self.world.calls['drive.files.patch'] += 1
+            try:
+                item = self.file(mutation['fileId'])
+            except FakeError as e:
+                results.append(e)
+                continue
+            if 'title' in mutation['body']:
+                item['title'] = mutation['body']['title']
+            if mutation['body'].get('labels', {}).get('trashed'):
+                self.trash(mutation['fileId'])
+            if 'addParents' in mutation:
+                item['parents'] = [parent for parent in item['parents'] if parent != mutation['removeParents']]
+                item['parents'].append(mutation['addParents'])
+            results.append(dict(id=mutation['fileId']))
+        return results
+
+    def replace_pdf(self, id_, pdf):
+        size = len(pdf.read())
+        self.call('upload', 'files.update', lambda: self.file(id_).update(size=size))
+
+
+# Notion
+
+class FakeNotion:
+    """ Same methods as notional.Notion. Reads and writes are counted as the unofficial client's getRecordValues and
+    submitTransaction, and official API calls by their endpoint. Pages read since the last clear_cache() aren't
+    read again, like with the real record cache. """
+    world = None
+
+    FILE_TYPES = ('bulleted_list_item', 'bulleted_list')
+    PAGE_TYPES = ('child_page', 'page')
+
+    def __init__(self, official_token, unofficial_token, root, scheduler=None):
+        self.scheduler = scheduler if scheduler else throttle.scheduler
+        self.cached = set()
+        self.cache_lock = threading.Lock()
+        self.ROOT = root
+
+        # Logging in
+        self.call('read', 'loadUserContent', lambda: None)
+
+    def call(self, endpoint, name, fn):
+        return self.world.send(self.scheduler, 'notion', endpoint, name, fn)
+
+    def clear_cache(self):
+        with self.cache_lock:
+            self.cached = set()
+
+    def block(self, id_):
+        block = self.world.notion.get(id_)
+        if block is None or not block['alive']:
+            raise FakeError(f"Notion block {id_} not found")
+        return block
+
+    def new_block(self, parent_id, type_, title):
+        id_ = str(uuid.uuid4())
+        self.world.notion[id_] = dict(type=type_, title=title, parent=parent_id, content=[], alive=True)
+        self.block(parent_id)['content'].append(id_)
+        return id_
+
+    def read(self, ids):
+        """ Fetch the records that aren't cached yet, FETCH_CHUNK at a time. """
+        with self.cache_lock:
+            ids = [id_ for id_ in dict.fromkeys(ids) if id_ not in self.cached]
+        for i in range(0, len(ids), FETCH_CHUNK):
+            self.call('read', 'getRecordValues', lambda: None)
+        with self.cache_lock:
+            self.cached.update(ids)
+
+    def write(self, fn):
+        return self.call('write', 'submitTransaction', fn)
+
+    def preload(self, page_ids):
+        self.read(page_ids)
+        self.read([child for id_ in page_ids for child in self.world.notion.get(id_, {}).get('content', [])])
+
+    @staticmethod
+    def header(text):
+        return {'object': 'block', 'type': 'heading_2', 'heading_2': {'text': [{'text': {'content': text}}]}}
+
+    @staticmethod
+    def file(name, url):
+        return {'object': 'block', 'type': 'bulleted_list_item', 'bulleted_list_item': {'text': [{
+            'type': 'text', 'text': {'content': name, 'link': {'url': url}}}]}}
+
+    @staticmethod
+    def sub_folder(parent_id, name):
+        return {'parent': {'page_id': parent_id}, 'properties': {'title': {'title': [{'text': {'content': name}}]}}}
+
+    def append_header(self, parent_id, text):
+        self.append_blocks(parent_id, [self.header(text)])
+
+    def append_files(self, parent_id, drive_files):
+        blocks = [self.file(file['name'], file['url']) for file in drive_files.values()]
+        ids = []
+        for i in range(0, len(blocks), APPEND_LIMIT):
+            ids.extend(self.append_blocks(parent_id, blocks[i:i + APPEND_LIMIT]))
+        return ids
+
+    def append_blocks(self, parent_id, blocks):
+        if len(blocks) > APPEND_LIMIT:
+            raise ValueError(f"Notion appends at most {APPEND_LIMIT} blocks at a time, got {len(blocks)}")
+
+        def append():
+            for block in blocks:
+                self.new_block(parent_id, block['type'], json.dumps(block[block['type']]))
+        self.call('official', 'blocks.children.append', append)
+        # Like Notion.append_blocks, the new IDs are read off the end of the page
+        return [child['id'] for child in self.list_children(parent_id)[-len(blocks):]]
+
+    def list_children(self, parent_id):
+        children = []
+        while True:
+            start = len(children)
+            page = self.call('official', 'blocks.children.list',
+                             lambda: self.block(parent_id)['content'][start:start + PAGE_SIZE])
+            children.extend(dict(id=id_, type=self.world.notion[id_]['type']) for id_ in page)
+            if len(page) < PAGE_SIZE:
+                return children
+
+    def append_sub_folder(self, parent_id, name):
+        return self.call('official', 'pages.create', lambda: dict(id=self.new_block(parent_id, 'child_page', name)))
+
+    def add_sub_folder(self, parent_id, name):
+        _, (sub_folder_id,) = self.add_links(parent_id, sub_folders=[name])
+        return types.SimpleNamespace(id=sub_folder_id)
+
+    def move_sub_folder(self, id_, parent_id):
+        self.add_links(parent_id, moved_sub_folders=[id_])
+        return types.SimpleNamespace(id=id_)
+
+    def add_links(self, id_, files=(), sub_folders=(), moved_sub_folders=()):
+        self.read([id_] + self.world.notion.get(id_, {}).get('content', []) + list(moved_sub_folders))
+
+        def link():
+            page = self.block(id_)
+            file_ids = [self.new_block(id_, 'bulleted_list', f"[{name}]({url})") for name, url in files]
+            sub_folder_ids = [self.new_block(id_, 'page', name) for name in sub_folders]
+            for page_id in moved_sub_folders:
+                moved = self.block(page_id)
+                old_parent = self.world.notion.get(moved['parent'])
+                if old_parent and page_id in old_parent['content']:
+                    old_parent['content'].remove(page_id)
+                moved['parent'] = id_
+                page['content'].append(page_id)
+
+            # Files section, then Folders section, each sorted by title
+            children = [self.world.notion[child] for child in page['content']]
+            titles = {child: self.world.notion[child]['title'].lower() for child in page['content']}
+            headers = {child['title']: id_ for id_, child in zip(page['content'], children)
+                       if child['type'] == 'sub_header'}
+            file_entries = sorted((child for child in page['content']
+                                   if self.world.notion[child]['type'] in self.FILE_TYPES), key=titles.get)
+            folder_entries = sorted((child for child in page['content']
+                                     if self.world.notion[child]['type'] in self.PAGE_TYPES), key=titles.get)
+            content = []
+            if file_entries:
+                content += [headers.get('Files') or self.new_block(id_, 'sub_header', 'Files')] + file_entries
+            if folder_entries:
+                content += [headers.get('Folders') or self.new_block(id_, 'sub_header', 'Folders')] + folder_entries
+            page['content'] = content
+            return file_ids, sub_folder_ids
+
+        return self.write(link)
+
+    def get_file_ids(self, parent_id):
+        return [block['id'] for block in self.list_children(parent_id) if block['type'] in self.FILE_TYPES]
+
+    def delete(self, id_):
+        self.read([id_])
+
+        def remove():
+            block = self.block(id_)
+            block['alive'] = False
+            parent = self.world.notion.get(block['parent'])
+            if parent and id_ in parent['content']:
+                parent['content'].remove(id_)
+        self.write(remove)
+
+    def retitle(self, id_, title):
+        self.read([id_])
+        self.write(lambda: self.block(id_).update(title=title(self.block(id_)['title'])))
+
+    def rename_file(self, id_, text):
+        self.retitle(id_, lambda title: f"[{text}]({title.split('](')[-1]}")
+
+    def relink_file(self, id_, url):
+        self.retitle(id_, lambda title: f"{title.split('](')[0]}]({url})")
+
+    def add_file(self, id_, name, url):
+        (file_id,), _ = self.add_links(id_, files=[(name, url)])
+        return types.SimpleNamespace(id=file_id)
+
+    def rename_sub_folder(self, id_, name):
+        self.retitle(id_, lambda title: name)
+
+
+_client = None
+
+
+async def get_client(allow_prompt=True):
+    return _client
+
+
+def install(world):
+    """ Put the fakes in place of rmcl, drive, and notional. Call this before update or mirror are imported. """
+    global _client
+    _client = Client(world)
+    Item.world = world
+    FakeDrive.world = world
+    FakeNotion.world = world
+
+    api = types.ModuleType('rmcl.api')
+    api.get_client = get_client
+    api.get_client_s = lambda allow_prompt=True: _client
+    rmcl = types.ModuleType('rmcl')
+    rmcl.api = api
+    rmcl.Item = Item
+    rmcl.Document = Document
+
+    drive = types.ModuleType('drive')
+    drive.Drive = FakeDrive
+    notional = types.ModuleType('notional')
+    notional.Notion = FakeNotion
+    notional.APPEND_LIMIT = APPEND_LIMIT
+
+    sys.modules.update({'rmcl': rmcl, 'rmcl.api': api, 'drive': drive, 'notional': notional})
@@ -0,0 +1,64 @@
+""" Synthetic reMarkable trees for the fake backends, and the changes the benchmark scenarios make to them. """
+
+
+def generate(world, folders=20, documents=200, pages=3, depth=3):
+    """ Fill a World's reMarkable with `folders` folders, nested at most `depth` deep, and `documents` notebooks of
+    `pages` pages each, spread over the root and the folders. Uses the World's random generator, so a given seed
+    always makes the same tree. """
+    parents = ['']
+    depths = {'': 0}
+    for i in range(folders):
+        parent = world.random.choice([id_ for id_ in parents if depths[id_] < depth])
+        id_ = world.add_folder(f"Folder {i:04d}", parent)
+        parents.append(id_)
+        depths[id_] = depths[parent] + 1
+
+    for i in range(documents):
+        world.add_document(f"Notebook {i:05d}", world.random.choice(parents), pages)
+
+
+def documents(world):
+    return sorted(id_ for id_, metadata in world.rm.items() if metadata['Type'] == 'DocumentType')
+
+
+def sample(world, fraction):
+    """ A random `fraction` of the documents, at least one unless there are none. """
+    ids = documents(world)
+    if not ids:
+        return []
+    return world.random.sample(ids, max(1, min(len(ids), round(len(ids) * fraction))))
+
+
+def churn(world, fraction):
+    """ Draw on a page of some documents, and move a few of them to another folder. """
+    folders = [''] + sorted(id_ for id_, metadata in world.rm.items() if metadata['Type'] == 'CollectionType')
+    for i, id_ in enumerate(sample(world, fraction)):
+        world.edit_document(id_)
+        if i % 5 == 4:
+            world.move(id_, world.random.choice(folders))
+
+
+def rename(world, fraction):
+    for id_ in sample(world, fraction):
+        world.rename(id_, world.rm[id_]['VissibleName'] + ' (renamed)')
+
+
+def delete(world, fraction):
+    for id_ in sample(world, fraction):
+        world.delete(id_)
+
+
+def drift(world, fraction):
+    """ Change Drive behind the sync's back: trash some of the files, and rename or move some others. """
+    files = sorted(id_ for id_, item in world.drive.items() if not item['folder'] and not item['trashed'])
+    folders = sorted(id_ for id_, item in world.drive.items() if item['folder'] and not item['trashed'])
+    if not files:
+        return
+    changed = world.random.sample(files, max(1, min(len(files), round(len(files) * fraction))))
+    for i, id_ in enumerate(changed):
+        if i % 3 == 0:
+            world.drive[id_]['trashed'] = True
+        elif i % 3 == 1:
+            world.drive[id_]['title'] += ' (edited on Drive)'
+        else:
+            world.drive[id_]['parents'] = [world.random.choice(folders)]
@@ -0,0 +1,199 @@
+""" Benchmark whole syncs against the fake backends in bench.fakes, e.g.
+
+    python -m bench.run noop churn --documents 2000 --latency 0.05
+
+Scenarios: `initial` mirrors a fresh tree with mirror.py. The others mirror it first, then time one update.py run:
+`noop` after no changes, `churn` after drawing on 1% of the documents (and moving some of those), `rename` after
+renaming 20% of them, and `delete` after deleting 20% of them. `drift` runs it with --verify after trashing, renaming,
+or moving 5% of the files on Drive.
+
+Each scenario runs in a fresh process, in a temporary directory with its own state store and caches. Only the timed
+part is measured: wall time, calls per service and method, and the peak RSS of the sync process and of its busiest
+render worker. Injected errors and rate limits only apply to the timed part too. The sync's own metrics (see
+metrics.py) end up in the scenario's directory, covering the timed part as well. """
+import argparse
+from functools import partial
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ('initial', 'noop', 'churn', 'rename', 'delete', 'drift')
+
+# Share of the documents that each scenario changes, unless --fraction says otherwise
+FRACTIONS = dict(churn=0.01, rename=0.2, delete=0.2, drift=0.05)
+
+# Environment the sync modules read at import. None of it gets used against the fakes.
+ENVIRONMENT = ('MAILHOST', 'FROMADDR', 'TOADDRS', 'OFFICIAL_NOTION_TOKEN', 'UNOFFICIAL_NOTION_TOKEN')
+
+
+def peak_rss(pid='self', reset=False):
+    """ Peak resident set size of a process in KB. With `reset`, start measuring the peak from now on instead.
+
+    Reads /proc, which only Linux has; elsewhere this falls back on the peak of this whole process. """
+    try:
+        if reset:
+            with open(f'/proc/{pid}/clear_refs', 'w') as file:
+                file.write('5')
+            return
+        with open(f'/proc/{pid}/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    if not reset and pid == 'self':
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def render_workers(*modules):
+    return [pid for module in modules if module.renderer.pool for pid in module.renderer.pool._processes]
+
+
+def run_scenario(name, args):
+    """ Set up and time one scenario in this process. Returns the measurements as a dict. """
+    os.chdir(tempfile.mkdtemp(prefix=f'bench-{name}-'))
+    sys.path.insert(0, REPO)
+    for key in ENVIRONMENT:
+        os.environ.setdefault(key, 'bench')
+
+    from bench import fakes, generate
+
+    world = fakes.World(latency=args.latency, seed=args.seed)
+    generate.generate(world, args.folders, args.documents, args.pages, args.depth)
+    os.environ['NOTION_ROOT'] = world.notion_root
+    fakes.install(world)
+
+    import trio
+    from folder import Folder
+    import log
+    from metrics import metrics
+    import mirror
+    import update
+
+    # Errors are expected with injected faults; don't try to email them
+    for module in (mirror, update):
+        module.logger.handlers = [handler for handler in module.logger.handlers
+                                  if not isinstance(handler, log.SpoolingSMTPHandler)]
+
+    def initial():
+        root_folder = Folder('root',
+                             rm=dict(id_=mirror.rm.ROOT),
+                             drive=dict(id_=mirror.drive.ROOT),
+                             notion=dict(id_=mirror.notion.ROOT))
+        trio.run(mirror.mirror, root_folder)
+        Folder.state().commit()
+        mirror.journal.finish()
+
+    timed = initial
+    if name != 'initial':
+        initial()
+        if name in FRACTIONS:
+            getattr(generate, name)(world, args.fraction if args.fraction else FRACTIONS[name])
+        timed = partial(trio.run, partial(update.run_update, args.parallelism, verify=name == 'drift',
+                                          budget=args.deadline))
+
+    world.errors = args.errors
+    world.throttles = args.throttles
+    world.calls.clear()
+    world.throttled = 0
+    metrics.reset()
+    for pid in ['self'] + render_workers(mirror, update):
+        peak_rss(pid, reset=True)
+
+    start = time.perf_counter()
+    timed()
+    wall = time.perf_counter() - start
+
+    workers = [peak_rss(pid) for pid in render_workers(mirror, update)]
+    return dict(scenario=name,
+                wall_seconds=round(wall, 3),
+                calls=dict(sorted(world.calls.items())),
+                throttled=world.throttled,
+                rss_kb=peak_rss(),
+                worker_rss_kb=max([rss for rss in workers if rss] or [0]))
+
+
+def report(results):
+    """ Print a table of the results, then each scenario's calls per service and method. """
+    print(f"{'scenario':<10} {'wall s':>9} {'rm':>7} {'drive':>7} {'notion':>7} {'throttled':>9} "
+          f"{'RSS MB':>8} {'worker MB':>9}")
+    for result in results:
+        if 'error' in result:
+            print(f"{result['scenario']:<10} failed: {result['error']}")
+            continue
+        totals = {service: sum(count for key, count in result['calls'].items() if key.startswith(service + '.'))
+                  for service in ('rm', 'drive', 'notion')}
+        print(f"{result['scenario']:<10} {result['wall_seconds']:>9.3f} {totals['rm']:>7} {totals['drive']:>7} "
+              f"{totals['notion']:>7} {result['throttled']:>9} {result['rss_kb'] / 1024:>8.1f} "
+              f"{result['worker_rss_kb'] / 1024:>9.1f}")
+
+    for result in results:
+        if 'calls' in result:
+            print(f"\n{result['scenario']}:")
+            for key, count in result['calls'].items():
+                print(f"    {key:<40} {count:>7}")
+
+
+def main(args):
+    options = ['--folders', str(args.folders), '--documents', str(args.documents), '--pages', str(args.pages),
+               '--depth', str(args.depth), '--latency', str(args.latency), '--errors', str(args.errors),
+               '--throttles', str(args.throttles), '--parallelism', str(args.parallelism), '--seed', str(args.seed)]
+    if args.fraction:
+        options += ['--fraction', str(args.fraction)]
+    if args.deadline is not None:
+        options += ['--deadline', str(args.deadline)]
+
+    results = []
+    for name in args.scenarios if args.scenarios else SCENARIOS:
+        process = subprocess.run([sys.executable, '-m', 'bench.run', '--child', name] + options, cwd=REPO,
+                                 stdout=subprocess.PIPE, stderr=None if args.verbose else subprocess.DEVNULL)
+        if process.returncode == 0:
+            results.append(json.loads(process.stdout.decode().splitlines()[-1]))
+        else:
+            results.append(dict(scenario=name, error=f"exit status {process.returncode}"))
+
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+    else:
+        report(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark syncs against local fake reMarkable, Drive, and Notion "
+                                                 "backends.")
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help=f"scenarios to run, out of {', '.join(SCENARIOS)} (all by default)")
+    parser.add_argument('--folders', type=int, default=20, help="number of folders in the tree")
+    parser.add_argument('--documents', type=int, default=200, help="number of notebooks in the tree")
+    parser.add_argument('--pages', type=int, default=3, help="pages per notebook")
+    parser.add_argument('--depth', type=int, default=3, help="how deep folders are nested at most")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds each call to a fake service takes")
+    parser.add_argument('--errors', type=float, default=0.0, help="chance of any Drive or Notion call failing")
+    parser.add_argument('--throttles', type=float, default=0.0,
+                        help="chance of any Drive or Notion call being rate limited")
+    parser.add_argument('--fraction', type=float,
+                        help="share of the documents that churn, rename, delete, or drift change")
+    parser.add_argument('--parallelism', type=int, default=8, help="update.py's --parallelism")
+    parser.add_argument('--deadline', type=float, help="update.py's --deadline, for the timed update")
+    parser.add_argument('--seed', type=int, default=0, help="seed for the tree and for injected faults")
+    parser.add_argument('--json', action='store_true', help="print one JSON object per scenario instead of a table")
+    parser.add_argument('--verbose', action='store_true', help="show the sync's log")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    for scenario in args.scenarios + ([args.child] if args.child else []):
+        if scenario not in SCENARIOS:
+            parser.error(f"unknown scenario {scenario}")
+
+    if args.child:
+        result = run_scenario(args.child, args)
+        # Render workers and logging may have printed before; the result is always the last line
+        print(json.dumps(result), flush=True)
+    else:
+        main(args)
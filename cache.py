@@ -0,0 +1,116 @@
+""" On-disk cache of rendered PDFs, so that a failed upload doesn't mean rendering the document all over again. """
+import os
+import shutil
+import tempfile
+import time
+
+CACHE_DIR = 'pdf_cache'
+
+# Upper bound on the total size of the cache. The least recently used PDFs are evicted first.
+CACHE_BYTES = int(os.environ.get('PDF_CACHE_MB', 2048)) * 1024 * 1024
+
+# Rendered pages of documents, keyed by a hash of everything that goes into rendering them
+PAGE_CACHE_DIR = 'page_cache'
+PAGE_CACHE_BYTES = int(os.environ.get('PAGE_CACHE_MB', 1024)) * 1024 * 1024
+
+# Temporary files this old were left behind by a crash
+STALE_SECONDS = 24 * 60 * 60
+
+
+class PdfCache:
+    """ Rendered PDFs keyed by Remarkable document ID and version.
+
+    A new version of a document always gets a new key, so entries never go stale; they just stop being used.
+    PDFs are handed out as open files, which stay readable even if the entry is evicted in the meantime. """
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, id_, version):
+        return os.path.join(self.directory, f"{id_}.{version}.pdf")
+
+    def get(self, id_, version):
+        """ Return the cached PDF for a document version as an open binary file, or None if it isn't cached. """
+        path = self.path(id_, version)
+        try:
+            pdf = open(path, 'rb')
+        except FileNotFoundError:
+            return
+
+        # Bump the modification time; eviction goes by least recently used. The entry may have been evicted since it
+        # was opened, which is fine, as the open file stays readable.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return pdf
+
+    def temp_path(self):
+        """ Return the path of a new, empty temporary file inside the cache directory. """
+        # Every entry starts out as one of these, so this is where the directory gets created, rather than whenever
+        # a cache is set up (e.g. on importing the update script)
+        os.makedirs(self.directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(fd)
+        return path
+
+    def spool(self, stream):
+        """ Copy a file-like object to a temporary file inside the cache directory and return its path. """
+        path = self.temp_path()
+        with open(path, 'wb') as file:
+            shutil.copyfileobj(stream, file)
+        return path
+
+    def put(self, id_, version, temp_path, tidy=True):
+        """ Move a finished PDF from a temporary path into the cache and return it as an open binary file.
+
+        Older versions of the same document are removed and the cache is trimmed to size, unless `tidy` is False;
+        then it's up to the caller to evict() once it's done adding entries.
+        The temporary file should already be flushed to disk. """
+        try:
+            pdf = open(temp_path, 'rb')
+            # Renaming is atomic, so a crash never leaves a truncated PDF under a real key
+            os.replace(temp_path, self.path(id_, version))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        if not tidy:
+            return pdf
+
+        for name in os.listdir(self.directory):
+            if name.startswith(f"{id_}.") and name != os.path.basename(self.path(id_, version)):
+                self.remove(name)
+
+        self.evict()
+        return pdf
+
+    def evict(self):
+        """ Delete the least recently used PDFs until the cache fits within its size limit. """
+        if not os.path.isdir(self.directory):
+            return  # Nothing has been cached yet
+        entries = []
+        for name in os.listdir(self.directory):
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue  # Another thread got to it first
+            if name.endswith('.pdf'):
+                entries.append((stat.st_mtime, stat.st_size, name))
+            elif name.endswith('.tmp') and stat.st_mtime < time.time() - STALE_SECONDS:
+                self.remove(name)
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.remove(name)
+            total -= size
+
+    def remove(self, name):
+        # Several threads may evict at once, so the file may already be gone
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
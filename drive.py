@@ -1,55 +1,234 @@
+from functools import partial
+import hashlib
+import io
+import threading
+
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload
 from pydrive2.auth import GoogleAuth
 from pydrive2.drive import GoogleDrive
 
+from metrics import metrics
+from state import UploadSessions
+import throttle
+
+# PDFs are uploaded in pieces of this size. Drive requires a multiple of 256 KB.
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# How many times to retry a chunk on a server error before giving up for this run
+RETRIES = 3
+
+# Drive accepts at most this many calls in a single batch request
+BATCH_LIMIT = 100
+
+# files.list returns at most this many items per page
+LIST_PAGE_SIZE = 1000
+
+# Folders whose children are listed by a single files.list query, keeping the query well under Drive's length limit
+LIST_PARENTS = 50
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
 
 class Drive:
-    """ Mediates interaction with the Google Drive API. """
-    def __init__(self):
-        gauth = GoogleAuth()
+    """ Mediates interaction with the Google Drive API.
+
+    Methods may be called from several worker threads at once (see services.AsyncService).
+    `settings_file` is PyDrive2's settings file, which says where the account's credentials are saved. """
+    def __init__(self, sessions=None, scheduler=None, settings_file=None):
+        self.sessions = sessions if sessions else UploadSessions()
+        self.scheduler = scheduler if scheduler else throttle.scheduler
+
+        gauth = GoogleAuth(settings_file) if settings_file else GoogleAuth()
         gauth.LocalWebserverAuth()
+        self.auth = gauth
+        self.auth.http.request = self.throttled(self.auth.http.request)
         self.client = GoogleDrive(gauth)
+        self.local = threading.local()
         self.ROOT = self.client.ListFile({
             'q': "'root' in parents and title = 'remarkable' and trashed=false"
         }).GetList()[0]['id']
 
+    @property
+    def param(self):
+        """ Request parameters carrying this thread's own authorized connection, since httplib2 isn't thread-safe. """
+        if not hasattr(self.local, 'http'):
+            self.local.http = self.auth.Get_Http_Object()
+            self.local.http.request = self.throttled(self.local.http.request)
+        return {'http': self.local.http}
+
+    def throttled(self, request):
+        """ Wrap an httplib2 request method so that every request it sends, down to single upload chunks and whole
+        batches, is paced by the shared scheduler. """
+        def send(uri, method='GET', *args, **kwargs):
+            if '/batch' in uri:
+                endpoint = 'batch'
+            elif '/upload/' in uri:
+                endpoint = 'upload'
+            else:
+                endpoint = 'metadata'
+            return self.scheduler.send('drive', endpoint, partial(request, uri, method, *args, **kwargs),
+                                       self.inspect)
+        return send
+
+    @staticmethod
+    def inspect(response):
+        """ Drive signals rate limits with 429s, but also with 403s whose reason ends in rateLimitExceeded. """
+        resp, content = response
+        rate_limited = resp.status == 403 and any(reason in (content or b'')
+                                                  for reason in (b'rateLimitExceeded', b'userRateLimitExceeded'))
+        return resp.status == 429 or rate_limited, resp.get('retry-after')
+
     def upload_pdf(self, parent_id, name, pdf):
-        """ Upload an in-memory PDF to drive. """
+        """ Upload a PDF file to drive. """
         metadata = {
             'title': name,
-            "parents": [{'id': parent_id}]
+            "parents": [{'id': parent_id}],
+            "mimeType": 'application/pdf'
         }
 
-        file = self.client.CreateFile(metadata)
-
-        file.content = pdf
-        file["mimeType"] = 'application/pdf'
-
-        file.Upload()
-
-        return file
+        return self.resumable_upload(
+            lambda media: self.auth.service.files().insert(body=metadata, media_body=media),
+            pdf, f"insert:{parent_id}:{name}")
 
     def create_folder(self, parent_id, name):
         """ Add a folder to drive under the specified parent_id folder. """
         folder = self.client.CreateFile({'title': name,
                                          "parents": [{"kind": "drive#fileLink", "id": parent_id}],
-                                         "mimeType": "application/vnd.google-apps.folder"})
-        folder.Upload()
+                                         "mimeType": FOLDER_MIME_TYPE})
+        folder.Upload(param=self.param)
 
         return folder
 
     def delete(self, id_):
         """ Delete an existing drive file or folder with a given id. """
-        self.client.CreateFile({'id': id_}).Trash()
+        self.client.CreateFile({'id': id_}).Trash(param=self.param)
 
     def rename(self, id_, name):
         """ Rename an existing drive file or folder with a given id without changing its contents. """
-        item = self.client.CreateFile({'id': id_})
-        item.FetchMetadata()
-        item['title'] = name
-        item.Upload()
+        # A patch of the title alone, on this thread's throttled connection. PyDrive2's FetchMetadata can't be given
+        # a connection, and the title is all that changes anyway.
+        self.auth.service.files().patch(fileId=id_, body=dict(title=name), fields='id').execute(http=self.param['http'])
+
+    def list_tree(self, root_id=None):
+        """ List every file and folder under a Drive folder, ROOT by default, without fetching any of them.
+
+        Goes one level of folders at a time, with a paged files.list query per LIST_PARENTS folders that only asks
+        for IDs, titles, types, and parents. Returns dict(name, parent, folder) by Drive ID, where `parent` is the
+        listed folder the item was found in. Trashed items are left out. """
+        root_id = root_id if root_id else self.ROOT
+        items = dict()
+        level = [root_id]
+        while level:
+            next_level = []
+            for start in range(0, len(level), LIST_PARENTS):
+                parents = set(level[start:start + LIST_PARENTS])
+                query = ' or '.join(f"'{parent_id}' in parents" for parent_id in sorted(parents))
+                for item in self.list_files(f"({query}) and trashed = false"):
+                    # An item in several listed folders shows up once per folder
+                    if item['id'] in items:
+                        continue
+                    folder = item['mimeType'] == FOLDER_MIME_TYPE
+                    items[item['id']] = dict(name=item['title'],
+                                             parent=next(parent['id'] for parent in item['parents']
+                                                         if parent['id'] in parents),
+                                             folder=folder)
+                    if folder:
+                        next_level.append(item['id'])
+            level = next_level
+
+        return items
+
+    def list_files(self, query):
+        """ Yield every file matching a files.list query, a page at a time. """
+        page_token = None
+        while True:
+            response = self.auth.service.files().list(
+                q=query, maxResults=LIST_PAGE_SIZE, pageToken=page_token,
+                fields='nextPageToken, items(id, title, mimeType, parents(id))').execute(http=self.param['http'])
+            yield from response.get('items', [])
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return
+
+    def apply_batch(self, mutations):
+        """ Send metadata-only changes to existing files as Drive batch requests.
+
+        Each mutation is a dict of keyword arguments for a files.patch call. Returns the response or the exception
+        for each mutation, in the same order, so that one failed change doesn't hide the outcome of the others. """
+        results = [None] * len(mutations)
+
+        def record(request_id, response, exception):
+            results[int(request_id)] = exception if exception else response
+
+        for start in range(0, len(mutations), BATCH_LIMIT):
+            batch = self.auth.service.new_batch_http_request(callback=record)
+            for i in range(start, min(start + BATCH_LIMIT, len(mutations))):
+                batch.add(self.auth.service.files().patch(fields='id', **mutations[i]), request_id=str(i))
+            batch.execute(http=self.param['http'])
+
+        return results
 
     def replace_pdf(self, id_, pdf):
         """ Replace the content of an existing drive PDF with a given id. """
-        file = self.client.CreateFile({'id': id_})
-        file.content = pdf
-        file.Upload()
+        self.resumable_upload(
+            lambda media: self.auth.service.files().update(fileId=id_, media_body=media),
+            pdf, f"update:{id_}")
+
+    def resumable_upload(self, build_request, pdf, key):
+        """ Upload a PDF file in chunks through Drive's resumable upload protocol and return the resulting file.
+
+        The session URI is saved once Drive hands it out, so if the upload is interrupted, a later attempt with the
+        same content carries on from the last chunk Drive received instead of starting over. """
+        key = f"{key}:{self.digest(pdf)}"
+        uri = self.sessions.get(key)
+        try:
+            response = self.send_chunks(build_request, pdf, key, uri)
+        except HttpError as e:
+            if uri is None or e.resp.status not in (404, 410):
+                raise
+            # The saved session has expired, so start over
+            self.sessions.delete(key)
+            response = self.send_chunks(build_request, pdf, key, None)
+
+        metrics.value('drive.uploaded_bytes', pdf.seek(0, io.SEEK_END))
+        return response
+
+    def send_chunks(self, build_request, pdf, key, uri):
+        media = MediaIoBaseUpload(pdf, mimetype='application/pdf', chunksize=CHUNK_SIZE, resumable=True)
+        request = build_request(media)
+
+        response = self.resume(request, media, uri) if uri else None
+        while response is None:
+            _, response = request.next_chunk(http=self.param['http'], num_retries=RETRIES)
+            if request.resumable_uri and request.resumable_uri != uri:
+                uri = request.resumable_uri
+                self.sessions.set(key, uri)
+
+        self.sessions.delete(key)
+        return response
+
+    def resume(self, request, media, uri):
+        """ Point an upload request at a saved session, starting after the last byte Drive received.
+
+        Returns the uploaded file if Drive had received all of it already, and None otherwise. Raises HttpError if
+        the session can't be resumed. """
+        headers = {'Content-Length': '0', 'Content-Range': f'bytes */{media.size()}'}
+        resp, content = self.param['http'].request(uri, 'PUT', headers=headers)
+        if resp.status in (200, 201):
+            return request.postproc(resp, content)
+        if resp.status != 308:
+            raise HttpError(resp, content, uri=uri)
+
+        # Drive leaves out the range if it has received nothing yet
+        request.resumable_uri = uri
+        request.resumable_progress = int(resp['range'].split('-')[1]) + 1 if 'range' in resp else 0
+
+    @staticmethod
+    def digest(pdf):
+        """ Hash a file's contents, so that a saved session is only ever resumed with exactly the same bytes. """
+        sha = hashlib.sha256()
+        for chunk in iter(lambda: pdf.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+        pdf.seek(0)
+        return sha.hexdigest()
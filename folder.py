@@ -1,5 +1,6 @@
 """ Infrastructure for keeping track of data across RM, Drive, and Notion. """
-import json
+from metrics import metrics
+from state import StateStore
 
 
 class FolderData:
@@ -17,6 +18,9 @@ class FolderData:
 
 class Folder:
     """ Groups RM, Drive, and Notion data together into a single object. """
+    # Where every folder is saved to and loaded from, opened on first use
+    store = None
+
     def __init__(self, name, **kwargs):
         self.name = name
 
@@ -27,21 +31,32 @@ class Folder:
         self.drive = FolderData(**kwargs['drive'])
         self.notion = FolderData(**kwargs['notion'])
 
-    def save(self):
-        """ Serialize the contents of this folder to a JSON file. """
-        with open(f"folder_state/{self.id_}.json", 'w') as file:
-            json.dump(self, file, default=vars)
+        # The rows in the store as of the last load or save, so that saving only writes what changed
+        self.saved_rows = None
 
     @classmethod
-    def maybe_load(cls, id_):
-        """ Try to construct a Folder instance from a JSON file.
+    def state(cls):
+        if cls.store is None:
+            cls.store = StateStore()
+        return cls.store
+
+    def to_dict(self):
+        return dict(name=self.name, rm=vars(self.rm), drive=vars(self.drive), notion=vars(self.notion))
 
-        If the file doesn't exist, return empty-handed. """
-        try:
-            with open(f"folder_state/{id_}.json", 'r') as file:
-                folder_dict = json.load(file)
+    def save(self):
+        """ Write the contents of this folder to the state store. """
+        with metrics.span('state.save'):
+            self.saved_rows = self.state().save_folder(self.to_dict(), self.saved_rows)
 
-            return cls(**folder_dict)
+    @classmethod
+    def maybe_load(cls, id_):
+        """ Try to construct a Folder instance from the state store.
 
-        except FileNotFoundError as e:
+        If the folder has never been saved, return empty-handed. """
+        folder_dict = cls.state().load_folder(id_)
+        if not folder_dict:
             return
+
+        folder = cls(**folder_dict)
+        folder.saved_rows = cls.state().rows(folder_dict)
+        return folder
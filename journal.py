@@ -0,0 +1,49 @@
+""" Append-only journal of completed operations, so that an interrupted mirror can pick up where it stopped. """
+import json
+import os
+
+JOURNAL = 'mirror_journal.jsonl'
+
+
+class Journal:
+    """ Records each completed Drive and Notion operation, along with the IDs it returned, one JSON line each.
+
+    Every entry is flushed as it's written, which survives the script crashing; checkpoint() also fsyncs, which
+    survives the machine going down. Opening an existing journal replays it, so that completed operations can be
+    looked up with get() and skipped. """
+    def __init__(self, path=JOURNAL):
+        self.path = path
+        self.entries = dict()
+
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line may have been cut short by the crash
+                        continue
+                    self.entries[(entry['op'], entry['key'])] = entry['result']
+
+        self.file = open(path, 'a')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, op, key):
+        """ Return what a completed operation returned, or None if it hasn't been completed. """
+        return self.entries.get((op, key))
+
+    def record(self, op, key, result):
+        """ Record a completed operation. `result` has to be JSON-serializable and truthy. """
+        self.entries[(op, key)] = result
+        self.file.write(json.dumps(dict(op=op, key=key, result=result)) + '\n')
+        self.file.flush()
+
+    def checkpoint(self):
+        os.fsync(self.file.fileno())
+
+    def finish(self):
+        """ Delete the journal once everything it covers has been saved to the state store. """
+        self.file.close()
+        os.remove(self.path)
@@ -1,23 +1,50 @@
+import hashlib
+import json
 import logging
-from logging.handlers import BufferingHandler
 import os
-import pickle as pkl
+import re
+import threading
+import time
 
 MAILHOST = os.environ['MAILHOST']
 FROMADDR = os.environ['FROMADDR']
 TOADDRS = os.environ['TOADDRS'].split(' ')
 
+# The run's log goes to this file instead of memory, and is what gets emailed. Past LOG_SPOOL_KB, its older half is
+# dropped, so the email always has the end of the run.
+SPOOL_FILE = '.log_spool'
+SPOOL_BYTES = int(os.environ.get('LOG_SPOOL_KB', 1024)) * 1024
+
+# Every kind of error seen so far, with counts and when it was first and last seen
+ERROR_INDEX = '.error_index.json'
+# An error that hasn't come up for this long is forgotten, and counts as new if it comes back
+ERROR_MEMORY_DAYS = 7
+
+# The messages that end an update or mirror run, and make the handler decide whether to send the log
+END_OF_RUN = ("Update complete", "Mirroring complete")
+
+FORMAT = '%(asctime)s %(levelname)-5s %(message)s'
+
+# Parts of exception messages that differ between otherwise equivalent errors, most specific first
+VARIABLE_PARTS = [(re.compile(r'https?://\S+'), '<url>'),
+                  (re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', re.IGNORECASE), '<id>'),
+                  (re.compile(r'"[^"]*"|\'[^\']*\''), '<str>'),
+                  (re.compile(r'\b(?=[\w-]*\d)[\w-]{16,}\b'), '<id>'),
+                  (re.compile(r'\d+(\.\d+)?'), '<n>')]
+# How many leading words of any other message tell what went wrong, as in "Could not move"
+GIST_WORDS = 3
+
 
 def set_up_logger(module):
     logger = logging.getLogger(module)
     logger.handlers.clear()
 
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-5s %(message)s')
+    logging.basicConfig(level=logging.INFO, format=FORMAT)
 
-    smtp_handler = BufferingSMTPHandler(mailhost=MAILHOST,
-                                        fromaddr=FROMADDR,
-                                        toaddrs=TOADDRS,
-                                        subject='RM Sync Error')
+    smtp_handler = SpoolingSMTPHandler(mailhost=MAILHOST,
+                                       fromaddr=FROMADDR,
+                                       toaddrs=TOADDRS,
+                                       subject='RM Sync Error')
 
     logger.addHandler(smtp_handler)
 
@@ -28,70 +55,175 @@ def set_up_logger(module):
     return logger
 
 
-class BufferingSMTPHandler(BufferingHandler):
+def fingerprint(record):
+    """ What kind of error a record is, regardless of the item names and IDs in it, and of edits elsewhere in the file.
+
+    Messages like "Could not move {name}." are told apart by the function they're logged from and their first few
+    words, which come before any name. The exception text that follows them in "Error message: ..." is normalised
+    and kept whole, since one statement can log many kinds of exceptions. """
+    message = record.getMessage().strip()
+    if message.startswith("Error message"):
+        for pattern, replacement in VARIABLE_PARTS:
+            message = pattern.sub(replacement, message)
+        message = ' '.join(message.split())
+    else:
+        message = ' '.join(message.split()[:GIST_WORDS])
+    key = f"{record.name}:{record.funcName}:{message}"
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+class Spool:
+    """ The log lines of the current run, on disk and capped at `max_bytes`.
+
+    Lines go to the spool file until it holds half the cap, which then becomes the '.1' file, replacing the one
+    before. Together the two files hold between half the cap and the whole of it, always the newest lines. """
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.file = None
+        # Whether lines were dropped to stay under the cap
+        self.truncated = False
+        self.lock = threading.Lock()
+
+    def write(self, line):
+        with self.lock:
+            if not self.file:
+                self.file = open(self.path, 'a', encoding='utf-8')
+            self.file.write(line + '\n')
+            if self.file.tell() >= self.max_bytes // 2:
+                self.file.close()
+                self.file = None
+                self.truncated = self.truncated or os.path.exists(self.path + '.1')
+                os.replace(self.path, self.path + '.1')
+
+    def read(self):
+        with self.lock:
+            if self.file:
+                self.file.flush()
+            lines = []
+            for path in (self.path + '.1', self.path):
+                if os.path.exists(path):
+                    with open(path, 'r', encoding='utf-8', errors='replace') as file:
+                        lines.extend(file.read().splitlines())
+            return lines
+
+    def clear(self):
+        """ Start over for the next run. """
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+            for path in (self.path, self.path + '.1'):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.truncated = False
+
+
+class ErrorIndex:
+    """ The kinds of errors seen in past runs, stored as fingerprint -> count, first and last seen, and an example. """
+    def __init__(self, path):
+        self.path = path
+        # Fingerprint -> [count, example] for the current run
+        self.current = dict()
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        key = fingerprint(record)
+        with self.lock:
+            if key in self.current:
+                self.current[key][0] += 1
+            else:
+                self.current[key] = [1, record.getMessage().strip()]
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return dict()
+        try:
+            with open(self.path, 'r') as file:
+                return json.load(file)
+        except ValueError:
+            # A damaged index only means some old errors get reported again
+            return dict()
+
+    def finish_run(self):
+        """ Fold the current run's errors into the stored index, and start counting afresh.
+
+        Returns the examples of the errors that weren't in the index, or had been forgotten. """
+        with self.lock:
+            current, self.current = self.current, dict()
+        now = time.time()
+        index = {key: entry for key, entry in self.load().items()
+                 if now - entry['last_seen'] < ERROR_MEMORY_DAYS * 24 * 60 * 60}
+
+        new = []
+        for key, (count, example) in current.items():
+            if key not in index:
+                new.append(example)
+                index[key] = dict(count=0, first_seen=now, example=example)
+            index[key]['count'] += count
+            index[key]['last_seen'] = now
+
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump(index, file, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+        return new
+
+
+# Shared by every handler, since a few modules log to their own loggers in the same run
+spool = Spool(SPOOL_FILE, SPOOL_BYTES)
+errors = ErrorIndex(ERROR_INDEX)
+
+
+class SpoolingSMTPHandler(logging.Handler):
+    """ Spools the run's log to disk, and emails it at the end of the run if there was a new kind of error. """
     def __init__(self, mailhost, fromaddr, toaddrs, subject):
-        # Set 'capacity' to 0 since our overridden shouldFlush doesn't use it
-        BufferingHandler.__init__(self, 0)
+        logging.Handler.__init__(self)
         self.mailhost = mailhost
         self.mailport = None
         self.fromaddr = fromaddr
         self.toaddrs = toaddrs
         self.subject = subject
-        self.setFormatter(logging.Formatter("%(asctime)s %(levelname)-5s %(message)s"))
-        self.should_flush = None
-
-    def flush(self):
-        # This check is needed because by default logging flushes no matter what at the end of program execution
-        if not self.should_flush:
-            return
-        if len(self.buffer) > 0:
-            try:
-                import smtplib
-                port = self.mailport
-                if not port:
-                    port = smtplib.SMTP_PORT
-                smtp = smtplib.SMTP(self.mailhost, port)
-                msg = '''From: {}\r\nTo: {}\r\nSubject: {}\r\n\r\n'''.format(
-                            self.fromaddr,
-                            ",".join(self.toaddrs),
-                            self.subject
-                            )
-                msg = msg + "An error occurred while syncing your Remarkable contents.\r\n" \
-                            "Here is the full execution log:\r\n\r\n"
-                for record in self.buffer:
-                    s = self.format(record)
-                    msg = msg + s + "\r\n"
-                msg = msg.encode("ascii", "ignore")
-                smtp.sendmail(self.fromaddr, self.toaddrs, msg)
-                smtp.quit()
-            except Exception as e:
-                print(e)
-                self.handleError(None)  # no particular record
-
-            self.buffer = []
-
-    def write_errors(self):
-        """ Write errors in the buffer to a file outside of flush for comparison to the subsequent run. """
-        with open(".prev_errs", 'wb') as f:
-            pkl.dump(([record for record in self.buffer if record.levelname == 'ERROR']), f)
-
-    def shouldFlush(self, record: logging.LogRecord) -> bool:
-        """ Only flush at the end of the script's execution, *if* there was a new (previously unseen) error. """
-        if record.msg != "Update complete":
-            return False
-
-        # On the last log statement, load up any errors from the previous run and compare with the current one.
-        # If there are any new errors, flush. If not, don't. Either way, overwrite previous errors with current ones.
-        curr_msgs = {record.msg for record in self.buffer if record.levelname == 'ERROR'}
-        if os.path.exists('.prev_errs'):
-            with open('.prev_errs', 'rb') as f:
-                prev_errors = pkl.load(f)
-            prev_msgs = {error.msg for error in prev_errors}
-        else:
-            prev_msgs = set()
-
-        self.write_errors()
-
-        # Need to check for this instance variable in flush() because logging does something weird when the program ends
-        self.should_flush = len(curr_msgs - prev_msgs) > 0
-        return self.should_flush
+        self.setFormatter(logging.Formatter(FORMAT))
+
+    def emit(self, record):
+        try:
+            spool.write(self.format(record))
+            if record.levelno >= logging.ERROR:
+                errors.add(record)
+            if record.msg in END_OF_RUN:
+                self.finish_run()
+        except Exception:
+            self.handleError(record)
+
+    def finish_run(self):
+        """ Send the spooled log if any error in it is new, then clear the spool either way. In watch mode this runs
+        once per sync, so each email only has its own sync's log. """
+        new = errors.finish_run()
+        if new:
+            self.send(new, spool.read(), spool.truncated)
+        spool.clear()
+
+    def send(self, new, lines, truncated):
+        try:
+            import smtplib
+            port = self.mailport
+            if not port:
+                port = smtplib.SMTP_PORT
+            smtp = smtplib.SMTP(self.mailhost, port)
+            msg = '''From: {}\r\nTo: {}\r\nSubject: {}\r\n\r\n'''.format(
+                        self.fromaddr,
+                        ",".join(self.toaddrs),
+                        self.subject
+                        )
+            msg = msg + "An error occurred while syncing your Remarkable contents.\r\n" \
+                        "New errors:\r\n\r\n"
+            msg = msg + "".join(f"    {example}\r\n" for example in new)
+            msg = msg + "\r\nHere is the execution log" + (" (its beginning was cut)" if truncated else "") \
+                + ":\r\n\r\n"
+            msg = msg + "\r\n".join(lines) + "\r\n"
+            msg = msg.encode("ascii", "ignore")
+            smtp.sendmail(self.fromaddr, self.toaddrs, msg)
+            smtp.quit()
+        except Exception as e:
+            print(e)
+            self.handleError(None)  # no particular record
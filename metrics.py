@@ -0,0 +1,147 @@
+""" Timing and size measurements for a run, written out at the end as a Prometheus textfile and a JSON summary. """
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+# Where the exports go. Point METRICS_DIR at node_exporter's textfile directory to have Prometheus pick them up.
+METRICS_DIR = os.environ.get('METRICS_DIR', 'metrics')
+PROM_FILE = 'rm_sync.prom'
+JSON_FILE = 'rm_sync.json'
+
+# Prefix of every exported Prometheus metric
+PREFIX = 'rm_sync'
+
+
+class Summary:
+    """ Count, total, and maximum of a series of observations, plus how many of them ended in an error. """
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.errors = 0
+
+    def add(self, value, error=False):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.errors += error
+
+
+class Metrics:
+    """ Collects spans (how long something took) and values (e.g. bytes uploaded) by name, across threads.
+
+    Names are dotted, service first where there is one, e.g. 'render' or 'drive.upload_pdf'. Everything adds up
+    until reset(), which the scripts call after writing out each run. """
+    def __init__(self):
+        self.spans = dict()
+        self.values = dict()
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name):
+        """ Time the body of a with statement, counting it as an error if it raises. Works in async code, too. """
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(self.spans, name, time.perf_counter() - start, error)
+
+    def value(self, name, value):
+        self.observe(self.values, name, value)
+
+    def observe(self, summaries, name, value, error=False):
+        with self.lock:
+            if name not in summaries:
+                summaries[name] = Summary()
+            summaries[name].add(value, error)
+
+    def reset(self):
+        with self.lock:
+            self.spans = dict()
+            self.values = dict()
+            self.started = time.time()
+
+    def summary(self, scheduler=None, success=None):
+        """ Everything measured since the last reset, plus the scheduler's request counters, as a JSON-ready dict. """
+        with self.lock:
+            summary = dict(started=self.started,
+                           seconds=time.time() - self.started,
+                           success=success,
+                           spans={name: vars(span).copy() for name, span in sorted(self.spans.items())},
+                           values={name: vars(value).copy() for name, value in sorted(self.values.items())})
+        summary['requests'] = dict()
+        if scheduler:
+            with scheduler.lock:
+                summary['requests'] = dict(sorted(scheduler.counters.items()))
+        return summary
+
+    @staticmethod
+    def prometheus(summary):
+        """ Render a summary in the Prometheus text format. Every metric describes the last run, so they're gauges. """
+        lines = []
+
+        def family(name, help_text, samples):
+            if not samples:
+                return
+            lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PREFIX}_{name} gauge")
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{label}"' for key, label in labels.items())
+                lines.append(f"{PREFIX}_{name}{{{label_text}}} {value}" if label_text else f"{PREFIX}_{name} {value}")
+
+        family('last_run_timestamp_seconds', "When the last run started.", [({}, summary['started'])])
+        family('last_run_seconds', "How long the last run took.", [({}, round(summary['seconds'], 3))])
+        if summary['success'] is not None:
+            family('last_run_success', "Whether every update in the last run went through.",
+                   [({}, int(summary['success']))])
+
+        spans = summary['spans'].items()
+        family('span_seconds_sum', "Total time spent in each span.",
+               [({'span': name}, round(span['total'], 6)) for name, span in spans])
+        family('span_seconds_max', "Longest single instance of each span.",
+               [({'span': name}, round(span['max'], 6)) for name, span in spans])
+        family('span_count', "Number of times each span ran.",
+               [({'span': name}, span['count']) for name, span in spans])
+        family('span_errors', "Number of times each span raised.",
+               [({'span': name}, span['errors']) for name, span in spans])
+
+        values = summary['values'].items()
+        family('value_sum', "Total of each measured value, e.g. bytes uploaded.",
+               [({'name': name}, value['total']) for name, value in values])
+        family('value_max', "Largest single measurement of each value.",
+               [({'name': name}, value['max']) for name, value in values])
+        family('value_count', "Number of measurements of each value.",
+               [({'name': name}, value['count']) for name, value in values])
+
+        # Scheduler counters look like 'drive.upload.requests'
+        requests = [(key.split('.'), value) for key, value in summary['requests'].items()]
+        for kind, help_text in (('requests', "HTTP requests sent, per service and endpoint class."),
+                                ('throttled', "Requests the service rate limited."),
+                                ('wait_seconds', "Time spent waiting for the rate limiter.")):
+            family(kind, help_text, [({'service': service, 'endpoint': endpoint}, round(value, 3))
+                                     for (service, endpoint, counter), value in requests if counter == kind])
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, scheduler=None, success=None, directory=METRICS_DIR):
+        """ Write everything measured since the last reset to the Prometheus textfile and the JSON summary.
+
+        Both are replaced atomically, so a scrape never sees half a file. """
+        summary = self.summary(scheduler, success)
+        os.makedirs(directory, exist_ok=True)
+        for file_name, text in ((PROM_FILE, self.prometheus(summary)), (JSON_FILE, json.dumps(summary, indent=2))):
+            path = os.path.join(directory, file_name)
+            with open(path + '.tmp', 'w') as file:
+                file.write(text)
+            os.replace(path + '.tmp', path)
+
+
+# Every module records into this one instance
+metrics = Metrics()
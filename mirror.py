@@ -1,30 +1,44 @@
 from rm import RM
 from drive import Drive
-from notional import Notion
+from notional import Notion, APPEND_LIMIT
 
+from cache import PdfCache, PAGE_CACHE_DIR, PAGE_CACHE_BYTES
 from folder import Folder
+from journal import Journal
+from render import Renderer, pipeline
+from services import AsyncService, DRIVE_THREADS, NOTION_THREADS
+from throttle import scheduler
+from metrics import metrics
 
 from log import set_up_logger
 
+from functools import partial
 import os
 import trio
 
 logger = set_up_logger(__name__)
 
-# Initialize and authenticate the APIs
+# The APIs are initialized and authenticated on first use. Drive and Notion calls block, so they run in worker threads.
 rm = RM()
-drive = Drive()
-notion = Notion(os.environ["OFFICIAL_NOTION_TOKEN"],
-                os.environ["UNOFFICIAL_NOTION_TOKEN"],
-                os.environ["NOTION_ROOT"])
+drive = AsyncService(Drive, DRIVE_THREADS, 'drive')
+notion = AsyncService(partial(Notion,
+                              os.environ["OFFICIAL_NOTION_TOKEN"],
+                              os.environ["UNOFFICIAL_NOTION_TOKEN"],
+                              os.environ["NOTION_ROOT"]), NOTION_THREADS, 'notion')
 
+# Completed operations are journaled, so that a rerun after a crash doesn't duplicate them
+journal = Journal()
 
-async def process_file(rm_file, drive_id):
-    """ Convert a raw RM file to a PDF, upload it to Drive, and return the upload URL. """
+# PDF rendering is CPU-bound, so it runs in a pool of worker processes. Keep the results around in case uploads fail.
+renderer = Renderer(cache=PdfCache(), pages=PdfCache(PAGE_CACHE_DIR, PAGE_CACHE_BYTES))
+
+
+async def convert_to_pdf(rm_file):
+    """ Convert a raw RM file to a PDF. """
     logger.info(f"Processing {await rm_file.type()} {rm_file.name}. id_:{rm_file.id}")
-    logger.info("\tConverting to PDF")
+    logger.info(f"\tConverting {rm_file.name} to PDF")
     try:
-        pdf = await rm_file.annotated()
+        return await renderer.annotated(rm_file)
     except TypeError as e:
         logger.error(f"\tCould not convert {rm_file.name} to PDF, "
                      f"likely due to missing size info in the original PDF:\n\t{e}")
@@ -33,44 +47,108 @@ async def process_file(rm_file, drive_id):
         logger.error(f"\tCould not convert {rm_file.name} to PDF for some unknown reason:\n\t{e}")
         return
 
+
+async def upload_pdf(rm_file, drive_id, pdf):
+    """ Upload a converted RM file to Drive and return the uploaded file. """
     try:
-        logger.info("\tUploading to drive")
-        return drive.upload_pdf(drive_id, rm_file.name, pdf)
+        logger.info(f"\tUploading {rm_file.name} to drive")
+        return await drive.upload_pdf(drive_id, rm_file.name, pdf)
     except Exception as e:
         logger.error(f"\tCould not upload {rm_file.name} to drive:\n\t{e}")
         return
+    finally:
+        pdf.close()
 
 
-async def process_files(folder, rm_files):
-    """ Process all the files in a folder. """
-    for rm_file in rm_files:
-        drive_file = await process_file(rm_file, folder.drive.id_)
+def upload_key(rm_file):
+    """ The journal key of a document version's upload. Journal keys are strings, since they go through JSON. """
+    return f"{rm_file.id}:{rm_file.version}"
 
-        # If the upload went smoothly, record it
+
+async def process_files(folder, rm_files):
+    """ Process all the files in a folder, converting and uploading several of them at once. """
+    # Files uploaded before an interruption don't need to be converted or uploaded again
+    # Uploads and their links are journaled by version, so a document that has changed since is uploaded afresh
+    drive_files = {rm_file.id: journal.get('upload', upload_key(rm_file)) for rm_file in rm_files
+                   if journal.get('upload', upload_key(rm_file))}
+
+    async def upload(rm_file, pdf):
+        drive_file = await upload_pdf(rm_file, folder.drive.id_, pdf)
         if drive_file:
+            drive_files[rm_file.id] = dict(id=drive_file['id'], embedLink=drive_file['embedLink'])
+            journal.record('upload', upload_key(rm_file), drive_files[rm_file.id])
+
+    pending_files = [rm_file for rm_file in rm_files if rm_file.id not in drive_files]
+    # Fingerprinted before downloading, so that no fingerprint is newer than what ends up on Drive
+    fingerprints = await rm.fingerprints(pending_files)
+    await pipeline(pending_files, convert_to_pdf, upload, renderer.processes, DRIVE_THREADS)
+    journal.checkpoint()
+
+    # If the upload went smoothly, record it
+    for rm_file in rm_files:
+        if rm_file.id in drive_files:
+            Folder.state().set_fingerprint(rm_file.id, fingerprints.get(rm_file.id))
             folder.rm.add_file(rm_file.id, rm_file.version)
-            folder.drive.add_file(rm_file.id, dict(id=drive_file['id'],
+            folder.drive.add_file(rm_file.id, dict(id=drive_files[rm_file.id]['id'],
                                                    name=rm_file.name,
-                                                   url=drive_file['embedLink']))
+                                                   url=drive_files[rm_file.id]['embedLink']))
 
-    # Add the 'Files' header if there is at least one file
-    if len(folder.drive.files) > 0:
-        notion.append_header(folder.notion.id_, "Files")
 
-    # Then, add the file links to Notion
-    notion.append_files(folder.notion.id_, folder.drive.files)
+async def process_layout(folder, rm_files, rm_sub_folders):
+    """ Add the Files section and the Folders header to a folder's Notion page in as few requests as possible. """
+    uploaded_files = [rm_file for rm_file in rm_files if rm_file.id in folder.drive.files]
 
-    # Finally, record the resulting notion ID of each file link
-    notion_file_ids = notion.get_file_ids(folder.notion.id_)
-    for rm_file, notion_file_id in zip(rm_files, notion_file_ids):
-        folder.notion.add_file(rm_file.id, notion_file_id)
+    # The whole layout as (journal operation, key, block), in page order
+    layout = []
+    if len(uploaded_files) > 0:
+        layout.append(('files_header', folder.id_, Notion.header("Files")))
+    for rm_file in uploaded_files:
+        layout.append(('link', upload_key(rm_file), Notion.file(rm_file.name, folder.drive.files[rm_file.id]['url'])))
+    if len(rm_sub_folders) > 0:
+        layout.append(('folders_header', folder.id_, Notion.header("Folders")))
+
+    # Blocks appended before an interruption are left out
+    pending = [entry for entry in layout if not journal.get(entry[0], entry[1])]
+
+    # Files that only made it onto Drive on a rerun can't be appended once the Folders section has been written, or
+    # they'd end up in it. They're sorted into the Files section instead, creating it if need be.
+    if journal.get('folders_header', folder.id_):
+        late_files = [rm_file for rm_file in uploaded_files if not journal.get('link', upload_key(rm_file))]
+        if late_files:
+            block_ids, _ = await notion.add_links(folder.notion.id_, files=[
+                (rm_file.name, folder.drive.files[rm_file.id]['url']) for rm_file in late_files])
+            for rm_file, block_id in zip(late_files, block_ids):
+                journal.record('link', upload_key(rm_file), block_id)
+            journal.checkpoint()
+        pending = []
+
+    for i in range(0, len(pending), APPEND_LIMIT):
+        chunk = pending[i:i + APPEND_LIMIT]
+        block_ids = await notion.append_blocks(folder.notion.id_, [block for _, _, block in chunk])
+        for (op, key, _), block_id in zip(chunk, block_ids):
+            journal.record(op, key, block_id)
+        journal.checkpoint()
+
+    for rm_file in uploaded_files:
+        folder.notion.add_file(rm_file.id, journal.get('link', upload_key(rm_file)))
 
 
 async def process_sub_folder(folder, rm_sub_folder):
     logger.info(f"Mirroring folder {rm_sub_folder.name}")
 
-    drive_sub_folder = drive.create_folder(folder.drive.id_, rm_sub_folder.name)
-    notion_sub_folder = notion.append_sub_folder(folder.notion.id_, rm_sub_folder.name)
+    # Either half may have been done before an interruption
+    drive_sub_folder = journal.get('drive_folder', rm_sub_folder.id)
+    if not drive_sub_folder:
+        drive_sub_folder = await drive.create_folder(folder.drive.id_, rm_sub_folder.name)
+        drive_sub_folder = dict(id=drive_sub_folder['id'], embedLink=drive_sub_folder['embedLink'])
+        journal.record('drive_folder', rm_sub_folder.id, drive_sub_folder)
+
+    notion_sub_folder = journal.get('notion_folder', rm_sub_folder.id)
+    if not notion_sub_folder:
+        notion_sub_folder = await notion.append_sub_folder(folder.notion.id_, rm_sub_folder.name)
+        notion_sub_folder = dict(id=notion_sub_folder['id'])
+        journal.record('notion_folder', rm_sub_folder.id, notion_sub_folder)
+    journal.checkpoint()
 
     # Record the sub-folder data
     folder.rm.add_sub_folder(rm_sub_folder.id, rm_sub_folder.version)
@@ -91,19 +169,18 @@ async def process_sub_folder(folder, rm_sub_folder):
 
 
 async def process_sub_folders(folder, rm_sub_folders):
-    # Add the 'Folders' header, but only if there's at least one folder
-    if len(rm_sub_folders) > 0:
-        notion.append_header(folder.notion.id_, "Folders")
-
     for rm_sub_folder in rm_sub_folders:
         await process_sub_folder(folder, rm_sub_folder)
 
 
 async def mirror(folder):
     """ Recursively mirror the contents of a Remarkable folder to Drive and Notion. """
-    rm_files, rm_sub_folders = await rm.get_contents(folder.rm.id_)
+    # The first of these fetches the whole listing
+    with metrics.span('rm.listing'):
+        rm_files, rm_sub_folders = await rm.get_contents(folder.rm.id_)
 
     await process_files(folder, rm_files)
+    await process_layout(folder, rm_files, rm_sub_folders)
     await process_sub_folders(folder, rm_sub_folders)
 
     folder.save()
@@ -115,7 +192,20 @@ if __name__ == '__main__':
                          drive=dict(id_=drive.ROOT),
                          notion=dict(id_=notion.ROOT))
 
+    if len(journal) > 0:
+        logger.info(f"Resuming an interrupted mirror; skipping {len(journal)} completed operations")
+
     # Run the mirror recursion
     trio.run(mirror, root_folder)
 
+    # Everything is in the state store now, so there's nothing left to resume
+    with metrics.span('state.commit'):
+        Folder.state().commit()
+    journal.finish()
+
+    # How close we ran to each service's quota
+    for line in scheduler.summary():
+        logger.info(line)
+    metrics.write(scheduler, True)
+
     logger.info("Mirroring complete")
@@ -1,28 +1,170 @@
+from functools import partial
+import threading
+
+import httpx
 from requests.exceptions import HTTPError
 
 from notion_client import Client
 
 from notion.client import NotionClient as UnofficialClient
-from notion.block import BulletedListBlock, PageBlock
+from notion.block import BulletedListBlock, PageBlock, SubheaderBlock
+from notion.markdown import markdown_to_notion
+from notion.operations import build_operation
+from notion.utils import extract_id
+
+from metrics import metrics
+import throttle
+
+# Number of records to ask for in a single getRecordValues request
+FETCH_CHUNK = 100
+
+# The official API appends at most this many blocks per request, and lists at most this many per page
+APPEND_LIMIT = 100
+PAGE_SIZE = 100
+
+
+class RecordCache:
+    """ Raw block records from the unofficial API, shared by every worker thread for the length of a run.
+
+    Each thread's unofficial client keeps its own record store, so without this every thread would fetch the same
+    pages all over again. Records are keyed by dashed block ID. """
+    def __init__(self):
+        self.records = dict()
+        self.lock = threading.Lock()
+
+    def get(self, id_):
+        with self.lock:
+            return self.records.get(id_)
+
+    def put(self, records):
+        with self.lock:
+            self.records.update({id_: value for id_, value in records.items() if value is not None})
+
+    def invalidate(self, ids):
+        with self.lock:
+            for id_ in ids:
+                self.records.pop(id_, None)
+
+
+class ThrottledTransport(httpx.HTTPTransport):
+    """ httpx transport for the official client that paces every request through the shared scheduler.
+
+    httpx 0.17 sends requests through the httpcore transport API, `request(method, url, headers, stream, ext)`, which
+    returns `(status_code, headers, stream, ext)` with the headers as a list of byte pairs. """
+    def __init__(self, scheduler):
+        super().__init__()
+        self.scheduler = scheduler
+
+    def request(self, method, url, headers=None, stream=None, ext=None):
+        return self.scheduler.send('notion', 'official',
+                                   partial(super().request, method, url, headers=headers, stream=stream, ext=ext),
+                                   lambda response: (response[0] == 429, retry_after(response[1])),
+                                   lambda response: response[2].close())
+
+
+def retry_after(headers):
+    """ The Retry-After value in a list of raw header pairs, or None. """
+    for name, value in headers:
+        if name.lower() == b'retry-after':
+            return value.decode('latin-1')
+    return None
 
 
 class Notion:
     """ Mediates interaction with the Notion APIs.
 
-    We use the official Notion API whenever possible, but the unofficial one is *much* more powerful. """
-    def __init__(self, official_token, unofficial_token, root):
-        self.client = Client(auth=official_token)
+    We use the official Notion API whenever possible, but the unofficial one is *much* more powerful.
+    Methods may be called from several worker threads at once (see services.AsyncService). """
+    def __init__(self, official_token, unofficial_token, root, scheduler=None):
+        self.scheduler = scheduler if scheduler else throttle.scheduler
+        self.client = Client(auth=official_token, client=httpx.Client(transport=ThrottledTransport(self.scheduler)))
+        self.unofficial_token = unofficial_token
+        self.local = threading.local()
+        self.cache = RecordCache()
+
+        # Log in right away so that an expired token is reported up front
         try:
-            self.other_client = UnofficialClient(token_v2=unofficial_token)
-        except HTTPError as e:
-            from log import set_up_logger
-            logger = set_up_logger(__name__)
-            # Log it so an email gets sent if this happens
-            logger.error("Got an HTTP error from the unofficial Notion client. Did the token expire?")
-            logger.error(f"Error message: {e}")
+            self.other_client
+        except HTTPError:
+            pass
 
         self.ROOT = root
 
+    @property
+    def other_client(self):
+        """ This thread's unofficial client. Its session and record store aren't thread-safe, so threads don't share
+        one. """
+        if not hasattr(self.local, 'client'):
+            try:
+                self.local.client = UnofficialClient(token_v2=self.unofficial_token)
+                self.local.client.session.request = self.throttled(self.local.client.session.request)
+            except HTTPError as e:
+                from log import set_up_logger
+                logger = set_up_logger(__name__)
+                # Log it so an email gets sent if this happens
+                logger.error("Got an HTTP error from the unofficial Notion client. Did the token expire?")
+                logger.error(f"Error message: {e}")
+                raise
+        return self.local.client
+
+    def throttled(self, request):
+        """ Wrap a requests session's request method so the unofficial client is paced by the shared scheduler. """
+        def send(method, url, *args, **kwargs):
+            endpoint = 'write' if url.endswith('/submitTransaction') else 'read'
+            return self.scheduler.send('notion', endpoint, partial(request, method, url, *args, **kwargs),
+                                       lambda response: (response.status_code == 429,
+                                                         response.headers.get('Retry-After')))
+        return send
+
+    def clear_cache(self):
+        """ Forget every cached record, so that the next sync fetches pages as they are now. """
+        self.cache = RecordCache()
+
+    def preload(self, page_ids):
+        """ Fetch the given pages and all of their children into the record cache, many records per request. """
+        page_ids = [extract_id(id_) for id_ in page_ids]
+        self.fetch(page_ids)
+        self.fetch([child for id_ in page_ids for child in (self.cache.get(id_) or {}).get('content', [])])
+
+    def fetch(self, ids):
+        """ Fetch block records with the given IDs into the record cache, skipping the ones it already has. """
+        ids = [id_ for id_ in dict.fromkeys(ids) if self.cache.get(id_) is None]
+        for i in range(0, len(ids), FETCH_CHUNK):
+            chunk = ids[i:i + FETCH_CHUNK]
+            response = self.other_client.post('getRecordValues',
+                                              {'requests': [{'table': 'block', 'id': id_} for id_ in chunk]})
+            self.cache.put({id_: result.get('value') for id_, result in zip(chunk, response.json()['results'])})
+
+    def block(self, id_):
+        """ Return a block from this thread's unofficial client, fetched from the record cache where possible.
+
+        The block's parent and children are handed to the client along with it, so that reading them later doesn't
+        cost a request each. """
+        id_ = extract_id(id_)
+        if self.cache.get(id_) is None:
+            self.preload([id_])
+
+        value = self.cache.get(id_)
+        if value is None:
+            # Missing or inaccessible; let the client deal with it like it always has
+            return self.other_client.get_block(id_)
+
+        related = value.get('content', []) + [value.get('parent_id')]
+        self.fetch([child for child in value.get('content', [])])
+        records = {related_id: self.cache.get(related_id) for related_id in related if related_id}
+        records[id_] = value
+
+        # Whatever this thread's client had for these records may be stale by now
+        self.other_client._store.store_recordmap({'block': {
+            record_id: {'value': record, 'role': 'editor'} for record_id, record in records.items() if record
+        }})
+        return self.other_client.get_block(id_)
+
+    def remember(self, ids):
+        """ Copy records this thread's client has just written into the record cache, for the other threads. """
+        client = self.other_client
+        self.cache.put({extract_id(id_): client.get_record_data('block', extract_id(id_)) for id_ in ids})
+
     @staticmethod
     def header(text):
         """ JSON representation of a Notion block containing H2-sized text. """
@@ -58,108 +200,171 @@ class Notion:
     def append_header(self, parent_id, text):
         """ Append a header block to a given Notion page. """
         self.client.blocks.children.append(parent_id, children=[self.header(text)])
+        self.cache.invalidate([extract_id(parent_id)])
 
     def append_files(self, parent_id, drive_files):
-        """ Append a list of bulleted links to a given Notion page. """
-        self.client.blocks.children.append(parent_id, children=[
-            self.file(file['name'], file['url']) for file in drive_files.values()
-        ])
+        """ Append a list of bulleted links to a given Notion page. Returns the IDs of the new links, in order. """
+        blocks = [self.file(file['name'], file['url']) for file in drive_files.values()]
+        ids = []
+        for i in range(0, len(blocks), APPEND_LIMIT):
+            ids.extend(self.append_blocks(parent_id, blocks[i:i + APPEND_LIMIT]))
+        return ids
+
+    def append_blocks(self, parent_id, blocks):
+        """ Append up to APPEND_LIMIT blocks to a given Notion page and return the IDs of the new blocks, in order.
+
+        With API version 2021-05-13, which notion-client 0.4.0 uses, the append response is the page rather than the
+        new blocks, so the IDs are read off the end of the page's children afterwards. Pages are only appended to one
+        call at a time, so nothing else can have been appended in between. """
+        if len(blocks) > APPEND_LIMIT:
+            raise ValueError(f"Notion appends at most {APPEND_LIMIT} blocks at a time, got {len(blocks)}")
+
+        self.client.blocks.children.append(parent_id, children=blocks)
+        self.cache.invalidate([extract_id(parent_id)])
+
+        results = self.list_children(parent_id)[-len(blocks):]
+        if [result['type'] for result in results] != [block['type'] for block in blocks]:
+            raise ValueError("The last blocks on the page don't match the blocks that were appended")
+        return [result['id'] for result in results]
+
+    def list_children(self, parent_id):
+        """ Return every child block of a given Notion page, following the cursor through all the result pages. """
+        children = []
+        cursor = None
+        while True:
+            kwargs = dict(start_cursor=cursor) if cursor else dict()
+            response = self.client.blocks.children.list(parent_id, page_size=PAGE_SIZE, **kwargs)
+            children.extend(response['results'])
+            if not response.get('has_more'):
+                return children
+            cursor = response['next_cursor']
 
     def append_sub_folder(self, parent_id, name):
         """ Append a sub-folder as a sub-page of a given Notion page. """
+        self.cache.invalidate([extract_id(parent_id)])
         return self.client.pages.create(**self.sub_folder(parent_id, name))
 
     def add_sub_folder(self, parent_id, name):
         """ Add a sub-folder as a sub-page of a Notion page with a given ID using the unofficial Notion API.
 
         The difference from append_sub_folder is that this function re-sorts the folder list alphabetically. """
-
-        block = self.other_client.get_block(parent_id)
-
-        # First locate and prepare the Folders section
-        if len(block.children) > 0 and block.children[-1].title == '':
-            # Remove the trailing whitespace block Notion adds, if present
-            block.children[-1].remove()
-
-        folder_header_blocks = [i for i, child in enumerate(block.children) if child.title == 'Folders']
-        if len(folder_header_blocks) == 0:
-            # There are no subfolders yet; add Folders header and then the folder
-            self.append_header(parent_id, "Folders")
-            # Need to tell unofficial client about change made by official one
-            block.refresh()
-            return block.children.add_new(PageBlock, title=name)
-
-        folders_header_index = folder_header_blocks[0]
-
-        # Add the link to the end of the page
-        new_sub_folder = block.children.add_new(PageBlock, title=name)
-
-        # Re-arrange the folder list to include the new folder in alphabetical order
-        folders = block.children[folders_header_index + 1:]
-        folders = sorted(folders, key=lambda folder: folder.title.lower())
-
-        # Finally re-assemble the entire list of children and set that as the block's contents
-        new_id_list = [child.id for child in block.children[:folders_header_index + 1]]
-        new_id_list.extend([child.id for child in folders])
-
-        block.set('content', new_id_list)
-
-        return new_sub_folder
+        _, (sub_folder_id,) = self.add_links(parent_id, sub_folders=[name])
+        return self.block(sub_folder_id)
+
+    def move_sub_folder(self, id_, parent_id):
+        """ Move a Notion folder with a given ID under another page, keeping that page's folder list sorted. """
+        self.add_links(parent_id, moved_sub_folders=[id_])
+        return self.block(id_)
+
+    def add_links(self, id_, files=(), sub_folders=(), moved_sub_folders=()):
+        """ Add any number of file links and sub-pages to a Notion page at once using the unofficial Notion API.
+
+        `files` are (name, url) pairs, `sub_folders` are names of new sub-pages, and `moved_sub_folders` are IDs of
+        existing pages to move here. Everything is merged into the alphabetically sorted Files and Folders sections
+        and sent as a single transaction, so the page's content list is only written once.
+        Returns the IDs of the new file blocks and of the new sub-pages, in the order they were given. """
+        client = self.other_client
+        block = self.block(id_)
+        children = list(block.children)
+        touched = [block.id] + [child.id for child in children]
+
+        with client.as_atomic_transaction():
+            if len(children) > 0 and children[-1].title == '':
+                # Remove the trailing whitespace block Notion adds, if present
+                children.pop().remove()
+
+            # Everything above the Folders header is part of the Files section
+            titles = [child.title for child in children]
+            split = titles.index('Folders') if 'Folders' in titles else len(children)
+            files_header = children[titles.index('Files')].id if 'Files' in titles[:split] else None
+            folders_header = children[split].id if split < len(children) else None
+
+            file_entries = [(child.title.lower(), child.id) for child in children[:split] if child.id != files_header]
+            folder_entries = [(child.title.lower(), child.id) for child in children[split + 1:]]
+
+            file_ids = []
+            for name, url in files:
+                title = f"[{name}]({url})"
+                file_ids.append(self.create_block(block, BulletedListBlock, title))
+                file_entries.append((title.lower(), file_ids[-1]))
+
+            sub_folder_ids = []
+            for name in sub_folders:
+                sub_folder_ids.append(self.create_block(block, PageBlock, name))
+                folder_entries.append((name.lower(), sub_folder_ids[-1]))
+
+            # Page.move_to would refresh records in the middle of the transaction, so moves are sent as raw operations.
+            # The page's place in this page's content is set along with everything else below.
+            for page_id in moved_sub_folders:
+                page = self.block(page_id)
+                touched += [page.id, page.get('parent_id')]
+                client.submit_transaction([
+                    build_operation(id=page.get('parent_id'), path=['content'], args={'id': page.id},
+                                    command='listRemove', table=page.get('parent_table')),
+                    build_operation(id=page.id, path=[], args={'parent_id': block.id, 'parent_table': 'block',
+                                                               'alive': True}, command='update')])
+                folder_entries.append((page.title.lower(), page.id))
+
+            if file_entries and files_header is None:
+                files_header = self.create_block(block, SubheaderBlock, 'Files')
+            if folder_entries and folders_header is None:
+                folders_header = self.create_block(block, SubheaderBlock, 'Folders')
+
+            # Re-assemble the entire list of children and set that as the block's contents
+            content = []
+            if files_header:
+                content.append(files_header)
+                content.extend(id_ for _, id_ in sorted(file_entries))
+            if folders_header:
+                content.append(folders_header)
+                content.extend(id_ for _, id_ in sorted(folder_entries))
+
+            block.set('content', content)
+
+        # The whole content list is written every time, so this is what adding links to a page costs
+        metrics.value('notion.rewritten_blocks', len(content))
+        self.remember(touched + content)
+        return file_ids, sub_folder_ids
+
+    def create_block(self, parent, block_type, title):
+        """ Create a block of a given type with a title at the end of a parent block and return its ID.
+
+        Unlike children.add_new, this works inside an atomic transaction because it never reads the block back. """
+        return self.other_client.create_record('block', parent, type=block_type._type,
+                                               properties={'title': markdown_to_notion(title)})
 
     def get_file_ids(self, parent_id):
         """ Return a list of IDs for all files listed on a given Notion page. """
-        children = self.client.blocks.children.list(parent_id)['results']
-        return [block['id'] for block in children
+        return [block['id'] for block in self.list_children(parent_id)
                 if block['type'] == 'bulleted_list_item']
 
     def delete(self, id_):
         """ Delete a block with a given ID using the unofficial Notion API. """
-        self.other_client.get_block(id_).remove()
+        block = self.block(id_)
+        block.remove()
+        self.remember([block.id, block.get('parent_id')])
 
     def rename_file(self, id_, text):
         """ Rename a file link block with a given ID using the unofficial Notion API. """
-        block = self.other_client.get_block(id_.replace('-', ''))
+        block = self.block(id_)
         _, url = tuple(block.title.replace('[', '').replace(')', '').split(']('))
         block.title = f"[{text}]({url})"
+        self.remember([block.id])
 
     def relink_file(self, id_, url):
         """ Change the URL of a file link block with a given ID using the unofficial Notion API. """
-        block = self.other_client.get_block(id_)
+        block = self.block(id_)
         text, _ = tuple(block.title.replace('[', '').replace(')', '').split(']('))
         block.title = f"[{text}]({url})"
+        self.remember([block.id])
 
     def add_file(self, id_, name, url):
         """ Add a bulleted file link in alphabetical order to a Notion page using the unofficial Notion API. """
-        block = self.other_client.get_block(id_)
-
-        if len(block.children) > 0 and block.children[-1].title == '':
-            # Remove the trailing whitespace block Notion adds, if present
-            block.children[-1].remove()
-
-        if len(block.children) == 0:
-            # This is a new page; just add the Files header and the link
-            self.append_header(id_, "Files")
-            return block.children.add_new(BulletedListBlock, title=f"[{name}]({url})")
-
-        # First add the link to the end of the page
-        new_file = block.children.add_new(BulletedListBlock, title=f"[{name}]({url})")
-
-        # Then re-arrange the file list to include the new file in alphabetical order
-        folders_header_index = [i for i, child in enumerate(block.children) if child.title == 'Folders'][0]
-        files = block.children[1:folders_header_index]
-        files.append(block.children[-1])
-        files = sorted(files, key=lambda file: file.title.lower())
-
-        # Finally re-assemble the entire list of children and set that as the block's contents
-        new_id_list = [block.children[0].id]
-        new_id_list.extend([file.id for file in files])
-
-        new_id_list.extend([child.id for child in block.children[folders_header_index:-1]])
-
-        block.set('content', new_id_list)
-
-        return new_file
+        (file_id,), _ = self.add_links(id_, files=[(name, url)])
+        return self.block(file_id)
 
     def rename_sub_folder(self, id_, name):
         """ Rename a Notion folder with a given ID using the unofficial Notion API. """
-        self.other_client.get_block(id_).title = name
+        block = self.block(id_)
+        block.title = name
+        self.remember([block.id])
@@ -0,0 +1,190 @@
+""" Infrastructure for planning a sync as a graph of operations and running independent operations concurrently. """
+from collections import Counter, defaultdict
+from contextlib import AsyncExitStack, asynccontextmanager
+import heapq
+import itertools
+
+import trio
+
+
+class Operation:
+    """ A single step of a sync, e.g. creating a Drive folder or inserting a link into a Notion page. """
+    def __init__(self, name, fn, requires=(), after=(), calls=None, locks=(), limited=True, priority=(),
+                 deferrable=False, item=None):
+        self.name = name
+
+        # An async callable taking no arguments. It should return something truthy if and only if it succeeded.
+        self.fn = fn
+
+        # Operations that have to succeed before this one runs, and operations that merely have to finish first
+        self.requires = list(requires)
+        self.after = list(after)
+
+        # Estimated number of API calls per service, used to summarize a plan without running it
+        self.calls = calls if calls else dict()
+
+        # Operations sharing a lock key never run at the same time (e.g. two rewrites of one Notion page)
+        self.locks = sorted(locks)
+
+        # Operations that mostly wait on batched requests don't count against the parallelism limit,
+        # otherwise the limit would also cap the size of the batches
+        self.limited = limited
+
+        # Among operations waiting for a slot, the lowest priority goes first. Operations without one go before all
+        # the others.
+        self.priority = priority
+
+        # Whether the operation can be left for the next run once the plan is out of time. Only operations that
+        # leave nothing half done that a later operation of the same run has to finish should be.
+        self.deferrable = deferrable
+
+        # RM ID of the item the operation is about, if any
+        self.item = item
+
+        self.done = None
+        self.result = None
+        self.deferred = False
+
+        # The slot the operation queued for when the plan started, if it could go right away (see Plan.execute)
+        self.slot = None
+
+    @property
+    def succeeded(self):
+        return bool(self.result)
+
+
+class Plan:
+    """ A dependency graph of operations that together mirror every update in the tree. """
+    def __init__(self, logger):
+        self.logger = logger
+        self.operations = []
+
+    def add(self, name, fn, requires=(), after=(), calls=None, locks=(), limited=True, priority=(), deferrable=False,
+            item=None):
+        """ Add an operation to the plan and return it so that later operations can depend on it. """
+        operation = Operation(name, fn, requires, after, calls, locks, limited, priority, deferrable, item)
+        self.operations.append(operation)
+        return operation
+
+    @property
+    def succeeded(self):
+        """ Whether every operation has run and succeeded. """
+        return all(operation.succeeded for operation in self.operations)
+
+    @property
+    def deferred(self):
+        """ The operations left for the next run because the plan ran out of time, or because one they required was. """
+        return [operation for operation in self.operations if operation.deferred]
+
+    def call_counts(self):
+        """ Total the estimated API calls of all operations, per service. """
+        counts = Counter()
+        for operation in self.operations:
+            counts.update(operation.calls)
+        return counts
+
+    def describe(self):
+        """ Log every planned operation and the estimated call counts instead of running anything. """
+        index = {id(operation): i for i, operation in enumerate(self.operations)}
+        for i, operation in enumerate(self.operations):
+            line = f"{i:>5} {operation.name}"
+            dependencies = [index[id(dependency)] for dependency in operation.requires + operation.after]
+            if dependencies:
+                line += f" (after {', '.join(map(str, dependencies))})"
+            self.logger.info(line)
+
+        self.logger.info(f"{len(self.operations)} operations planned")
+        for service, count in sorted(self.call_counts().items()):
+            self.logger.info(f"\t~{count} {service} calls")
+
+    async def execute(self, parallelism, deadline=None):
+        """ Run every operation as soon as its dependencies have finished, at most `parallelism` at a time, and those
+        waiting for a slot in order of priority.
+
+        Past `deadline`, in trio time, deferrable operations that haven't started yet are skipped and marked deferred.
+        Operations already under way are finished, as is everything that isn't deferrable. """
+        limiter = PriorityLimiter(parallelism)
+        locks = defaultdict(trio.Lock)
+
+        # Events have to be created inside the trio run
+        for operation in self.operations:
+            operation.done = trio.Event()
+
+        # Tasks start in no particular order, so the operations that can go right away queue for a slot up front
+        by_priority = sorted(self.operations, key=lambda operation: operation.priority)
+        for operation in by_priority:
+            if operation.limited and not operation.requires + operation.after:
+                operation.slot = limiter.request(operation.priority)
+
+        async with trio.open_nursery() as nursery:
+            for operation in by_priority:
+                nursery.start_soon(self.run, operation, limiter, locks, deadline)
+
+    async def run(self, operation, limiter, locks, deadline=None):
+        """ Wait for an operation's dependencies, then run it unless one of its prerequisites failed or it's out of
+        time. """
+        try:
+            for dependency in operation.requires + operation.after:
+                await dependency.done.wait()
+
+            if not all(dependency.succeeded for dependency in operation.requires):
+                operation.deferred = any(dependency.deferred for dependency in operation.requires)
+                self.logger.debug(f"Skipping {operation.name} because a prerequisite failed or was deferred")
+                return
+
+            async with AsyncExitStack() as stack:
+                # Locks are always taken in sorted order, so two operations can't each hold one the other needs
+                for key in operation.locks:
+                    await stack.enter_async_context(locks[key])
+                if operation.limited:
+                    await stack.enter_async_context(limiter.slot(operation))
+
+                if operation.deferrable and deadline is not None and trio.current_time() >= deadline:
+                    operation.deferred = True
+                    self.logger.debug(f"Out of time, leaving {operation.name} for the next run")
+                    return
+
+                operation.result = await operation.fn()
+
+        except Exception as e:
+            # Don't let one failure cancel every other operation in the nursery
+            self.logger.error(f"Operation failed: {operation.name}.")
+            self.logger.error(f"Error message: {e}")
+        finally:
+            operation.done.set()
+
+
+class PriorityLimiter:
+    """ Like trio.CapacityLimiter, except that when operations are waiting for a slot, the one that comes first by
+    priority gets the next one, rather than the one that has been waiting longest. """
+    def __init__(self, total):
+        self.available = total
+        self.waiting = []
+        # Breaks ties between equal priorities in order of arrival
+        self.arrivals = itertools.count()
+
+    def request(self, priority):
+        """ Queue for a slot, returning an event that's set once the slot is granted. Release it with release(). """
+        granted = trio.Event()
+        heapq.heappush(self.waiting, (priority, next(self.arrivals), granted))
+        self.grant()
+        return granted
+
+    def release(self):
+        self.available += 1
+        self.grant()
+
+    def grant(self):
+        while self.available > 0 and self.waiting:
+            self.available -= 1
+            heapq.heappop(self.waiting)[-1].set()
+
+    @asynccontextmanager
+    async def slot(self, operation):
+        """ Hold a slot for an operation, using the request it made up front if it made one. """
+        granted = operation.slot if operation.slot else self.request(operation.priority)
+        await granted.wait()
+        try:
+            yield
+        finally:
+            self.release()
@@ -0,0 +1,88 @@
+""" Account profiles, for syncing several Remarkable accounts from one process.
+
+Profiles are read from a JSON file mapping each profile's name to its settings, e.g.
+
+    {"alice": {"directory": "profiles/alice", "official_notion_token": "...", "unofficial_notion_token": "...",
+               "notion_root": "..."}}
+
+The rest of a profile lives in its directory: `rmcl.json` holds its Remarkable tokens (a copy of rmcl's config.json
+once the device has been registered), `settings.yaml` is its PyDrive2 settings file, which should save the Drive
+credentials into the directory as well, and the state store goes there too. Run mirror.py from the directory, with
+the profile's tokens in the environment, for the initial mirror.
+
+Profiles share the render workers and the rate limiter. They take turns rather than sync at the same time, since rmcl
+can only talk to one account at once (see RM.activate). """
+import json
+import os
+
+from drive import Drive
+from metrics import METRICS_DIR
+from notional import Notion
+from rm import RM
+from services import AsyncService, DriveBatcher, DRIVE_THREADS, NOTION_THREADS
+from state import StateStore, UploadSessions, STATE_DB
+
+PROFILES_FILE = os.environ.get('PROFILES_FILE', 'profiles.json')
+
+# The profile made up of the environment and the working directory, which is synced when no profiles are given
+DEFAULT_PROFILE = 'default'
+
+RM_CONFIG = 'rmcl.json'
+DRIVE_SETTINGS = 'settings.yaml'
+
+
+class Profile:
+    """ One account's RM, Drive, and Notion clients and state store. The clients are only logged into once used. """
+    def __init__(self, name, directory='.', official_notion_token=None, unofficial_notion_token=None,
+                 notion_root=None):
+        self.name = name
+        self.directory = directory
+        self.official_notion_token = official_notion_token
+        self.unofficial_notion_token = unofficial_notion_token
+        self.notion_root = notion_root
+
+        default = name == DEFAULT_PROFILE
+        self.rm = RM(None if default else os.path.join(directory, RM_CONFIG))
+        self.drive = AsyncService(self.drive_client, DRIVE_THREADS, 'drive')
+        self.notion = AsyncService(self.notion_client, NOTION_THREADS, 'notion')
+
+        # Renames, deletions, and moves on Drive only touch metadata, so they're sent together in batches
+        self.batcher = DriveBatcher(self.drive)
+
+        # Each profile's metrics go to a directory of their own, next to the default profile's
+        self.metrics_dir = METRICS_DIR if default else os.path.join(METRICS_DIR, name)
+
+        self._store = None
+
+    @property
+    def store(self):
+        """ The profile's state store, opened on first use. """
+        if self._store is None:
+            self._store = StateStore(os.path.join(self.directory, STATE_DB))
+        return self._store
+
+    def drive_client(self):
+        """ Log into Drive with the profile's PyDrive2 settings, or the ones in the working directory by default. """
+        return Drive(sessions=UploadSessions(os.path.join(self.directory, STATE_DB)),
+                     settings_file=None if self.name == DEFAULT_PROFILE
+                     else os.path.join(self.directory, DRIVE_SETTINGS))
+
+    def notion_client(self):
+        """ Log into Notion with the profile's tokens, falling back on the ones in the environment. """
+        return Notion(self.official_notion_token if self.official_notion_token else os.environ['OFFICIAL_NOTION_TOKEN'],
+                      self.unofficial_notion_token if self.unofficial_notion_token
+                      else os.environ['UNOFFICIAL_NOTION_TOKEN'],
+                      self.notion_root if self.notion_root else os.environ['NOTION_ROOT'])
+
+
+def load_profiles(names=None, path=PROFILES_FILE):
+    """ Return the profiles with the given names from the profiles file, in that order, or all of them if None.
+
+    Raises KeyError for a name that isn't in the file. """
+    with open(path, 'r') as file:
+        settings = json.load(file)
+
+    for name in names if names else []:
+        if name not in settings:
+            raise KeyError(f"No profile named {name} in {path}")
+    return [Profile(name, **settings[name]) for name in (names if names else settings)]
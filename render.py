@@ -0,0 +1,257 @@
+""" Render Remarkable documents to PDF in a pool of worker processes. """
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import zipfile
+
+import trio
+
+from metrics import metrics
+
+# Part of every page's cache key. Bump it whenever a change would make pages render differently.
+PAGE_FORMAT = 2
+
+# Fields of a document's .content file that change how its pages look, which are part of every page's cache key too.
+# The rest, like the page list or the last opened page, change all the time without touching the pages themselves.
+RENDER_FIELDS = ('orientation', 'transform', 'zoomMode', 'customZoomScale', 'customZoomCenterX', 'customZoomCenterY',
+                 'customZoomPageWidth', 'customZoomPageHeight', 'margins', 'textScale', 'lineHeight', 'fontName',
+                 'textAlignment')
+
+
+def render_raw(raw_path, pdf_path, pages=None):
+    """ Render the raw zip of a Remarkable document to a PDF file. Runs inside a worker process.
+
+    If `pages` is a PdfCache, the document is put together from individually rendered pages, and only pages that
+    aren't in that cache yet are rendered. """
+    from rmrl import render
+    from rmrl.sources import ZipSource
+
+    with zipfile.ZipFile(raw_path, 'r') as raw:
+        source = ZipSource(raw)
+        if pages is None or not render_by_page(source, pdf_path, pages):
+            stream = render(source)
+            with open(pdf_path, 'wb') as file:
+                shutil.copyfileobj(stream, file)
+
+    with open(pdf_path, 'rb+') as file:
+        os.fsync(file.fileno())
+
+
+def render_by_page(source, pdf_path, pages):
+    """ Write a document to a PDF file page by page, rendering only the pages that have changed since they were last
+    rendered. Returns False, without writing anything, for documents that can't be split into pages.
+
+    A notebook is put together from its rendered pages. A document with a base PDF keeps that PDF whole, outline and
+    links included, and only each page's overlay of strokes is rendered and cached, then merged onto its page the way
+    rmrl merges it. """
+    from pdfrw import PdfReader, PdfWriter
+
+    if not source.exists('{ID}.content'):
+        return False
+    with source.open('{ID}.content', 'r') as file:
+        content = json.load(file)
+    page_ids = content.get('pages', [])
+    if len(page_ids) == 0:
+        return False
+
+    base = None
+    if source.exists('{ID}.pdf'):
+        with source.open('{ID}.pdf', 'rb') as file:
+            base_data = file.read()
+        base = PdfReader(fdata=base_data)
+        if len(base.pages) != len(page_ids):
+            return False
+
+    templates = []
+    if source.exists('{ID}.pagedata'):
+        with source.open('{ID}.pagedata', 'r') as file:
+            templates = file.read().splitlines()
+
+    page_sources = [PageSource(source, content, page_id, index, templates)
+                    for index, page_id in enumerate(page_ids)]
+
+    if base is None:
+        writer = PdfWriter(pdf_path)
+        for page in page_sources:
+            with rendered_page(page, pages) as page_pdf:
+                writer.addpages(PdfReader(page_pdf).pages)
+        writer.write()
+    elif not any(page.has_strokes() for page in page_sources):
+        # Like rmrl, hand back the base PDF untouched if nothing was drawn on it
+        with open(pdf_path, 'wb') as file:
+            file.write(base_data)
+    else:
+        from rmrl.constants import PDFHEIGHT, PDFWIDTH
+        from rmrl.render import merge_pages
+        from pdfrw import PdfArray, PdfDict
+
+        for base_page, page in zip(base.pages, page_sources):
+            if page.has_strokes():
+                with rendered_page(page, pages) as page_pdf:
+                    overlay = PdfReader(page_pdf).pages[0]
+            else:
+                # Pages without strokes are still resized to the reMarkable's screen, for which only the size counts
+                overlay = PdfDict(MediaBox=PdfArray([0, 0, PDFWIDTH, PDFHEIGHT]))
+            merge_pages(base_page, overlay, page.has_strokes(), True)
+        PdfWriter(pdf_path).write(trailer=base)
+
+    pages.evict()
+    return True
+
+
+def rendered_page(page, pages):
+    """ Return a page rendered as a PDF of its own, as an open file, from the page cache or rendered now. """
+    from rmrl import render
+
+    key = page.digest()
+    page_pdf = pages.get(key, 'page')
+    if page_pdf is None:
+        temp_path = pages.spool(render(page))
+        page_pdf = pages.put(key, 'page', temp_path, tidy=False)
+    return page_pdf
+
+
+class PageSource:
+    """ An rmrl source that shows a single page of a document, as if it were a whole notebook of its own.
+
+    Wraps the source of the whole document and translates file names where needed. A base PDF is left out, so a page
+    of a PDF or ebook renders as just its overlay of strokes. """
+    def __init__(self, source, content, page_id, index, templates):
+        self.source = source
+        self.index = index
+
+        # rmrl looks for stroke data by page ID first, then by page number, which is now always 0
+        self.rm_path = f'{{ID}}/{page_id}.rm'
+        self.metadata_path = f'{{ID}}/{page_id}-metadata.json'
+        if not source.exists(self.rm_path):
+            self.rm_path = f'{{ID}}/{index}.rm'
+            self.metadata_path = f'{{ID}}/{index}-metadata.json'
+
+        self.content = json.dumps(dict(content, pages=[page_id]))
+        self.settings = json.dumps({field: content[field] for field in RENDER_FIELDS if field in content},
+                                   sort_keys=True)
+
+        # rmrl gives every page the last template in .pagedata (see rmrl.document.DocumentPage), and documents that
+        # can't be split into pages are still rendered whole by rmrl, so pages get the same one whichever way they're
+        # rendered
+        self.template = templates[-1] if templates else None
+
+    def has_strokes(self):
+        return self.source.exists(self.rm_path)
+
+    def translate(self, fn):
+        if fn == '{ID}/0.rm':
+            return self.rm_path
+        if fn == '{ID}/0-metadata.json':
+            return self.metadata_path
+        return fn
+
+    def exists(self, fn):
+        if fn == '{ID}.pdf':
+            return False
+        if fn == '{ID}.pagedata':
+            return self.template is not None
+        return self.source.exists(self.translate(fn))
+
+    def open(self, fn, mode='r'):
+        if fn == '{ID}.content':
+            return io.StringIO(self.content)
+        if fn == '{ID}.pagedata':
+            return io.StringIO(self.template)
+        return self.source.open(self.translate(fn), mode)
+
+    def digest(self):
+        """ Hash everything that goes into rendering this page: its strokes, layer names, template, and the document's
+        display settings. """
+        sha = hashlib.sha256(f"{PAGE_FORMAT}:{self.index}:{self.template}:{self.settings}".encode())
+        for path in (self.rm_path, self.metadata_path):
+            sha.update(b'\0' + path.encode() + b'\0')
+            if self.source.exists(path):
+                with self.source.open(path, 'rb') as file:
+                    sha.update(file.read())
+        return sha.hexdigest()
+
+
+class Renderer:
+    """ Renders documents with their annotations in worker processes, one per core by default.
+
+    rmrl rendering is CPU-bound, so running it in the main process keeps a whole sync on a single core.
+    Rendered PDFs are written straight into a PdfCache, so a document version that has already been rendered is
+    served from there instead, and large PDFs never have to sit in the main process's memory.
+    If there's also a PdfCache for `pages`, documents are rendered page by page, so that a new version of a document
+    only costs rendering the pages that changed. """
+    def __init__(self, cache, pages=None, processes=None):
+        self.processes = processes if processes else os.cpu_count()
+        self.limiter = trio.CapacityLimiter(self.processes)
+        self.pool = None
+        self.cache = cache
+        self.pages = pages
+
+    def executor(self):
+        # Start the workers on first use, and fork them so they don't re-run the calling script's setup code
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('fork'))
+        return self.pool
+
+    async def annotated(self, rm_file):
+        """ Like rmcl's Document.annotated(), but renders in a worker process and returns an open PDF file. """
+        pdf = await trio.to_thread.run_sync(self.cache.get, rm_file.id, rm_file.version)
+        if pdf:
+            metrics.value('render.cache_hits', 1)
+            return pdf
+
+        with metrics.span('rm.download'):
+            raw_path = await trio.to_thread.run_sync(self.cache.spool, await rm_file.raw())
+        pdf_path = self.cache.temp_path()
+        try:
+            # Only render as many documents at once as there are workers
+            async with self.limiter:
+                with metrics.span('render'):
+                    future = self.executor().submit(render_raw, raw_path, pdf_path, self.pages)
+                    await trio.to_thread.run_sync(future.result)
+        except BaseException:
+            os.remove(pdf_path)
+            raise
+        finally:
+            os.remove(raw_path)
+
+        return await trio.to_thread.run_sync(self.cache.put, rm_file.id, rm_file.version, pdf_path)
+
+
+async def pipeline(items, render, upload, renderers, uploaders):
+    """ Render items and upload the results, with each stage working on several items at a time.
+
+    Items wait in bounded queues between the stages, so only a few rendered PDFs are waiting at once.
+    `render` returns a PDF, or None if the item should be skipped. """
+    send_item, receive_item = trio.open_memory_channel(renderers)
+    send_pdf, receive_pdf = trio.open_memory_channel(uploaders)
+
+    async def feed():
+        async with send_item:
+            for item in items:
+                await send_item.send(item)
+
+    async def render_stage(receive_item, send_pdf):
+        async with receive_item, send_pdf:
+            async for item in receive_item:
+                pdf = await render(item)
+                if pdf:
+                    await send_pdf.send((item, pdf))
+
+    async def upload_stage(receive_pdf):
+        async with receive_pdf:
+            async for item, pdf in receive_pdf:
+                await upload(item, pdf)
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(feed)
+        async with receive_item, send_pdf:
+            for _ in range(renderers):
+                nursery.start_soon(render_stage, receive_item.clone(), send_pdf.clone())
+        async with receive_pdf:
+            for _ in range(uploaders):
+                nursery.start_soon(upload_stage, receive_pdf.clone())
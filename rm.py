@@ -1,13 +1,58 @@
+from collections import defaultdict
+import hashlib
+import json
+import struct
+
 import rmcl
 from rmcl import Item, Document
+import trio
+
+from state import SnapshotItem
+
+# Bytes to read from the end of a document's zip, which holds the central directory of all but the largest documents
+FINGERPRINT_BYTES = 64 * 1024
+
+# Maximum number of documents to fingerprint or look up the size of at once
+FINGERPRINT_REQUESTS = 8
+
+
+class AccountConfig(dict):
+    """ rmcl's tokens for one account, kept in a file of its own instead of rmcl's config file. rmcl writes them back
+    whenever it renews them, through the same methods as rmcl.config.Config. """
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        with open(path, 'r') as file:
+            super().update(json.load(file))
+
+    def save(self):
+        with open(self.path, 'w') as file:
+            json.dump(self, file, indent=2)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.save()
+
+    def update(self, other):
+        super().update(other)
+        self.save()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.save()
 
 
 class RM:
     """ Mediates interaction with the Remarkable API. """
     ROOT = ''
 
-    # RM has a one-time device authentication which we already did on this machine
-    client = rmcl.api.get_client_s()
+    def __init__(self, config=None):
+        # The account's rmcl tokens (see AccountConfig), or None for the account in rmcl's own config file.
+        # RM has a one-time device authentication, which has to have been done for the account already.
+        self.config = config
+
+        # rmcl's client for the account, set up by the first activate()
+        self.client = None
 
     @staticmethod
     async def get_contents(id_):
@@ -23,62 +68,277 @@ class RM:
 
         return files, folders
 
-    async def get_updates(self, id_, old_files, old_sub_folders):
-        """ Figure out what's changed since the last sync. """
+    async def activate(self):
+        """ Make this account's client the one rmcl uses.
 
-        # This updates the by_id dict for *all* RM items, so only needs to be called once at the root
-        if id_ == self.ROOT:
-            await self.client.update_items()
+        rmcl keeps a single client per process, which every Item looks up for itself, so only one account can be
+        worked on at a time. """
+        if self.client is None and self.config is None:
+            self.client = await rmcl.api.get_client()
+        elif self.client is None:
+            self.client = rmcl.api.Client()
+            self.client.config = AccountConfig(self.config)
+        rmcl.api._client = self.client
 
-        new_files, new_sub_folders = await self.get_contents(id_)
+    async def refresh(self):
+        """ Fetch the current state of *all* RM items into the by_id dict. Only needs to happen once per run. """
+        await self.activate()
+        await self.client.update_items()
 
-        file_updates = Updates(new_files, old_files, self.client.by_id)
-        folder_updates = Updates(new_sub_folders, old_sub_folders, self.client.by_id)
+    def snapshot(self):
+        """ Every RM item as of the last refresh(), as a dict of SnapshotItems by ID. Cheap to compare and to store. """
+        return {id_: SnapshotItem(id_, item.parent, item.name, TreeDiff.kind(item), item.version)
+                for id_, item in self.client.by_id.items()}
 
-        return file_updates, folder_updates
+    async def get_diff(self, known_items):
+        """ Figure out what's changed across the whole account since the last sync. Call refresh() first.
 
+        Documents with a new version are fingerprinted first, so the diff can tell content changes from the rest. """
+        changed = [item for id_, item in self.client.by_id.items()
+                   if isinstance(item, Document) and id_ in known_items and known_items[id_].version != item.version]
+        return TreeDiff(self.client.by_id, known_items, self.ROOT, await self.fingerprints(changed))
 
-class Updates:
-    """ Determine which items have changed and how in a given RM directory since the last run. """
-    def __init__(self, new_items, old_items=None, by_id=None):
-        self.by_id = by_id
-        self.old_items = old_items
-        self.new_items = new_items
-
-        if by_id:  # This is a true update record
-            self.created = [item for item in new_items if self.created_q(item)]
-            self.modified = [by_id[item] for item, version in old_items.items() if self.modified_q(item, version)]
-            self.deleted = [by_id[item] for item in old_items.keys() if self.deleted_q(item)]
-        else:  # This is a wrapper around a bunch of new items
-            self.created = new_items
-            self.modified = []
-            self.deleted = []
+    async def fingerprints(self, documents):
+        """ Fingerprint several documents at once. Returns a dict of fingerprints by document ID, leaving out
+        failures. """
+        # Without a fingerprint, a document just counts as changed
+        return await self.fetch_all(documents, self.fingerprint)
 
-        # Use this to decide whether to write the Folder data back to disk
-        if len(self.created) > 0 or len(self.modified) > 0 or len(self.deleted) > 0:
-            self.change = True
-        else:
-            self.change = False
+    async def sizes(self, documents):
+        """ Look up the size of several documents at once, in bytes. Returns a dict of sizes by document ID, leaving out
+        failures. rmcl caches each version's size, so this only sends requests for versions it hasn't seen. """
+        return await self.fetch_all(documents, lambda document: document.raw_size())
 
-    def created_q(self, new_item):
-        """ Returns True if the item is new and False otherwise. """
-        return False if new_item.id in self.old_items else True
+    @staticmethod
+    async def fetch_all(documents, fetch):
+        """ Call an async function on several documents at once, at most FINGERPRINT_REQUESTS at a time. Returns the
+        truthy results in a dict by document ID, leaving out failures. """
+        results = dict()
+        limiter = trio.CapacityLimiter(FINGERPRINT_REQUESTS)
+
+        async def fetch_one(document):
+            async with limiter:
+                try:
+                    result = await fetch(document)
+                except Exception:
+                    return
+            if result:
+                results[document.id] = result
+
+        async with trio.open_nursery() as nursery:
+            for document in documents:
+                nursery.start_soon(fetch_one, document)
+        return results
+
+    @staticmethod
+    async def fingerprint(document):
+        """ Hash the names, sizes, and checksums of the files inside a document, without downloading the document.
+
+        These are all listed in the zip's central directory at the very end of the blob, so one or two small ranged
+        requests are enough. Renaming or moving a document doesn't touch its blob, so the fingerprint only changes
+        when the content does. Returns None if the document can't be downloaded. """
+        url = await document.download_url()
+        if not url:
+            return
+        client = await rmcl.api.get_client()
 
-    def modified_q(self, old_item, old_version):
-        """ Returns True if the item has been modified and False otherwise. """
-        if old_item not in self.by_id or self.by_id[old_item].parent == 'trash':
-            return False  # In this case it counts as deleted
-        elif self.by_id[old_item].version == old_version:
-            return False
+        tail = (await client.request('GET', url, headers={'Range': f'bytes=-{FINGERPRINT_BYTES}'})).content
+        end = tail.rfind(b'PK\x05\x06')
+        if end < 0:
+            return
+
+        # The end of central directory record holds the size and offset of the directory, which comes right before it
+        size, offset = struct.unpack('<II', tail[end + 12:end + 20])
+        if end >= size:
+            directory = tail[end - size:end]
         else:
-            return True
+            directory = (await client.request('GET', url,
+                                              headers={'Range': f'bytes={offset}-{offset + size - 1}'})).content
+
+        return RM.directory_digest(directory)
+
+    @staticmethod
+    def directory_digest(directory):
+        """ Hash the name, CRC-32, and size of every entry in a zip central directory. """
+        entries = []
+        position = 0
+        while directory.startswith(b'PK\x01\x02', position):
+            crc, _, size, name_length, extra_length, comment_length = \
+                struct.unpack('<IIIHHH', directory[position + 16:position + 34])
+            name = directory[position + 46:position + 46 + name_length]
+            entries.append(b'%s:%d:%d' % (name, crc, size))
+            position += 46 + name_length + extra_length + comment_length
+        return hashlib.sha256(b'\n'.join(sorted(entries))).hexdigest()
+
+
+class RemovedItem:
+    """ Stand-in for an item that has been deleted from the Remarkable for good, so rmcl no longer knows about it. """
+    def __init__(self, id_, name):
+        self.id = id_
+        self.name = name
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} "{self.name}">'
+
+
+class TreeDiff:
+    """ Determine which items have changed and how across all RM directories since the last run.
 
-    def deleted_q(self, old_item):
-        """ Returns True if the item has been deleted and False otherwise. """
-        # Normally the ID should show up as a child of the trash folder, but check just in case
-        if old_item not in self.by_id:
+    Everything is worked out in a single pass over rmcl's by_id dict and the stored state, after which the updates
+    for any one directory are a dict lookup away. A stored snapshot (see RM.snapshot) can stand in for by_id. """
+    def __init__(self, by_id, known_items, root='', fingerprints=None):
+        """ `known_items` maps the ID of every synced item to its KnownItem row from the state store.
+        `fingerprints` holds the current fingerprint of documents with a new version, where it could be fetched. """
+        self.by_id = by_id
+        self.known_items = known_items
+        self.root = root
+        self.fingerprints = fingerprints if fingerprints else dict()
+
+        # Keyed by (parent ID, 'file' or 'folder')
+        self.children = defaultdict(list)
+        self.created = defaultdict(list)
+        self.modified = defaultdict(list)
+        self.deleted = defaultdict(list)
+        self.moved_in = defaultdict(list)
+
+        # Items with a new version but the same content, e.g. renamed ones
+        self.renamed = defaultdict(list)
+
+        # Items that changed directories, mapped to their (old parent, new parent)
+        self.moved = dict()
+
+        # Items recorded under a directory that no longer exists, which can simply be forgotten
+        self.orphaned = []
+
+        # Directories whose own contents changed
+        touched = set()
+
+        for id_, item in by_id.items():
+            if id_ in (root, 'trash') or item.parent == 'trash':
+                continue
+
+            key = (item.parent, self.kind(item))
+            self.children[key].append(item)
+
+            known = known_items.get(id_)
+            if known is None:
+                self.created[key].append(item)
+                touched.add(item.parent)
+            elif known.parent != item.parent:
+                # Moves are handled by the new directory
+                self.moved[id_] = (known.parent, item.parent)
+                self.moved_in[key].append(item)
+                touched.update((item.parent, known.parent))
+            elif known.version != item.version:
+                if self.same_content(id_):
+                    self.renamed[key].append(item)
+                else:
+                    self.modified[key].append(item)
+                touched.add(item.parent)
+
+        for id_, known in known_items.items():
+            item = by_id.get(id_)
+            if item is not None and item.parent != 'trash':
+                continue
+
+            if not self.alive(known.parent):
+                self.orphaned.append(id_)
+            else:
+                self.deleted[(known.parent, known.kind)].append(item if item else RemovedItem(id_, known.name))
+                touched.add(known.parent)
+
+        self.changed = self.with_ancestors(touched)
+
+    def same_content(self, id_):
+        """ Returns True if a known item's content is the same as when it was last synced, as far as we can tell.
+
+        Folders have no content. Documents are compared by fingerprint; without one, they're assumed to have changed
+        if their version has. """
+        known = self.known_items[id_]
+        if known.kind == 'folder':
             return True
-        elif self.by_id[old_item].parent == 'trash':
+        if known.version == self.by_id[id_].version:
             return True
+        return known.fingerprint is not None and self.fingerprints.get(id_) == known.fingerprint
+
+    def to_render(self):
+        """ Return the documents that have to be rendered: new ones, and known ones with new content. """
+        new = [item for (_, kind), items in list(self.created.items()) + list(self.modified.items())
+               if kind == 'file' for item in items]
+        moved = [self.by_id[id_] for id_ in self.moved
+                 if self.known_items[id_].kind == 'file' and not self.same_content(id_)]
+        return new + moved
+
+    @staticmethod
+    def kind(item):
+        if isinstance(item, SnapshotItem):
+            return item.kind
+        return 'file' if isinstance(item, Document) else 'folder'
+
+    def alive(self, id_):
+        """ Returns True if the directory with a given ID still exists outside the trash and False otherwise. """
+        return id_ == self.root or (id_ in self.by_id and self.by_id[id_].parent != 'trash')
+
+    def moved_out(self, id_):
+        """ Return the IDs of the items that moved out of a deleted directory, or out of the deleted directories that
+        were beneath it. """
+        result = []
+        for moved_id, (old_parent, _) in self.moved.items():
+            # Walk up from the old parent through directories that are gone, which all went with their parent
+            while old_parent != id_ and old_parent in self.known_items and not self.alive(old_parent):
+                old_parent = self.known_items[old_parent].parent
+            if old_parent == id_:
+                result.append(moved_id)
+        return result
+
+    def with_ancestors(self, ids):
+        """ Return the given directory IDs along with the IDs of all the directories above them. """
+        result = set()
+        for id_ in ids:
+            # Walk up to the root, stopping early at directories that are already in the result
+            while id_ is not None and id_ != 'trash' and id_ not in result:
+                result.add(id_)
+                if id_ == self.root:
+                    id_ = None
+                elif id_ in self.by_id:
+                    id_ = self.by_id[id_].parent
+                elif id_ in self.known_items:
+                    id_ = self.known_items[id_].parent
+                else:
+                    id_ = None
+        return result
+
+    def contents(self, id_):
+        """ Return sorted lists of files and sub-folders in the specified Remarkable directory. """
+        files = sorted(self.children[(id_, 'file')], key=lambda document: document.name)
+        folders = sorted(self.children[(id_, 'folder')], key=lambda document: document.name)
+        return files, folders
+
+    def updates(self, id_):
+        """ Return the file and sub-folder Updates for the specified Remarkable directory. """
+        return tuple(Updates(sorted(self.created[(id_, kind)], key=lambda item: item.name),
+                             self.modified[(id_, kind)],
+                             self.deleted[(id_, kind)],
+                             self.moved_in[(id_, kind)],
+                             self.renamed[(id_, kind)])
+                     for kind in ('file', 'folder'))
+
+
+class Updates:
+    """ The items in an RM directory that were created, modified, deleted, moved in, or renamed since the last run.
+
+    Modified items have new content; renamed items have a new version with the same content, which usually means just
+    a new name. Moved items may or may not have new content as well (see TreeDiff.same_content). """
+    def __init__(self, created=(), modified=(), deleted=(), moved=(), renamed=()):
+        self.created = list(created)
+        self.modified = list(modified)
+        self.deleted = list(deleted)
+        self.moved = list(moved)
+        self.renamed = list(renamed)
+
+        # Use this to decide whether to write the Folder data back to disk
+        if len(self.created) > 0 or len(self.modified) > 0 or len(self.deleted) > 0 or len(self.moved) > 0 \
+                or len(self.renamed) > 0:
+            self.change = True
         else:
-            return False
+            self.change = False
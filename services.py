@@ -0,0 +1,129 @@
+""" Async access to the blocking Drive and Notion clients. """
+from functools import partial
+import threading
+
+import trio
+
+from metrics import metrics
+
+# Maximum number of worker threads talking to each service at once
+DRIVE_THREADS = 4
+NOTION_THREADS = 4
+
+# How long the first queued Drive change waits for others to join its batch, in seconds
+BATCH_WINDOW = 0.2
+
+
+class AsyncService:
+    """ Wraps a blocking service object so that its methods run in worker threads instead of stalling trio.
+
+    Every call is awaited, e.g. `await drive.upload_pdf(...)`. Plain attributes like ROOT are passed through as-is.
+    Calls are timed as spans named after the service and method, e.g. 'drive.upload_pdf', not counting the time spent
+    waiting for a thread.
+    Each service gets its own CapacityLimiter, so slow Drive uploads can't hold up Notion calls or vice versa.
+
+    The service object is only created by calling `factory` on first use, so a run that has nothing to sync never
+    logs in. Call connect() first from async code, so that logging in doesn't stall trio. """
+    def __init__(self, factory, threads, name):
+        self.factory = factory
+        self.name = name
+        self.instance = None
+        self.lock = threading.Lock()
+        self.limiter = trio.CapacityLimiter(threads)
+
+    @property
+    def service(self):
+        with self.lock:
+            if self.instance is None:
+                self.instance = self.factory()
+        return self.instance
+
+    async def connect(self):
+        """ Create the service object in a worker thread, if it hasn't been created yet. """
+        with metrics.span(f"{self.name}.connect"):
+            await trio.to_thread.run_sync(lambda: self.service, limiter=self.limiter)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.service, name)
+        if not callable(attribute):
+            return attribute
+
+        def timed(*args, **kwargs):
+            with metrics.span(f"{self.name}.{name}"):
+                return attribute(*args, **kwargs)
+
+        async def call(*args, **kwargs):
+            return await trio.to_thread.run_sync(partial(timed, *args, **kwargs), limiter=self.limiter)
+
+        return call
+
+
+class DriveBatcher:
+    """ Collects metadata-only Drive changes (renames, trashes, and moves) and sends them as batch requests.
+
+    Each call waits for the batch containing its change to come back, then returns or raises that change's own
+    result, just like an individual request would. """
+    def __init__(self, drive, window=BATCH_WINDOW):
+        self.drive = drive
+        self.window = window
+        self.queue = []
+
+    async def rename(self, id_, name):
+        """ Rename an existing drive file or folder with a given id without changing its contents. """
+        return await self.submit(dict(fileId=id_, body={'title': name}))
+
+    async def delete(self, id_):
+        """ Delete an existing drive file or folder with a given id. """
+        return await self.submit(dict(fileId=id_, body={'labels': {'trashed': True}}))
+
+    async def move(self, id_, old_parent_id, new_parent_id, name):
+        """ Move an existing drive file or folder with a given id to another folder, renaming it along the way. """
+        return await self.submit(dict(fileId=id_, body={'title': name},
+                                      addParents=new_parent_id, removeParents=old_parent_id))
+
+    async def submit(self, mutation):
+        # The first change in line sends the batch, and the others wait for it
+        entry = dict(mutation=mutation, done=trio.Event(), result=None, sender=not self.queue)
+        self.queue.append(entry)
+
+        if not entry['sender']:
+            try:
+                await entry['done'].wait()
+            except trio.Cancelled:
+                if entry['sender']:
+                    self.hand_off(entry)
+                raise
+        # Still set if the sender was cancelled and handed the batch over to this change
+        if entry['sender']:
+            await self.send(entry)
+
+        if isinstance(entry['result'], Exception):
+            raise entry['result']
+        return entry['result']
+
+    async def send(self, entry):
+        """ Give other operations a moment to queue their changes, then send everything queued. """
+        try:
+            await trio.sleep(self.window)
+        except trio.Cancelled:
+            self.hand_off(entry)
+            raise
+
+        batch, self.queue = self.queue, []
+        # The other changes are waiting on this batch, so it goes out even if the sender is cancelled meanwhile
+        with trio.CancelScope(shield=True):
+            try:
+                results = await self.drive.apply_batch([queued['mutation'] for queued in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+
+        for queued, result in zip(batch, results):
+            queued['result'] = result
+            queued['done'].set()
+
+    def hand_off(self, entry):
+        """ Drop a cancelled sender's change, and make the next change in line the sender, so nobody waits forever. """
+        self.queue.remove(entry)
+        if self.queue:
+            self.queue[0]['sender'] = True
+            self.queue[0]['done'].set()
@@ -0,0 +1,249 @@
+""" SQLite-backed store for the RM, Drive, and Notion state of every synced item. """
+import atexit
+from collections import namedtuple
+import json
+import os
+import sqlite3
+import threading
+
+STATE_DB = 'state.db'
+
+# Where folders used to be saved, one JSON file each. These get imported into the database once.
+LEGACY_DIR = 'folder_state'
+
+# Number of folder saves to group into a single transaction
+COMMIT_EVERY = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (id TEXT PRIMARY KEY, name TEXT, drive_id TEXT, notion_id TEXT);
+CREATE TABLE IF NOT EXISTS items (id TEXT PRIMARY KEY, parent TEXT NOT NULL, kind TEXT NOT NULL, version INTEGER);
+CREATE TABLE IF NOT EXISTS drive (id TEXT PRIMARY KEY, parent TEXT NOT NULL, kind TEXT NOT NULL,
+                                  drive_id TEXT, name TEXT, url TEXT);
+CREATE TABLE IF NOT EXISTS notion (id TEXT PRIMARY KEY, parent TEXT NOT NULL, kind TEXT NOT NULL, notion_id TEXT);
+CREATE INDEX IF NOT EXISTS items_parent ON items (parent);
+CREATE INDEX IF NOT EXISTS drive_parent ON drive (parent);
+CREATE INDEX IF NOT EXISTS notion_parent ON notion (parent);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS fingerprints (id TEXT PRIMARY KEY, fingerprint TEXT);
+CREATE TABLE IF NOT EXISTS snapshot (id TEXT PRIMARY KEY, parent TEXT, name TEXT, kind TEXT NOT NULL, version INTEGER);
+CREATE TABLE IF NOT EXISTS listing (id TEXT PRIMARY KEY, parent TEXT, name TEXT, kind TEXT NOT NULL, version INTEGER);
+CREATE TABLE IF NOT EXISTS deferred (id TEXT PRIMARY KEY, since REAL NOT NULL);
+"""
+
+# What the last sync recorded about an item, regardless of which folder it's in
+KnownItem = namedtuple('KnownItem', ['parent', 'kind', 'version', 'name', 'fingerprint'])
+
+# One item of the whole RM listing as of the last sync, whether it was synced or not (e.g. in the trash)
+SnapshotItem = namedtuple('SnapshotItem', ['id', 'parent', 'name', 'kind', 'version'])
+
+# Where a synced item should be on Drive, and the Notion block that links to it
+DriveItem = namedtuple('DriveItem', ['id', 'parent', 'kind', 'drive_id', 'name', 'parent_drive_id', 'notion_id'])
+
+# RM listings that are kept: the one the last successful sync mirrored, and the one the last sync worked from, which
+# differs from it when something didn't go through
+SNAPSHOT = 'snapshot'
+LISTING = 'listing'
+
+# Folder dicts keep files and sub-folders apart, the tables tell them apart with a kind column
+SECTIONS = {'file': 'files', 'folder': 'sub_folders'}
+
+
+class StateStore:
+    """ Every folder's state in one database, with a row per item per service.
+
+    Tables are keyed by RM ID and indexed by parent ID, so saving a folder only touches the rows that changed and
+    questions about the whole tree are a single query. """
+    def __init__(self, path=STATE_DB):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.pending = 0
+
+        self.maybe_migrate()
+
+        # Don't lose a partial batch if the script dies with an exception
+        atexit.register(self.commit)
+
+    @staticmethod
+    def rows(folder_dict):
+        """ Flatten a folder dict (as stored in the old JSON files) into rows for each table, keyed by RM ID. """
+        id_ = folder_dict['rm']['id_']
+        rows = dict(folders={id_: (folder_dict['name'], folder_dict['drive']['id_'], folder_dict['notion']['id_'])},
+                    items=dict(), drive=dict(), notion=dict())
+
+        for kind, section in SECTIONS.items():
+            for child, version in folder_dict['rm'].get(section, {}).items():
+                rows['items'][child] = (id_, kind, version)
+            for child, drive_data in folder_dict['drive'].get(section, {}).items():
+                rows['drive'][child] = (id_, kind, drive_data['id'], drive_data['name'], drive_data['url'])
+            for child, notion_id in folder_dict['notion'].get(section, {}).items():
+                rows['notion'][child] = (id_, kind, notion_id)
+
+        return rows
+
+    def save_folder(self, folder_dict, previous_rows=None):
+        """ Write a folder's rows that differ from `previous_rows` (all of them if None) and return the new rows. """
+        rows = self.rows(folder_dict)
+        previous_rows = previous_rows if previous_rows else dict(folders={}, items={}, drive={}, notion={})
+        id_ = folder_dict['rm']['id_']
+
+        for table, table_rows in rows.items():
+            old_rows = previous_rows[table]
+            changed = [(key, *row) for key, row in table_rows.items() if old_rows.get(key) != row]
+            removed = [(key, id_) for key in old_rows.keys() - table_rows.keys()]
+
+            if changed:
+                placeholders = ', '.join('?' * len(changed[0]))
+                self.connection.executemany(f"INSERT OR REPLACE INTO {table} VALUES ({placeholders})", changed)
+            if removed and table != 'folders':
+                # Only delete rows still under this folder, in case the item has since been filed elsewhere
+                self.connection.executemany(f"DELETE FROM {table} WHERE id = ? AND parent = ?", removed)
+
+        self.pending += 1
+        if self.pending >= COMMIT_EVERY:
+            self.commit()
+
+        return rows
+
+    def load_folder(self, id_):
+        """ Return the folder dict for a given RM ID, or None if that folder has never been saved. """
+        folder_row = self.connection.execute("SELECT name, drive_id, notion_id FROM folders WHERE id = ?",
+                                             (id_,)).fetchone()
+        if not folder_row:
+            return
+
+        name, drive_id, notion_id = folder_row
+        rm = dict(id_=id_, files=dict(), sub_folders=dict())
+        drive = dict(id_=drive_id, files=dict(), sub_folders=dict())
+        notion = dict(id_=notion_id, files=dict(), sub_folders=dict())
+
+        for child, kind, version in self.connection.execute(
+                "SELECT id, kind, version FROM items WHERE parent = ?", (id_,)):
+            rm[SECTIONS[kind]][child] = version
+        for child, kind, drive_id, drive_name, url in self.connection.execute(
+                "SELECT id, kind, drive_id, name, url FROM drive WHERE parent = ?", (id_,)):
+            drive[SECTIONS[kind]][child] = dict(id=drive_id, name=drive_name, url=url)
+        for child, kind, notion_id in self.connection.execute(
+                "SELECT id, kind, notion_id FROM notion WHERE parent = ?", (id_,)):
+            notion[SECTIONS[kind]][child] = notion_id
+
+        return dict(name=name, rm=rm, drive=drive, notion=notion)
+
+    def known_ids(self):
+        """ Return the RM IDs of every item that has been synced, across the whole tree. """
+        return {id_ for id_, in self.connection.execute("SELECT id FROM items")}
+
+    def known_items(self):
+        """ Return a KnownItem for every item that has been synced, keyed by RM ID. """
+        return {id_: KnownItem(*row) for id_, *row in self.connection.execute(
+            "SELECT items.id, items.parent, items.kind, items.version, drive.name, fingerprints.fingerprint "
+            "FROM items LEFT JOIN drive ON drive.id = items.id "
+            "LEFT JOIN fingerprints ON fingerprints.id = items.id")}
+
+    def drive_items(self):
+        """ Return a DriveItem for every item that has been put on Drive, keyed by RM ID. """
+        return {row[0]: DriveItem(*row) for row in self.connection.execute(
+            "SELECT drive.id, drive.parent, drive.kind, drive.drive_id, drive.name, folders.drive_id, notion.notion_id "
+            "FROM drive LEFT JOIN folders ON folders.id = drive.parent "
+            "LEFT JOIN notion ON notion.id = drive.id")}
+
+    def set_fingerprint(self, id_, fingerprint):
+        """ Record the content fingerprint of the version of a document that's on Drive now (see RM.fingerprint). """
+        if fingerprint:
+            self.connection.execute("INSERT OR REPLACE INTO fingerprints VALUES (?, ?)", (id_, fingerprint))
+
+    def locate(self, id_):
+        """ Return what's stored about a synced item on Drive and Notion, plus the Drive ID of the folder it's in. """
+        drive_row = self.connection.execute("SELECT drive_id, name, url FROM drive WHERE id = ?", (id_,)).fetchone()
+        notion_row = self.connection.execute("SELECT notion_id FROM notion WHERE id = ?", (id_,)).fetchone()
+        parent_row = self.connection.execute("SELECT folders.drive_id FROM items JOIN folders "
+                                             "ON folders.id = items.parent WHERE items.id = ?", (id_,)).fetchone()
+
+        return dict(drive=dict(zip(('id', 'name', 'url'), drive_row)) if drive_row else None,
+                    notion=notion_row[0] if notion_row else None,
+                    parent_drive_id=parent_row[0] if parent_row else None)
+
+    def notion_pages(self, ids):
+        """ Return the Notion page IDs of the saved folders among the given RM IDs. """
+        ids = set(ids)
+        return [notion_id for id_, notion_id in self.connection.execute("SELECT id, notion_id FROM folders")
+                if id_ in ids and notion_id]
+
+    def save_snapshot(self, items, table=SNAPSHOT):
+        """ Replace a stored RM listing (SNAPSHOT or LISTING) with `items`, a dict of SnapshotItems by RM ID, writing
+        only what changed. """
+        previous = self.load_snapshot(table)
+        changed = [tuple(item) for id_, item in items.items() if previous.get(id_) != item]
+        removed = [(id_,) for id_ in previous.keys() - items.keys()]
+
+        self.connection.executemany(f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?, ?, ?)", changed)
+        self.connection.executemany(f"DELETE FROM {table} WHERE id = ?", removed)
+
+    def load_snapshot(self, table=SNAPSHOT):
+        """ Return a stored RM listing (SNAPSHOT by default, see above), as a dict of SnapshotItems by RM ID. """
+        if table not in (SNAPSHOT, LISTING):
+            raise ValueError(f"No stored listing called {table}")
+        return {row[0]: SnapshotItem(*row) for row in self.connection.execute(
+            f"SELECT id, parent, name, kind, version FROM {table}")}
+
+    def deferred(self):
+        """ Return when each item whose updates were left for later by a run that ran out of time was first left. """
+        return dict(self.connection.execute("SELECT id, since FROM deferred"))
+
+    def set_deferred(self, ids, now):
+        """ Record that the last run left the updates of the items with the given RM IDs for later. Items left by
+        earlier runs as well keep the time they were first left. """
+        ids = set(ids)
+        previous = self.deferred()
+        self.connection.executemany("DELETE FROM deferred WHERE id = ?", [(id_,) for id_ in previous.keys() - ids])
+        self.connection.executemany("INSERT INTO deferred VALUES (?, ?)", [(id_, now) for id_ in ids - previous.keys()])
+
+    def forget(self, ids):
+        """ Delete every trace of the items with the given RM IDs. """
+        for table in ('folders', 'items', 'drive', 'notion', 'fingerprints', 'deferred'):
+            self.connection.executemany(f"DELETE FROM {table} WHERE id = ?", [(id_,) for id_ in ids])
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def maybe_migrate(self):
+        """ Import the per-folder JSON files from before there was a database, once. """
+        if self.connection.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone():
+            return
+
+        # The root folder's ID is empty, so its file is '.json', which glob would skip as hidden
+        names = os.listdir(LEGACY_DIR) if os.path.isdir(LEGACY_DIR) else []
+        for name in names:
+            if name.endswith('.json'):
+                with open(os.path.join(LEGACY_DIR, name), 'r') as file:
+                    self.save_folder(json.load(file))
+
+        self.connection.execute("INSERT INTO meta VALUES ('migrated', ?)", (LEGACY_DIR,))
+        self.commit()
+
+
+class UploadSessions:
+    """ Drive resumable upload session URIs, so an interrupted upload can pick up where it stopped in a later run.
+
+    Uploads happen in worker threads, so this keeps its own connection and lock rather than sharing StateStore's.
+    Every write is committed right away; there are only a couple per upload. """
+    def __init__(self, path=STATE_DB):
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS uploads (key TEXT PRIMARY KEY, uri TEXT)")
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT uri FROM uploads WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, uri):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO uploads VALUES (?, ?)", (key, uri))
+
+    def delete(self, key):
+        with self.lock:
+            self.connection.execute("DELETE FROM uploads WHERE key = ?", (key,))
@@ -0,0 +1,47 @@
+""" Shared setup: the sync modules run against the fake backends in bench.fakes, in a fresh directory per test. """
+import os
+import sys
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+# Environment the sync modules read at import. None of it gets used against the fakes.
+for key in ('MAILHOST', 'FROMADDR', 'TOADDRS', 'OFFICIAL_NOTION_TOKEN', 'UNOFFICIAL_NOTION_TOKEN', 'NOTION_ROOT'):
+    os.environ.setdefault(key, 'test')
+
+from bench import fakes  # noqa: E402
+
+# rmcl, drive, and notional have to be replaced before anything imports them
+fakes.install(fakes.World())
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', "renders: the test syncs documents, which takes rmrl to render")
+
+
+@pytest.fixture
+def world(request, tmp_path, monkeypatch):
+    """ A fresh, empty fake world, with the update script pointed at it and its state kept in a temporary directory. """
+    if request.node.get_closest_marker('renders'):
+        pytest.importorskip('rmrl')
+    monkeypatch.chdir(tmp_path)
+    world = fakes.World(seed=0)
+    monkeypatch.setenv('NOTION_ROOT', world.notion_root)
+    fakes.install(world)
+
+    from cache import PdfCache, CACHE_DIR, PAGE_CACHE_DIR, PAGE_CACHE_BYTES
+    import log
+    from profiles import Profile, DEFAULT_PROFILE
+    import update
+
+    # Errors are expected in some tests; don't try to email them
+    update.logger.handlers = [handler for handler in update.logger.handlers
+                              if not isinstance(handler, log.SpoolingSMTPHandler)]
+    update.use_profile(Profile(DEFAULT_PROFILE))
+
+    # Render workers keep the directory they were forked in, so the caches need absolute paths
+    update.renderer.cache = PdfCache(str(tmp_path / CACHE_DIR))
+    update.renderer.pages = PdfCache(str(tmp_path / PAGE_CACHE_DIR), PAGE_CACHE_BYTES)
+    return world
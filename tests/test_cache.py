@@ -0,0 +1,32 @@
+""" The rendered PDF cache. """
+import os
+
+import cache
+from cache import PdfCache
+
+
+def test_entry_evicted_while_it_is_being_opened(tmp_path, monkeypatch):
+    pdfs = PdfCache(str(tmp_path))
+    temp_path = pdfs.temp_path()
+    with open(temp_path, 'wb') as file:
+        file.write(b'%PDF')
+    pdfs.put('doc', 1, temp_path).close()
+
+    def evict_then_touch(path):
+        os.remove(path)
+        raise FileNotFoundError(path)
+    monkeypatch.setattr(cache.os, 'utime', evict_then_touch)
+
+    with pdfs.get('doc', 1) as pdf:
+        assert pdf.read() == b'%PDF'
+    assert pdfs.get('doc', 1) is None
+
+
+def test_directory_is_created_on_first_write(tmp_path):
+    pdfs = PdfCache(str(tmp_path / 'cache'))
+    assert pdfs.get('doc', 1) is None
+    pdfs.evict()
+    assert not os.path.exists(tmp_path / 'cache')
+
+    pdfs.put('doc', 1, pdfs.temp_path()).close()
+    assert pdfs.get('doc', 1) is not None
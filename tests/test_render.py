@@ -0,0 +1,72 @@
+""" Rendering documents page by page. """
+import io
+import json
+import zipfile
+
+import pytest
+
+from bench.fakes import World
+from cache import PdfCache
+from render import render_raw
+
+PAGES = 20
+
+
+def annotated_pdf(path, strokes):
+    """ Write the zip of a PDF document with an outline, and strokes on the given pages. """
+    from reportlab.pdfgen import canvas
+
+    base = io.BytesIO()
+    pdf = canvas.Canvas(base)
+    for i in range(PAGES):
+        pdf.drawString(100, 700, f"Page {i}")
+        pdf.bookmarkPage(f"page{i}")
+        pdf.addOutlineEntry(f"Chapter {i}", f"page{i}")
+        pdf.showPage()
+    pdf.save()
+
+    page_ids = [f"page{i}" for i in range(PAGES)]
+    files = {'doc.content': json.dumps(dict(fileType='pdf', pages=page_ids)).encode(),
+             'doc.pdf': base.getvalue(),
+             'doc.pagedata': b'Blank\n' * PAGES}
+    for i, seed in strokes.items():
+        files[f'doc/page{i}.rm'] = World.lines(seed)
+    with zipfile.ZipFile(path, 'w') as raw:
+        for name, data in files.items():
+            raw.writestr(name, data)
+
+
+def test_base_pdf_keeps_its_outline_and_only_changed_overlays_are_rendered(tmp_path):
+    pytest.importorskip('rmrl')
+    from pdfrw import PdfReader
+
+    pages = PdfCache(str(tmp_path / 'pages'))
+    annotated_pdf(tmp_path / 'v1.zip', {3: 1, 7: 2})
+    render_raw(tmp_path / 'v1.zip', tmp_path / 'v1.pdf', pages)
+    annotated_pdf(tmp_path / 'v2.zip', {3: 1, 7: 3})
+    render_raw(tmp_path / 'v2.zip', tmp_path / 'v2.pdf', pages)
+    render_raw(tmp_path / 'v2.zip', tmp_path / 'full.pdf')
+
+    # One overlay per stroked page and version, and none for the pages without strokes
+    assert len(list((tmp_path / 'pages').iterdir())) == 3
+
+    by_page, full = PdfReader(str(tmp_path / 'v2.pdf')), PdfReader(str(tmp_path / 'full.pdf'))
+    assert len(by_page.pages) == PAGES
+    assert by_page.Root.Outlines.Count == full.Root.Outlines.Count
+    # The base PDF's shared resources are written once, as in a full render
+    assert (tmp_path / 'v2.pdf').stat().st_size < 1.2 * (tmp_path / 'full.pdf').stat().st_size
+
+
+def test_page_key_covers_display_settings():
+    from render import PageSource
+
+    class Source:
+        def exists(self, fn):
+            return False
+
+    def key(**content):
+        return PageSource(Source(), dict(content, pages=['page0']), 'page0', 0, []).digest()
+
+    assert key(orientation='portrait', lastOpenedPage=1) == key(orientation='portrait', lastOpenedPage=5)
+    assert key(orientation='portrait') != key(orientation='landscape')
+    assert key(transform=dict(m11=1)) != key(transform=dict(m11=2))
@@ -0,0 +1,148 @@
+""" Working out what changed on the reMarkable, offline. """
+import io
+import struct
+import zipfile
+
+from rm import RM, RemovedItem, TreeDiff
+from state import KnownItem, SnapshotItem
+
+
+def listing(*items):
+    """ A listing of (id, parent, name, kind, version) tuples, as a dict of SnapshotItems by ID. """
+    return {item[0]: SnapshotItem(*item) for item in items}
+
+
+def known(by_id, **fingerprints):
+    """ The stored state after syncing a listing. """
+    return {id_: KnownItem(item.parent, item.kind, item.version, item.name, fingerprints.get(id_))
+            for id_, item in by_id.items()}
+
+
+BEFORE = listing(('a', '', 'A', 'folder', 1),
+                 ('b', '', 'B', 'folder', 1),
+                 ('doc', 'a', 'Doc', 'file', 1),
+                 ('other', 'a', 'Other', 'file', 1))
+
+
+def names(updates, change):
+    return [item.name for item in getattr(updates, change)]
+
+
+def test_nothing_changed():
+    diff = TreeDiff(BEFORE, known(BEFORE))
+    assert diff.changed == set()
+
+
+def test_create():
+    diff = TreeDiff(dict(BEFORE, new=SnapshotItem('new', 'b', 'New', 'file', 1)), known(BEFORE))
+    files, folders = diff.updates('b')
+
+    assert names(files, 'created') == ['New']
+    assert not folders.change
+    assert diff.changed == {'b', ''}
+
+
+def test_modify_and_rename():
+    # Both have a new version, but only the first has new content
+    after = dict(BEFORE, doc=SnapshotItem('doc', 'a', 'Doc', 'file', 2),
+                 other=SnapshotItem('other', 'a', 'Renamed', 'file', 2))
+    diff = TreeDiff(after, known(BEFORE, doc='old', other='same'), fingerprints=dict(doc='new', other='same'))
+    files, _ = diff.updates('a')
+
+    assert names(files, 'modified') == ['Doc']
+    assert names(files, 'renamed') == ['Renamed']
+    assert diff.to_render() == [after['doc']]
+
+
+def test_move():
+    after = dict(BEFORE, doc=SnapshotItem('doc', 'b', 'Doc', 'file', 2))
+    diff = TreeDiff(after, known(BEFORE))
+
+    assert names(diff.updates('b')[0], 'moved') == ['Doc']
+    assert not diff.updates('a')[0].change
+    assert diff.moved == {'doc': ('a', 'b')}
+    assert diff.changed == {'a', 'b', ''}
+
+
+def test_delete():
+    after = dict(BEFORE, other=SnapshotItem('other', 'trash', 'Other', 'file', 2))
+    del after['doc']
+    files, _ = TreeDiff(after, known(BEFORE)).updates('a')
+
+    assert sorted(names(files, 'deleted')) == ['Doc', 'Other']
+    assert any(isinstance(item, RemovedItem) for item in files.deleted)
+
+
+def test_move_out_of_a_deleted_folder():
+    after = dict(BEFORE, doc=SnapshotItem('doc', 'b', 'Doc', 'file', 2))
+    del after['a'], after['other']
+    diff = TreeDiff(after, known(BEFORE))
+
+    # The folder is deleted where it was; what's left in it goes with it, and the moved document is planned in B
+    assert names(diff.updates('')[1], 'deleted') == ['A']
+    assert diff.orphaned == ['other']
+    assert names(diff.updates('b')[0], 'moved') == ['Doc']
+    assert diff.moved_out('a') == ['doc']
+    assert diff.moved_out('b') == []
+
+
+def test_move_out_of_a_folder_deleted_along_with_its_parent():
+    before = dict(BEFORE, c=SnapshotItem('c', 'a', 'C', 'folder', 1), deep=SnapshotItem('deep', 'c', 'Deep', 'file', 1))
+    after = dict(before, deep=SnapshotItem('deep', '', 'Deep', 'file', 2))
+    del after['a'], after['c']
+
+    assert sorted(TreeDiff(after, known(before)).moved_out('a')) == ['deep']
+
+
+def central_directory(entries):
+    """ The central directory of a zip holding the given (name, content) entries, in that order. """
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as archive:
+        for name, content in entries:
+            archive.writestr(name, content)
+    blob = data.getvalue()
+    end = blob.rfind(b'PK\x05\x06')
+    size, offset = struct.unpack('<II', blob[end + 12:end + 20])
+    return blob[offset:offset + size]
+
+
+def test_directory_digest():
+    digest = RM.directory_digest(central_directory([('x.rm', b'lines'), ('x.content', b'{}')]))
+
+    assert RM.directory_digest(central_directory([('x.content', b'{}'), ('x.rm', b'lines')])) == digest
+    assert RM.directory_digest(central_directory([('x.rm', b'more lines'), ('x.content', b'{}')])) != digest
+    assert RM.directory_digest(central_directory([('y.rm', b'lines'), ('x.content', b'{}')])) != digest
+
+
+def test_a_deep_change_marks_every_directory_above_it():
+    before = dict(BEFORE, c=SnapshotItem('c', 'a', 'C', 'folder', 1), deep=SnapshotItem('deep', 'c', 'Deep', 'file', 1))
+    after = dict(before, deep=SnapshotItem('deep', 'c', 'Deep', 'file', 2))
+    diff = TreeDiff(after, known(before))
+
+    assert names(diff.updates('c')[0], 'modified') == ['Deep']
+    assert diff.changed == {'c', 'a', ''}
+
+
+def test_trashed_items_are_deleted_and_left_out_of_the_listing():
+    after = dict(BEFORE, b=SnapshotItem('b', 'trash', 'B', 'folder', 2))
+    diff = TreeDiff(after, known(BEFORE))
+
+    assert names(diff.updates('')[1], 'deleted') == ['B']
+    assert [item.name for item in diff.children[('', 'folder')]] == ['A']
+
+
+def test_documents_without_a_stored_fingerprint_count_as_modified():
+    after = dict(BEFORE, doc=SnapshotItem('doc', 'a', 'Doc', 'file', 2))
+    diff = TreeDiff(after, known(BEFORE), fingerprints=dict(doc='same'))
+
+    assert names(diff.updates('a')[0], 'modified') == ['Doc']
+    assert diff.to_render() == [after['doc']]
+
+
+def test_moved_documents_are_only_rendered_if_their_content_changed():
+    after = dict(BEFORE, doc=SnapshotItem('doc', 'b', 'Doc', 'file', 2),
+                 other=SnapshotItem('other', 'b', 'Other', 'file', 2))
+    diff = TreeDiff(after, known(BEFORE, doc='old', other='same'), fingerprints=dict(doc='new', other='same'))
+
+    assert sorted(names(diff.updates('b')[0], 'moved')) == ['Doc', 'Other']
+    assert diff.to_render() == [after['doc']]
@@ -0,0 +1,59 @@
+""" Batching Drive changes. """
+import trio
+
+from services import DriveBatcher
+
+
+class RecordingDrive:
+    def __init__(self):
+        self.batches = []
+
+    async def apply_batch(self, mutations):
+        self.batches.append([mutation['fileId'] for mutation in mutations])
+        return [dict(id=mutation['fileId']) for mutation in mutations]
+
+
+def run_deletes(batcher, ids, cancel=()):
+    """ Delete the given Drive IDs at once, cancelling the deletions of the IDs in `cancel` once all are queued. """
+    results = dict()
+    scopes = dict()
+
+    async def delete(id_):
+        with trio.CancelScope() as scopes[id_]:
+            results[id_] = await batcher.delete(id_)
+
+    async def main():
+        with trio.fail_after(5):
+            async with trio.open_nursery() as nursery:
+                for id_ in ids:
+                    nursery.start_soon(delete, id_)
+                    await trio.sleep(0.01)
+                for id_ in cancel:
+                    scopes[id_].cancel()
+
+    trio.run(main)
+    return results
+
+
+def test_changes_go_out_in_one_batch():
+    drive = RecordingDrive()
+    results = run_deletes(DriveBatcher(drive, window=0.1), ['a', 'b', 'c'])
+
+    assert drive.batches == [['a', 'b', 'c']]
+    assert results == {id_: dict(id=id_) for id_ in ('a', 'b', 'c')}
+
+
+def test_cancelled_sender_hands_the_batch_over():
+    drive = RecordingDrive()
+    results = run_deletes(DriveBatcher(drive, window=0.1), ['a', 'b', 'c'], cancel=['a'])
+
+    assert drive.batches == [['b', 'c']]
+    assert results == {id_: dict(id=id_) for id_ in ('b', 'c')}
+
+
+def test_cancelled_waiter_still_gets_its_change_sent():
+    drive = RecordingDrive()
+    results = run_deletes(DriveBatcher(drive, window=0.1), ['a', 'b'], cancel=['b'])
+
+    assert drive.batches == [['a', 'b']]
+    assert results == {'a': dict(id='a')}
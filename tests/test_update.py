@@ -0,0 +1,168 @@
+""" End-to-end updates against the fake backends. """
+from functools import partial
+
+import pytest
+import trio
+
+import tree
+import update
+
+
+def sync():
+    return trio.run(update.run_update, 4)
+
+
+def drive_files(world, name):
+    return [item for item in world.drive.values() if item['title'] == name and not item['trashed']]
+
+
+def live(world, block):
+    """ Whether a Notion block and every block above it are still there. """
+    while block is not None and block['alive']:
+        block = world.notion.get(block['parent'])
+    return block is None
+
+
+def notion_links(world, name):
+    return [block for block in world.notion.values()
+            if live(world, block) and block['type'] == 'bulleted_list' and block['title'].startswith(f"[{name}]")]
+
+
+@pytest.mark.renders
+def test_initial_sync_then_no_changes(world):
+    folder = world.add_folder("Folder")
+    world.add_document("Top")
+    world.add_document("Inside", folder)
+
+    assert sync()
+    assert len(drive_files(world, "Top")) == 1
+    assert len(notion_links(world, "Inside")) == 1
+
+    world.calls.clear()
+    assert sync()
+    assert not any(key.startswith(('drive.', 'notion.')) for key in world.calls)
+
+
+@pytest.mark.renders
+def test_move_folder_with_new_document_inside(world):
+    aaa = world.add_folder("AAA")
+    bbb = world.add_folder("BBB")
+    xxx = world.add_folder("XXX", aaa)
+    world.add_document("Old", xxx)
+    assert sync()
+
+    world.move(xxx, bbb)
+    world.add_document("New", xxx)
+    assert sync()
+
+    assert len(drive_files(world, "New")) == 1
+    assert len(notion_links(world, "New")) == 1
+    assert sync()
+
+
+@pytest.mark.renders
+def test_move_folder_while_deleting_a_folder_inside(world):
+    aaa = world.add_folder("AAA")
+    bbb = world.add_folder("BBB")
+    xxx = world.add_folder("XXX", aaa)
+    child = world.add_folder("Child", xxx)
+    world.add_document("Kept", xxx)
+    assert sync()
+
+    world.move(xxx, bbb)
+    world.delete(child)
+    assert sync()
+
+    assert [item['title'] for item in world.drive.values() if item['trashed']] == ["Child"]
+    assert len(drive_files(world, "Kept")) == 1
+
+
+@pytest.mark.renders
+def test_move_out_of_a_deleted_folder(world):
+    doomed = world.add_folder("Doomed")
+    inner = world.add_folder("Inner", doomed)
+    kept = world.add_folder("Kept", doomed)
+    saved = world.add_document("Saved", doomed)
+    deep = world.add_document("Deep", inner)
+    assert sync()
+
+    # Trashing Doomed on Drive would trash anything that hadn't moved out of it yet
+    for id_ in (saved, deep, kept):
+        world.move(id_, '')
+    world.delete(inner)
+    world.delete(doomed)
+    assert sync()
+
+    for name in ("Saved", "Deep", "Kept"):
+        assert len(drive_files(world, name)) == 1
+    for name in ("Saved", "Deep"):
+        assert len(notion_links(world, name)) == 1
+    assert sync()
+
+
+@pytest.mark.renders
+def test_failed_sync_still_leaves_a_listing_to_diff(world, capsys):
+    world.add_document("Old")
+    assert sync()
+
+    world.add_document("New")
+    world.errors = 1.0
+    assert not sync()
+
+    store = update.Folder.state()
+    tree.diff(store.load_snapshot(update.LISTING), store.known_items())
+    assert "created file: New" in capsys.readouterr().out
+    # The snapshot is still the last successful sync's
+    assert [item.name for item in store.load_snapshot().values() if item.kind == 'file'] == ["Old"]
+
+
+def test_dry_run_succeeds_without_changing_anything(world):
+    world.add_folder("Folder")
+    assert trio.run(partial(update.run_update, 4, dry_run=True))
+    assert drive_files(world, "Folder") == []
+    assert update.Folder.state().load_snapshot() == dict()
+
+
+@pytest.mark.renders
+def test_new_folder_whose_link_fails_is_filled_on_the_next_run(world, monkeypatch):
+    folder = world.add_folder("Folder")
+    world.add_document("Inside", folder)
+
+    async def fail(*args):
+        return None
+    with monkeypatch.context() as patch:
+        patch.setattr(update, 'link_new_items', fail)
+        assert not sync()
+    assert drive_files(world, "Inside") == []
+
+    assert sync()
+    assert len(drive_files(world, "Folder")) == 1
+    assert len(drive_files(world, "Inside")) == 1
+    assert len(notion_links(world, "Inside")) == 1
+
+
+def test_folders_are_created_renamed_moved_and_deleted(world):
+    aaa = world.add_folder("AAA")
+    bbb = world.add_folder("BBB")
+    xxx = world.add_folder("XXX", aaa)
+    doomed = world.add_folder("Doomed", aaa)
+    assert sync()
+    assert len(drive_files(world, "XXX")) == 1
+
+    world.rename(aaa, "Renamed")
+    world.move(xxx, bbb)
+    world.delete(doomed)
+    assert sync()
+
+    assert drive_files(world, "AAA") == [] and len(drive_files(world, "Renamed")) == 1
+    bbb_id = next(id_ for id_, item in world.drive.items() if item['title'] == "BBB")
+    assert drive_files(world, "XXX")[0]['parents'] == [bbb_id]
+    assert drive_files(world, "Doomed") == []
+    assert sorted(block['title'] for block in world.notion.values()
+                  if live(world, block) and block['type'] == 'page') == ["BBB", "Remarkable", "Renamed", "XXX"]
+    pages = {block['title']: id_ for id_, block in world.notion.items() if live(world, block)}
+    assert world.notion[pages["XXX"]]['parent'] == pages["BBB"]
+
+    world.calls.clear()
+    assert sync()
+    assert not any(key.startswith(('drive.', 'notion.')) for key in world.calls)
@@ -0,0 +1,148 @@
+""" Pacing of Drive and Notion requests, so that bursts stay just under each service's quota instead of failing. """
+from collections import Counter
+from email.utils import parsedate_to_datetime
+import threading
+import time
+
+# Sustained requests per second and burst size, per service and class of endpoint
+RATES = {
+    ('drive', 'metadata'): (10, 20),
+    ('drive', 'upload'): (5, 10),
+    ('drive', 'batch'): (2, 4),
+    ('notion', 'official'): (3, 6),
+    ('notion', 'read'): (5, 10),
+    ('notion', 'write'): (3, 6),
+}
+
+# How many times to resend a throttled request before handing the throttled response back to the client
+THROTTLE_RETRIES = 5
+
+# How long to back off, in seconds, when a throttled response doesn't say. Doubles with each retry.
+DEFAULT_BACKOFF = 1
+
+# Throttling halves the rate, but never below this fraction of the configured rate.
+# Each request that goes through wins back RECOVERY of the configured rate.
+MIN_RATE_FRACTION = 0.1
+RECOVERY = 0.05
+
+
+class TokenBucket:
+    """ Hands out one token per request at a steady rate, with room for short bursts. Thread-safe. """
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Take a token, sleeping until it's available. Returns the number of seconds spent waiting. """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # Going into debt reserves a slot in the future, so later callers line up behind this one
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, self.paused_until - now, 0)
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self, delay):
+        """ The server asked us to slow down: pause everyone for `delay` seconds and halve the rate. """
+        with self.lock:
+            self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate / 2)
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY)
+
+
+class Scheduler:
+    """ One token bucket per service and endpoint class, shared by every client and worker thread.
+
+    Clients route each HTTP request through send(), which paces it and resends it when the server responds with a
+    rate limit, backing off as long as the server's Retry-After says to. """
+    def __init__(self, rates=RATES):
+        self.buckets = {key: TokenBucket(*rate) for key, rate in rates.items()}
+
+        # e.g. 'drive.upload.requests', 'drive.upload.throttled', 'drive.upload.wait_seconds'
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    def send(self, service, endpoint, request, inspect, discard=None):
+        """ Send a request once its bucket allows, and return the response.
+
+        `request` sends the request and returns the response. `inspect` takes a response and returns whether it was
+        throttled, plus the value of its Retry-After header (or None). `discard` releases a response that's about to
+        be retried, if it needs that. """
+        bucket = self.buckets[(service, endpoint)]
+        key = f"{service}.{endpoint}"
+
+        for attempt in range(THROTTLE_RETRIES + 1):
+            waited = bucket.acquire()
+            response = request()
+            throttled, retry_after = inspect(response)
+            self.count(key, waited, throttled)
+
+            if not throttled:
+                bucket.succeeded()
+                return response
+            if attempt == THROTTLE_RETRIES:
+                return response
+
+            delay = self.parse_retry_after(retry_after)
+            bucket.throttled(delay if delay is not None else DEFAULT_BACKOFF * 2 ** attempt)
+            if discard:
+                discard(response)
+
+    def count(self, key, waited, throttled):
+        with self.lock:
+            self.counters[f"{key}.requests"] += 1
+            self.counters[f"{key}.wait_seconds"] += waited
+            if throttled:
+                self.counters[f"{key}.throttled"] += 1
+
+    @staticmethod
+    def parse_retry_after(value):
+        """ Retry-After is either a number of seconds or an HTTP date. Returns seconds, or None if it's missing. """
+        if not value:
+            return
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return
+
+    def reset(self):
+        """ Zero the counters, e.g. between syncs in a long-running process. The buckets keep their current rates. """
+        with self.lock:
+            self.counters.clear()
+
+    def summary(self):
+        """ One line per endpoint class that was used: requests sent, how many were throttled, and time spent
+        waiting. """
+        with self.lock:
+            counters = self.counters.copy()
+
+        lines = []
+        for service, endpoint in self.buckets:
+            key = f"{service}.{endpoint}"
+            if counters[f"{key}.requests"]:
+                lines.append(f"{key}: {counters[f'{key}.requests']} requests, "
+                             f"{counters[f'{key}.throttled']} throttled, "
+                             f"{counters[f'{key}.wait_seconds']:.1f}s waiting")
+        return lines
+
+
+# Drive and both Notion clients pace their requests through this one scheduler
+scheduler = Scheduler()
@@ -0,0 +1,67 @@
+""" Look at the RM tree as of the last sync, without contacting any service.
+
+`python tree.py show` prints the listing of the last successful sync as a tree, and `python tree.py diff` lists what
+in the latest sync's listing hasn't been mirrored (e.g. items whose operations failed), folder by folder. """
+import argparse
+from collections import defaultdict
+
+from rm import RM, TreeDiff
+from state import StateStore, SNAPSHOT, LISTING
+
+
+def path(items, id_):
+    """ The slash-separated names of the folders from the root down to a given item. """
+    names = []
+    while id_ in items and id_ != RM.ROOT:
+        names.append(items[id_].name)
+        id_ = items[id_].parent
+    return '/' + '/'.join(reversed(names))
+
+
+def show(items, id_):
+    """ Print the tree under a folder, folders first, each level sorted by name. """
+    children = defaultdict(list)
+    for item in items.values():
+        children[item.parent].append(item)
+
+    def print_children(parent, depth):
+        for item in sorted(children[parent], key=lambda child: (child.kind != 'folder', child.name)):
+            print(f"{'    ' * depth}{item.name}{'/' if item.kind == 'folder' else ''}  (v{item.version}, {item.id})")
+            if item.kind == 'folder':
+                print_children(item.id, depth + 1)
+
+    print_children(id_, 0)
+
+
+def diff(items, known_items):
+    """ Print the difference between the stored listing and what's been mirrored, folder by folder. """
+    tree_diff = TreeDiff(items, known_items, RM.ROOT)
+    for id_ in sorted(tree_diff.changed, key=lambda changed_id: path(items, changed_id)):
+        lines = []
+        for kind, updates in zip(('files', 'folders'), tree_diff.updates(id_)):
+            for change in ('created', 'modified', 'deleted', 'moved', 'renamed'):
+                for item in getattr(updates, change):
+                    lines.append(f"    {change} {kind[:-1]}: {item.name} ({item.id})")
+        if lines:
+            print(path(items, id_))
+            print('\n'.join(lines))
+
+    if not tree_diff.changed:
+        print("Everything in the listing has been mirrored")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Inspect the RM tree as of the last sync, offline.")
+    parser.add_argument('command', choices=('show', 'diff'),
+                        help="print the tree, or what hasn't been mirrored to Drive and Notion")
+    parser.add_argument('--folder', default=RM.ROOT, help="RM ID of the folder to show, the root by default")
+    args = parser.parse_args()
+
+    store = StateStore()
+    snapshot = store.load_snapshot(SNAPSHOT if args.command == 'show' else LISTING)
+    if not snapshot:
+        print("No listing stored yet; one is saved after every sync, and another after every successful one")
+    elif args.command == 'show':
+        show(snapshot, args.folder)
+    else:
+        diff(snapshot, store.known_items())
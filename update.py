@@ -1,29 +1,95 @@
-from rm import RM, Updates
-from drive import Drive
-from notional import Notion
+from profiles import Profile, DEFAULT_PROFILE, load_profiles
 
+from cache import PdfCache, PAGE_CACHE_DIR, PAGE_CACHE_BYTES
 from folder import Folder
+from state import SNAPSHOT, LISTING
+from render import Renderer
+from plan import Plan
+from throttle import scheduler
+from metrics import metrics
 
 from log import set_up_logger
 
-import os
+import argparse
+from collections import defaultdict
+from functools import partial
+import time
 import trio
 
 logger = set_up_logger(__name__)
 
-# Initialize and authenticate the APIs
-rm = RM()
-drive = Drive()
-notion = Notion(os.environ["OFFICIAL_NOTION_TOKEN"],
-                os.environ["UNOFFICIAL_NOTION_TOKEN"],
-                os.environ["NOTION_ROOT"])
+# Maximum number of operations in flight at once
+DEFAULT_PARALLELISM = 8
+
+# In watch mode, seconds between polls right after a change, and at most once things have gone quiet
+MIN_POLL_INTERVAL = 5
+MAX_POLL_INTERVAL = 300
+
+# With a deadline, documents at least this big are rendered after everything else
+LARGE_DOCUMENT_BYTES = 20 * 1024 * 1024
+
+# Updates that have been left for later this long go before everything else, so a tight deadline can't hold them off
+# forever
+MAX_DEFERRAL = 24 * 60 * 60
+
+# The account being synced, and its services. Switch to another with use_profile().
+# The APIs are only initialized and authenticated once there's something to sync.
+# Drive and Notion calls block, so they run in worker threads.
+profile = Profile(DEFAULT_PROFILE)
+rm = profile.rm
+drive = profile.drive
+notion = profile.notion
+batcher = profile.batcher
+
+# PDF rendering is CPU-bound, so it runs in a pool of worker processes. Keep the results around in case uploads fail.
+renderer = Renderer(cache=PdfCache(), pages=PdfCache(PAGE_CACHE_DIR, PAGE_CACHE_BYTES))
+
+
+class Priorities:
+    """ Decides which updates go first: those left for later for too long, then metadata-only changes before
+    rendering, smaller documents before large ones, and the most recently modified items first. """
+    def __init__(self, sizes=None, deferred=None):
+        # Document sizes by RM ID where known, and when the updates of items left for later were first left
+        self.sizes = sizes if sizes else dict()
+        self.deferred = deferred if deferred else dict()
+        self.now = time.time()
+
+    def __call__(self, rm_item, render=False):
+        """ Return the sort key of an operation on an item, lowest first. Pass `render=True` if it renders the item. """
+        overdue = self.now - self.deferred.get(rm_item.id, self.now) >= MAX_DEFERRAL
+        large = render and self.sizes.get(rm_item.id, 0) >= LARGE_DOCUMENT_BYTES
+        try:
+            modified = rm_item.mtime.timestamp()
+        except Exception:
+            # Deleted items have no modification time
+            modified = 0
+        return not overdue, render, large, -modified
+
+
+# Set up for each run by mirror_updates
+priorities = Priorities()
+
+# The plan's Drive moves and sub-folder deletions by RM ID, set up for each run by mirror_updates
+moves = dict()
+deletions = dict()
+
+
+def use_profile(new_profile):
+    """ Sync another account from now on. Every function here works with the current profile's services and state. """
+    global profile, rm, drive, notion, batcher
+    profile = new_profile
+    rm = profile.rm
+    drive = profile.drive
+    notion = profile.notion
+    batcher = profile.batcher
+    Folder.store = profile.store
 
 
 async def convert_to_pdf(rm_file):
     """ Convert a raw RM file to a PDF. """
     logger.info(f"Converting {await rm_file.type()} {rm_file.name}. id_:{rm_file.id}")
     try:
-        return await rm_file.annotated()
+        return await renderer.annotated(rm_file)
     except TypeError as e:
         logger.error(f"Could not convert {rm_file.name} to PDF, likely due to missing size info in the original PDF.")
         logger.error(f"Error message:{e}")
@@ -41,23 +107,28 @@ async def create_file(rm_file, drive_id):
         return
     try:
         logger.debug("Uploading to drive")
-        return drive.upload_pdf(drive_id, rm_file.name, pdf)
+        return await drive.upload_pdf(drive_id, rm_file.name, pdf)
     except Exception as e:
         logger.error(f"Could not upload {rm_file.name} to drive.")
         logger.error(f"Error message: {e}")
         return
+    finally:
+        pdf.close()
 
 
 async def modify_file(folder, rm_file):
-    """ Rename and re-upload a modified RM file to Drive and Notion. """
+    """ Re-upload a modified RM file to Drive, renaming it on Drive and Notion if its name has changed too. """
     pdf = await convert_to_pdf(rm_file)
+    if not pdf:
+        return
     try:
-        logger.debug("Renaming on Drive and Notion")
-        drive.rename(folder.drive.files[rm_file.id]['id'], rm_file.name)
-        notion.rename_file(folder.notion.files[rm_file.id], rm_file.name)
+        if folder.drive.files[rm_file.id]['name'] != rm_file.name:
+            logger.debug("Renaming on Drive and Notion")
+            await batcher.rename(folder.drive.files[rm_file.id]['id'], rm_file.name)
+            await notion.rename_file(folder.notion.files[rm_file.id], rm_file.name)
 
         logger.debug("Uploading to drive")
-        drive.replace_pdf(folder.drive.files[rm_file.id]['id'], pdf)
+        await drive.replace_pdf(folder.drive.files[rm_file.id]['id'], pdf)
 
         return True
 
@@ -65,61 +136,240 @@ async def modify_file(folder, rm_file):
         logger.error(f"Could not update {rm_file.name}.")
         logger.error(f"Error message: {e}")
         return
+    finally:
+        pdf.close()
+
+
+async def rename_file(folder, rm_file):
+    """ Rename an RM file on Drive and Notion without touching its content. """
+    try:
+        logger.debug("Renaming on Drive and Notion")
+        await batcher.rename(folder.drive.files[rm_file.id]['id'], rm_file.name)
+        await notion.rename_file(folder.notion.files[rm_file.id], rm_file.name)
+        return True
+    except Exception as e:
+        logger.error(f"Could not rename {rm_file.name}.")
+        logger.error(f"Error message: {e}")
 
 
 async def delete_file(folder, rm_file):
-    """ Delete a removed RM file from Drive and Notion. """
+    """ Delete a removed RM file from Drive. Its Notion link is removed afterwards (see unlink_deleted_file). """
     try:
         logger.debug("Deleting Drive file")
-        drive.delete(folder.drive.files[rm_file.id]['id'])
+        await batcher.delete(folder.drive.files[rm_file.id]['id'])
+        return True
+    except Exception as e:
+        logger.error(f"Could not delete {rm_file.name}.")
+        logger.error(f"Error message: {e}")
+
+
+async def unlink_deleted_file(folder, rm_file):
+    """ Delete a removed RM file's link from its folder's Notion page. """
+    try:
         logger.debug("Deleting Notion file")
-        notion.delete(folder.notion.files[rm_file.id])
+        await notion.delete(folder.notion.files[rm_file.id])
         return True
     except Exception as e:
         logger.error(f"Could not delete {rm_file.name}.")
         logger.error(f"Error message: {e}")
 
 
-async def process_files(folder, file_updates):
-    """ Process all the file updates in a folder. """
-    for rm_file in file_updates.created:
-        drive_file = await create_file(rm_file, folder.drive.id_)
+async def upload_new_file(folder, rm_file):
+    """ Upload a new RM file to Drive and record it in the Folder. """
+    # Fingerprint the file before downloading it, so the fingerprint can't be newer than what ends up on Drive
+    fingerprint = await fingerprint_file(rm_file)
+    drive_file = await create_file(rm_file, folder.drive.id_)
 
-        # If the upload went smoothly, record it in the Folder and add the file link to Notion
-        if drive_file:
-            folder.rm.add_file(rm_file.id, rm_file.version)
-            folder.drive.add_file(rm_file.id, dict(id=drive_file['id'],
-                                                   name=rm_file.name,
-                                                   url=drive_file['embedLink']))
+    # If the upload went smoothly, record it in the Folder
+    if drive_file:
+        Folder.state().set_fingerprint(rm_file.id, fingerprint)
+        folder.rm.add_file(rm_file.id, rm_file.version)
+        folder.drive.add_file(rm_file.id, dict(id=drive_file['id'],
+                                               name=rm_file.name,
+                                               url=drive_file['embedLink']))
+    return drive_file
 
-            notion_file = notion.add_file(folder.notion.id_, rm_file.name, drive_file['embedLink'])
-            folder.notion.add_file(rm_file.id, notion_file.id)
 
-    for rm_file in file_updates.modified:
-        success = await modify_file(folder, rm_file)
+async def link_new_items(folder, rm_files, new_sub_folders):
+    """ Add links to every new file and sub-folder that made it onto Drive to the folder's Notion page at once.
 
-        # If the upload went smoothly, update the Folder data
-        if success:
-            folder.rm.add_file(rm_file.id, rm_file.version)
-            folder.drive.files[rm_file.id]['name'] = rm_file.name
+    `new_sub_folders` are (RM sub-folder, Folder) pairs. The new Notion IDs are recorded in the Folder and handed
+    to the sub-folders' own operations. """
+    rm_files = [rm_file for rm_file in rm_files if rm_file.id in folder.drive.files]
+    new_sub_folders = [(rm_sub_folder, sub_folder) for rm_sub_folder, sub_folder in new_sub_folders
+                       if rm_sub_folder.id in folder.drive.sub_folders]
+    if len(rm_files) == 0 and len(new_sub_folders) == 0:
+        return
 
-    for rm_file in file_updates.deleted:
-        success = await delete_file(folder, rm_file)
+    logger.info(f"Linking {len(rm_files)} files and {len(new_sub_folders)} folders in {folder.name}")
+    file_ids, sub_folder_ids = await notion.add_links(
+        folder.notion.id_,
+        files=[(rm_file.name, folder.drive.files[rm_file.id]['url']) for rm_file in rm_files],
+        sub_folders=[rm_sub_folder.name for rm_sub_folder, _ in new_sub_folders])
+
+    for rm_file, notion_id in zip(rm_files, file_ids):
+        folder.notion.add_file(rm_file.id, notion_id)
+    for (rm_sub_folder, sub_folder), notion_id in zip(new_sub_folders, sub_folder_ids):
+        folder.rm.add_sub_folder(rm_sub_folder.id, rm_sub_folder.version)
+        folder.notion.add_sub_folder(rm_sub_folder.id, notion_id)
+        sub_folder.notion.id_ = notion_id
+    return True
+
+
+async def fingerprint_file(rm_file):
+    """ Return the content fingerprint of an RM file, or None if it can't be fetched right now. """
+    try:
+        return await rm.fingerprint(rm_file)
+    except Exception as e:
+        # Without a fingerprint, the file's next version simply counts as a content change
+        logger.debug(f"Could not fingerprint {rm_file.name}: {e}")
+
+
+async def update_modified_file(folder, rm_file, fingerprint):
+    success = await modify_file(folder, rm_file)
+
+    # If the upload went smoothly, update the Folder data
+    if success:
+        Folder.state().set_fingerprint(rm_file.id, fingerprint)
+        folder.rm.add_file(rm_file.id, rm_file.version)
+        folder.drive.files[rm_file.id]['name'] = rm_file.name
+    return success
+
+
+async def update_renamed_file(folder, rm_file):
+    # A new version with the same content and name (e.g. a new bookmark) just needs recording
+    if folder.drive.files[rm_file.id]['name'] != rm_file.name and not await rename_file(folder, rm_file):
+        return
+
+    folder.rm.add_file(rm_file.id, rm_file.version)
+    folder.drive.files[rm_file.id]['name'] = rm_file.name
+    return True
 
-        # If the upload went smoothly, delete the associated Folder data
-        if success:
-            del folder.rm.files[rm_file.id]
-            del folder.drive.files[rm_file.id]
-            del folder.notion.files[rm_file.id]
+
+async def remove_deleted_file(folder, rm_file):
+    success = await unlink_deleted_file(folder, rm_file)
+
+    # If the upload went smoothly, delete the associated Folder data
+    if success:
+        del folder.rm.files[rm_file.id]
+        del folder.drive.files[rm_file.id]
+        del folder.notion.files[rm_file.id]
+    return success
+
+
+async def move_file(folder, rm_file, stored, refresh):
+    """ Move a file that was recorded under another RM folder on Drive, and record it in its new Folder.
+
+    If `refresh` is True, the file's content has changed as well, and still has to be re-uploaded afterwards. """
+    logger.info(f"Moving file {rm_file.name}")
+    try:
+        await batcher.move(stored['drive']['id'], stored['parent_drive_id'], folder.drive.id_, rm_file.name)
+    except Exception as e:
+        logger.error(f"Could not move {rm_file.name}.")
+        logger.error(f"Error message: {e}")
+        return
+
+    # Keep the old version for now if the content is out of date, so that the file still counts as modified if its
+    # content can't be refreshed
+    folder.rm.add_file(rm_file.id, stored['version'] if refresh else rm_file.version)
+    folder.drive.add_file(rm_file.id, dict(stored['drive'], name=rm_file.name))
+    return True
+
+
+async def unlink_moved_file(rm_file, stored):
+    """ Remove the link to a moved file from its old Notion page. """
+    await notion.delete(stored['notion'])
+    return True
+
+
+async def refresh_moved_file(folder, rm_file, fingerprint):
+    """ Re-upload a moved file whose content has changed as well. """
+    pdf = await convert_to_pdf(rm_file)
+    if not pdf:
+        return
+    try:
+        logger.debug("Uploading to drive")
+        await drive.replace_pdf(folder.drive.files[rm_file.id]['id'], pdf)
+    except Exception as e:
+        logger.error(f"Could not update {rm_file.name}.")
+        logger.error(f"Error message: {e}")
+        return
+    finally:
+        pdf.close()
+
+    Folder.state().set_fingerprint(rm_file.id, fingerprint)
+    folder.rm.add_file(rm_file.id, rm_file.version)
+    return True
+
+
+def plan_files(plan, folder, file_updates, diff, requires=()):
+    """ Add operations for all the file updates in a folder to the plan and return them.
+
+    Also returns the operations that put files on Drive which still need a link on the folder's Notion page. """
+    operations = []
+    unlinked = []
+    page = ('notion', folder.id_)
+
+    for rm_file in file_updates.created:
+        unlinked.append(plan.add(f"Upload new file {rm_file.name}", partial(upload_new_file, folder, rm_file),
+                                 requires=requires, calls={'render': 1, 'drive': 1},
+                                 priority=priorities(rm_file, render=True), deferrable=True, item=rm_file.id))
+
+    for rm_file in file_updates.modified:
+        operations.append(plan.add(f"Update modified file {rm_file.name}",
+                                   partial(update_modified_file, folder, rm_file, diff.fingerprints.get(rm_file.id)),
+                                   requires=requires, calls={'render': 1, 'drive': 2, 'notion': 1},
+                                   priority=priorities(rm_file, render=True), deferrable=True, item=rm_file.id))
+
+    # Same content, so no rendering or uploading
+    for rm_file in file_updates.renamed:
+        operations.append(plan.add(f"Rename file {rm_file.name}", partial(update_renamed_file, folder, rm_file),
+                                   requires=requires, calls={'drive': 1, 'notion': 1}, limited=False,
+                                   priority=priorities(rm_file), deferrable=True, item=rm_file.id))
+
+    # Only the Notion half of a deletion locks the page, so that the Drive halves can go out in one batch
+    for rm_file in file_updates.deleted:
+        delete = plan.add(f"Delete file {rm_file.name}", partial(delete_file, folder, rm_file),
+                          requires=requires, calls={'drive': 1}, limited=False, priority=priorities(rm_file),
+                          deferrable=True, item=rm_file.id)
+        operations.append(delete)
+        operations.append(plan.add(f"Unlink deleted file {rm_file.name}",
+                                   partial(remove_deleted_file, folder, rm_file),
+                                   requires=[delete], calls={'notion': 2}, locks=[page], limited=False))
+
+    for rm_file in file_updates.moved:
+        old_parent = diff.moved[rm_file.id][0]
+        stored = dict(Folder.state().locate(rm_file.id), version=diff.known_items[rm_file.id].version)
+
+        refresh = not diff.same_content(rm_file.id)
+        move = plan.add(f"Move file {rm_file.name}", partial(move_file, folder, rm_file, stored, refresh),
+                        requires=requires, calls={'drive': 1}, limited=False, priority=priorities(rm_file),
+                        deferrable=True, item=rm_file.id)
+        moves[rm_file.id] = move
+        unlinked.append(move)
+
+        # A link on a page that has since been deleted is gone already
+        if diff.alive(old_parent):
+            operations.append(plan.add(f"Unlink moved file {rm_file.name}",
+                                       partial(unlink_moved_file, rm_file, stored),
+                                       requires=[move], calls={'notion': 2}, locks=[('notion', old_parent)],
+                                       limited=False))
+
+        if refresh:
+            operations.append(plan.add(f"Refresh moved file {rm_file.name}",
+                                       partial(refresh_moved_file, folder, rm_file, diff.fingerprints.get(rm_file.id)),
+                                       requires=[move], calls={'render': 1, 'drive': 1},
+                                       priority=priorities(rm_file, render=True), deferrable=True,
+                                       item=rm_file.id))
+
+    return operations + unlinked, unlinked
 
 
 async def create_sub_folder(folder, rm_sub_folder):
     logger.info(f"Creating sub-folder {rm_sub_folder.name}")
 
     try:
-        drive_sub_folder = drive.create_folder(folder.drive.id_, rm_sub_folder.name)
-        notion_sub_folder = notion.add_sub_folder(folder.notion.id_, rm_sub_folder.name)
-        return drive_sub_folder, notion_sub_folder
+        return await drive.create_folder(folder.drive.id_, rm_sub_folder.name)
     except Exception as e:
         logger.error(f"Could not upload {rm_sub_folder.name}.")
         logger.error(f"Error message: {e}")
@@ -130,8 +380,8 @@ async def modify_sub_folder(folder, rm_sub_folder):
     logger.info(f"Updating modified folder {rm_sub_folder.name}")
 
     try:
-        drive.rename(folder.drive.sub_folders[rm_sub_folder.id]['id'], rm_sub_folder.name)
-        notion.rename_sub_folder(folder.notion.sub_folders[rm_sub_folder.id], rm_sub_folder.name)
+        await batcher.rename(folder.drive.sub_folders[rm_sub_folder.id]['id'], rm_sub_folder.name)
+        await notion.rename_sub_folder(folder.notion.sub_folders[rm_sub_folder.id], rm_sub_folder.name)
         return True
     except Exception as e:
         logger.error(f"Could not update {rm_sub_folder.name}.")
@@ -140,12 +390,12 @@ async def modify_sub_folder(folder, rm_sub_folder):
 
 
 async def delete_sub_folder(folder, rm_sub_folder):
+    """ Delete a removed RM sub-folder from Drive. Its Notion page goes afterwards (see unlink_deleted_sub_folder). """
     logger.info(f"Deleting folder {rm_sub_folder.name}")
 
     try:
-        logger.debug("Renaming on Drive and Notion")
-        drive.delete(folder.drive.sub_folders[rm_sub_folder.id]['id'])
-        notion.delete(folder.notion.sub_folders[rm_sub_folder.id])
+        logger.debug("Deleting on Drive")
+        await batcher.delete(folder.drive.sub_folders[rm_sub_folder.id]['id'])
         return True
     except Exception as e:
         logger.error(f"Could not delete {rm_sub_folder.name}.")
@@ -153,59 +403,191 @@ async def delete_sub_folder(folder, rm_sub_folder):
         return
 
 
-async def process_sub_folders(folder, folder_updates):
-    for new_sub_folder in folder_updates.created:
-        result = await create_sub_folder(folder, new_sub_folder)
+async def unlink_deleted_sub_folder(folder, rm_sub_folder):
+    """ Delete a removed RM sub-folder's page from its folder's Notion page. """
+    try:
+        logger.debug("Deleting on Notion")
+        await notion.delete(folder.notion.sub_folders[rm_sub_folder.id])
+        return True
+    except Exception as e:
+        logger.error(f"Could not delete {rm_sub_folder.name}.")
+        logger.error(f"Error message: {e}")
+        return
 
-        # If the upload went smoothly, record it in the Folder
-        if result:
-            drive_sub_folder, notion_sub_folder = result
-            folder.rm.add_sub_folder(new_sub_folder.id, new_sub_folder.version)
-            folder.drive.add_sub_folder(new_sub_folder.id, dict(id=drive_sub_folder['id'],
-                                                                name=new_sub_folder.name,
-                                                                url=drive_sub_folder['embedLink']))
-            folder.notion.add_sub_folder(new_sub_folder.id, notion_sub_folder.id)
 
-    for modified_sub_folder in folder_updates.modified:
-        success = await modify_sub_folder(folder, modified_sub_folder)
+async def add_created_sub_folder(folder, rm_sub_folder, sub_folder):
+    # A sub-folder whose Notion link failed in an earlier run is on Drive already, and still empty
+    if rm_sub_folder.id in folder.drive.sub_folders:
+        sub_folder.drive.id_ = folder.drive.sub_folders[rm_sub_folder.id]['id']
+        return folder.drive.sub_folders[rm_sub_folder.id]
 
-        # If the upload went smoothly, update the Folder data that has changed
-        if success:
-            folder.rm.add_sub_folder(modified_sub_folder.id, modified_sub_folder.version)
-            folder.drive.sub_folders[modified_sub_folder.id]['name'] = modified_sub_folder.name
+    drive_sub_folder = await create_sub_folder(folder, rm_sub_folder)
 
-    for deleted_sub_folder in folder_updates.deleted:
-        success = await delete_sub_folder(folder, deleted_sub_folder)
+    # If the upload went smoothly, record it on the Drive side and hand the new ID to the sub-folder's operations.
+    # The rest is recorded once the sub-folder is linked on Notion.
+    if drive_sub_folder:
+        folder.drive.add_sub_folder(rm_sub_folder.id, dict(id=drive_sub_folder['id'],
+                                                           name=rm_sub_folder.name,
+                                                           url=drive_sub_folder['embedLink']))
+        sub_folder.drive.id_ = drive_sub_folder['id']
+    return drive_sub_folder
+
+
+async def update_modified_sub_folder(folder, rm_sub_folder):
+    # A new version doesn't always mean a new name
+    if folder.drive.sub_folders[rm_sub_folder.id]['name'] == rm_sub_folder.name:
+        success = True
+    else:
+        success = await modify_sub_folder(folder, rm_sub_folder)
+
+    # If the upload went smoothly, update the Folder data that has changed
+    if success:
+        folder.rm.add_sub_folder(rm_sub_folder.id, rm_sub_folder.version)
+        folder.drive.sub_folders[rm_sub_folder.id]['name'] = rm_sub_folder.name
+    return success
+
+
+async def remove_deleted_sub_folder(folder, rm_sub_folder):
+    success = await unlink_deleted_sub_folder(folder, rm_sub_folder)
+
+    # If the upload went smoothly, delete the associated Folder data
+    if success:
+        del folder.rm.sub_folders[rm_sub_folder.id]
+        del folder.drive.sub_folders[rm_sub_folder.id]
+        del folder.notion.sub_folders[rm_sub_folder.id]
+    return success
 
-        # If the upload went smoothly, delete the associated Folder data
-        if success:
-            del folder.rm.sub_folders[deleted_sub_folder.id]
-            del folder.drive.sub_folders[deleted_sub_folder.id]
-            del folder.notion.sub_folders[deleted_sub_folder.id]
 
-    # Process sub-folder contents *after* making all the updates at this level
-    for rm_id_ in folder.rm.sub_folders.keys():
-        await mirror_updates(Folder(folder.drive.sub_folders[rm_id_]['name'],
-                                    rm=dict(id_=rm_id_),
-                                    drive=dict(id_=folder.drive.sub_folders[rm_id_]['id']),
-                                    notion=dict(id_=folder.notion.sub_folders[rm_id_])))
+async def move_sub_folder(folder, rm_sub_folder, stored):
+    """ Move a sub-folder that was recorded under another RM folder on Drive and Notion, and record it here. """
+    logger.info(f"Moving folder {rm_sub_folder.name}")
+    try:
+        await batcher.move(stored['drive']['id'], stored['parent_drive_id'], folder.drive.id_, rm_sub_folder.name)
+        await notion.move_sub_folder(stored['notion'], folder.notion.id_)
+        if stored['drive']['name'] != rm_sub_folder.name:
+            await notion.rename_sub_folder(stored['notion'], rm_sub_folder.name)
+    except Exception as e:
+        logger.error(f"Could not move {rm_sub_folder.name}.")
+        logger.error(f"Error message: {e}")
+        return
+
+    folder.rm.add_sub_folder(rm_sub_folder.id, rm_sub_folder.version)
+    folder.drive.add_sub_folder(rm_sub_folder.id, dict(stored['drive'], name=rm_sub_folder.name))
+    folder.notion.add_sub_folder(rm_sub_folder.id, stored['notion'])
+    return True
+
+
+async def save_folder(folder):
+    folder.save()
+    return True
+
 
+async def plan_sub_folders(plan, folder, folder_updates, diff, requires=()):
+    """ Add operations for all the sub-folder updates in a folder to the plan, then plan the existing sub-folders.
 
-async def mirror_updates(folder):
-    """ Recursively mirror updates in a Remarkable folder to Drive and Notion. """
-    old_folder = Folder.maybe_load(folder.id_)
+    Existing sub-folders are only planned if something beneath them has changed. New sub-folders are returned as
+    (RM sub-folder, Folder, creation operation) so they can be planned once their Notion link is. """
+    operations = []
+    created = []
+    page = ('notion', folder.id_)
+
+    for new_sub_folder in folder_updates.created:
+        # The sub-folder's Drive and Notion IDs are filled in once the creation and link operations succeed
+        sub_folder = Folder(new_sub_folder.name,
+                            rm=dict(id_=new_sub_folder.id),
+                            drive=dict(id_=None),
+                            notion=dict(id_=None))
+        create = plan.add(f"Create sub-folder {new_sub_folder.name}",
+                          partial(add_created_sub_folder, folder, new_sub_folder, sub_folder),
+                          requires=requires, calls={'drive': 1}, priority=priorities(new_sub_folder),
+                          deferrable=True, item=new_sub_folder.id)
+        operations.append(create)
+        created.append((new_sub_folder, sub_folder, create))
+
+    # Folders have no content, so a new version is always a metadata change
+    for modified_sub_folder in folder_updates.modified + folder_updates.renamed:
+        operations.append(plan.add(f"Update modified sub-folder {modified_sub_folder.name}",
+                                   partial(update_modified_sub_folder, folder, modified_sub_folder),
+                                   requires=requires, calls={'drive': 1, 'notion': 1}, limited=False,
+                                   priority=priorities(modified_sub_folder), deferrable=True,
+                                   item=modified_sub_folder.id))
+
+    # Trashing a folder on Drive trashes whatever is still in it, so the deletion waits for everything moving out of
+    # it (see wait_for_moves)
+    deleted_ids = set()
+    for deleted_sub_folder in folder_updates.deleted:
+        deleted_ids.add(deleted_sub_folder.id)
+        delete = plan.add(f"Delete sub-folder {deleted_sub_folder.name}",
+                          partial(delete_sub_folder, folder, deleted_sub_folder),
+                          requires=requires, calls={'drive': 1}, limited=False,
+                          priority=priorities(deleted_sub_folder), deferrable=True, item=deleted_sub_folder.id)
+        deletions[deleted_sub_folder.id] = delete
+        operations.append(delete)
+        operations.append(plan.add(f"Unlink deleted sub-folder {deleted_sub_folder.name}",
+                                   partial(remove_deleted_sub_folder, folder, deleted_sub_folder),
+                                   requires=[delete], calls={'notion': 2}, locks=[page], limited=False))
+
+    moved_sub_folders = []
+    for moved_sub_folder in folder_updates.moved:
+        old_parent = diff.moved[moved_sub_folder.id][0]
+        stored = Folder.state().locate(moved_sub_folder.id)
+        move = plan.add(f"Move sub-folder {moved_sub_folder.name}",
+                        partial(move_sub_folder, folder, moved_sub_folder, stored),
+                        requires=requires, calls={'drive': 1, 'notion': 4},
+                        locks=[page, ('notion', old_parent)], limited=False,
+                        priority=priorities(moved_sub_folder), deferrable=True, item=moved_sub_folder.id)
+        moves[moved_sub_folder.id] = move
+        operations.append(move)
+        moved_sub_folders.append((moved_sub_folder, stored))
+
+    # Plan the contents of the sub-folders that already existed, are sticking around, and have changes inside them.
+    # Sub-folders that moved away are planned at their new location.
+    for rm_id_ in list(folder.rm.sub_folders.keys()):
+        if rm_id_ in deleted_ids or rm_id_ in diff.moved or rm_id_ not in diff.changed:
+            continue
+        await plan_updates(plan, Folder(folder.drive.sub_folders[rm_id_]['name'],
+                                        rm=dict(id_=rm_id_),
+                                        drive=dict(id_=folder.drive.sub_folders[rm_id_]['id']),
+                                        notion=dict(id_=folder.notion.sub_folders[rm_id_])),
+                           diff)
+
+    # A moved sub-folder keeps its Drive and Notion IDs, so its contents don't have to wait for the move
+    for moved_sub_folder, stored in moved_sub_folders:
+        if moved_sub_folder.id in diff.changed and stored['drive']:
+            await plan_updates(plan, Folder(moved_sub_folder.name,
+                                            rm=dict(id_=moved_sub_folder.id),
+                                            drive=dict(id_=stored['drive']['id']),
+                                            notion=dict(id_=stored['notion'])),
+                               diff)
+
+    return operations, created
+
+
+def wait_for_moves(diff):
+    """ Make each sub-folder deletion wait for the moves out of the sub-folder, and out of the folders beneath it.
+
+    Moves and deletions are planned wherever the items end up, in any order, so this is done once planning is over. """
+    for id_, delete in deletions.items():
+        delete.after.extend(moves[moved_id] for moved_id in diff.moved_out(id_) if moved_id in moves)
+
+
+async def plan_updates(plan, folder, diff, created=None, linked=None):
+    """ Recursively add the operations that mirror updates in a Remarkable folder to Drive and Notion to the plan.
+
+    `diff` is the TreeDiff for the whole account.
+    If the folder is being created in this same run, `created` is the operation that creates it on Drive and
+    `linked` the one that creates its Notion page. """
+    old_folder = None if created else Folder.maybe_load(folder.id_)
+    # A new folder is only recorded once it's linked on Notion (see link_new_items), so nothing goes into it before
+    # then. Otherwise a failed link would leave its contents on Drive unrecorded, to be uploaded again next run.
+    requires = [created, linked] if created else []
 
     if old_folder:
         # This is the folder instance we want, if it exists
         folder = old_folder
-        file_updates, folder_updates = await rm.get_updates(folder.id_,
-                                                            folder.rm.files,
-                                                            folder.rm.sub_folders)
-    else:
-        # Keep the Folder instance that was passed in and treat everything as new
-        files, sub_folders = await rm.get_contents(folder.id_)
-        file_updates = Updates(files)
-        folder_updates = Updates(sub_folders)
+
+    # A folder that has never been saved has no known contents, so everything in it is either new or moved in
+    file_updates, folder_updates = diff.updates(folder.id_)
 
     if len(file_updates.created) > 0:
         logger.info(f"New files: {file_updates.created}")
@@ -213,33 +595,360 @@ async def mirror_updates(folder):
         logger.info(f"Modified files: {file_updates.modified}")
     if len(file_updates.deleted) > 0:
         logger.info(f"Deleted files: {file_updates.deleted}")
+    if len(file_updates.renamed) > 0:
+        logger.info(f"Renamed files: {file_updates.renamed}")
 
     if len(folder_updates.created) > 0:
         logger.info(f"New folders: {folder_updates.created}")
-    if len(folder_updates.modified) > 0:
-        logger.info(f"Modified folders: {folder_updates.modified}")
+    if len(folder_updates.modified + folder_updates.renamed) > 0:
+        logger.info(f"Modified folders: {folder_updates.modified + folder_updates.renamed}")
     if len(folder_updates.deleted) > 0:
         logger.info(f"Deleted folders: {folder_updates.deleted}")
 
-    await process_files(folder, file_updates)
-    await process_sub_folders(folder, folder_updates)
+    if len(file_updates.moved) + len(folder_updates.moved) > 0:
+        logger.info(f"Moved in: {file_updates.moved + folder_updates.moved}")
+
+    operations, unlinked = plan_files(plan, folder, file_updates, diff, requires)
+    sub_folder_operations, new_sub_folders = await plan_sub_folders(plan, folder, folder_updates, diff, requires)
+    operations += sub_folder_operations
+
+    # Everything new on this page is linked in one go, once it's all on Drive
+    link = None
+    if len(unlinked) > 0 or len(new_sub_folders) > 0:
+        rm_files = file_updates.created + file_updates.moved
+        link = plan.add(f"Link new items in {folder.name}",
+                        partial(link_new_items, folder, rm_files,
+                                [(rm_sub_folder, sub_folder) for rm_sub_folder, sub_folder, _ in new_sub_folders]),
+                        requires=requires, after=unlinked + [create for _, _, create in new_sub_folders],
+                        calls={'notion': 2}, locks=[('notion', folder.id_)])
+        operations.append(link)
+
+    for rm_sub_folder, sub_folder, create in new_sub_folders:
+        await plan_updates(plan, sub_folder, diff, created=create, linked=link)
 
-    # If something has changed, update the folder contents on disk
+    # If something has changed, update the folder contents on disk once all of this folder's operations are done
     if file_updates.change or folder_updates.change:
-        folder.save()
+        plan.add(f"Save folder {folder.name}", partial(save_folder, folder), requires=requires,
+                 after=operations)
+
+
+def save_listing(succeeded):
+    """ Keep the listing this sync worked from for looking at offline (see tree.py). It's always kept as the latest
+    listing, so that it can be compared with what went through, and as the snapshot if everything did. """
+    listing = rm.snapshot()
+    Folder.state().save_snapshot(listing, LISTING)
+    if succeeded:
+        Folder.state().save_snapshot(listing, SNAPSHOT)
+
+
+async def mirror_updates(parallelism=DEFAULT_PARALLELISM, dry_run=False, refresh=True, deadline=None):
+    """ Plan the updates for the whole tree, then mirror them to Drive and Notion.
+
+    Pass `refresh=False` if the RM items have just been refreshed. Past `deadline`, in trio time, no more updates are
+    started, and the rest are left for the next run. Returns True if every update went through. """
+    global priorities, moves, deletions
+    plan = Plan(logger)
+
+    # Compare the whole tree against the stored state once, so that unchanged folders don't have to be visited
+    if refresh:
+        with metrics.span('rm.listing'):
+            await rm.refresh()
+    with metrics.span('diff'):
+        diff = await rm.get_diff(Folder.state().known_items())
+
+    # Most runs end here, before Drive or Notion have even been logged into
+    if rm.ROOT not in diff.changed:
+        logger.info("No changes since the last sync")
+        if not dry_run:
+            save_listing(True)
+        return True
 
+    if len(diff.moved) > 0:
+        logger.info(f"Moved items: {[diff.by_id[id_] for id_ in diff.moved]}")
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(drive.connect)
+        nursery.start_soon(notion.connect)
+    root_folder = Folder('root',
+                         rm=dict(id_=rm.ROOT),
+                         drive=dict(id_=drive.ROOT),
+                         notion=dict(id_=notion.ROOT))
+    with metrics.span('plan'):
+        # Sizes cost a request per document version, so they're only looked up when there's a deadline to make
+        sizes = await rm.sizes(diff.to_render()) if deadline is not None else None
+        priorities = Priorities(sizes, Folder.state().deferred())
+        moves, deletions = dict(), dict()
+        await plan_updates(plan, root_folder, diff)
+        wait_for_moves(diff)
+
+    if dry_run:
+        plan.describe()
+        return True
 
-if __name__ == '__main__':
+    # Every page that's about to change, along with its links, is loaded up front in a handful of requests.
+    # Operations fetch whatever is missing on their own, so the run can go on without it.
+    # Pages may have been edited since the last sync in this process, so nothing cached then is trusted.
+    await notion.clear_cache()
+    try:
+        await notion.preload(Folder.state().notion_pages(diff.changed))
+    except Exception as e:
+        logger.error("Could not preload the Notion pages that are about to change.")
+        logger.error(f"Error message: {e}")
+
+    with metrics.span('execute'):
+        await plan.execute(parallelism, deadline)
+
+    # Whatever is left over is planned again by the next run anyway, but it goes first once it has waited too long
+    deferred = plan.deferred
+    if len(deferred) > 0:
+        logger.info(f"Out of time, left {len(deferred)} operations for the next run")
+    Folder.state().set_deferred([operation.item for operation in deferred if operation.item], priorities.now)
+
+    # Items left behind under folders that have since been deleted for good don't need tracking anymore
+    Folder.state().forget(diff.orphaned)
+
+    save_listing(plan.succeeded)
+    return plan.succeeded
+
+
+async def restore_drive_item(item, listed):
+    """ Move and rename an item back to where and what the last sync left it as on Drive. """
+    logger.info(f"Restoring {item.name} on Drive")
+    try:
+        if listed['parent'] != item.parent_drive_id:
+            await batcher.move(item.drive_id, listed['parent'], item.parent_drive_id, item.name)
+        else:
+            await batcher.rename(item.drive_id, item.name)
+        return True
+    except Exception as e:
+        logger.error(f"Could not restore {item.name} on Drive.")
+        logger.error(f"Error message: {e}")
+
+
+async def forget_missing_item(item, ids):
+    """ Forget an item that's gone from Drive, along with everything under it, so that the sync after this uploads
+    it again. Its Notion link goes too, since uploading it adds a new one. """
+    logger.info(f"{item.name} is missing from Drive, and will be uploaded again")
+    if item.notion_id:
+        try:
+            await notion.delete(item.notion_id)
+        except Exception as e:
+            # Likely deleted by hand along with the Drive file
+            logger.warning(f"Could not remove the Notion link to {item.name}, it may be gone already.")
+            logger.warning(f"Error message: {e}")
+    Folder.state().forget(ids)
+    return True
+
+
+def plan_drive_repairs(plan, listing, items):
+    """ Add an operation to the plan for every synced item that isn't on Drive the way the state store has it.
+
+    `listing` is Drive.list_tree() and `items` StateStore.drive_items(). Returns the names of the listed items that
+    the state store doesn't know about. """
+    children = defaultdict(list)
+    for item in items.values():
+        children[item.parent].append(item.id)
+    missing = {id_ for id_, item in items.items() if item.drive_id not in listing}
+
+    def subtree(id_):
+        return [id_] + [descendant for child in children[id_] for descendant in subtree(child)]
+
+    def under_missing(id_):
+        parent = items[id_].parent
+        while parent in items:
+            if parent in missing:
+                return True
+            parent = items[parent].parent
+        return False
+
+    for id_, item in items.items():
+        # Everything under a missing folder is forgotten along with it
+        if under_missing(id_):
+            continue
+        if id_ in missing:
+            plan.add(f"Forget missing {item.kind} {item.name}", partial(forget_missing_item, item, subtree(id_)),
+                     calls={'notion': 1} if item.notion_id else None)
+        elif item.parent_drive_id and (listing[item.drive_id]['name'] != item.name
+                                       or listing[item.drive_id]['parent'] != item.parent_drive_id):
+            plan.add(f"Restore {item.kind} {item.name}", partial(restore_drive_item, item, listing[item.drive_id]),
+                     calls={'drive': 1}, limited=False)
+
+    known = {item.drive_id for item in items.values()}
+    return [listed['name'] for drive_id, listed in listing.items() if drive_id not in known]
+
+
+async def verify_drive(parallelism=DEFAULT_PARALLELISM, dry_run=False):
+    """ Check every synced item against one listing of the whole Drive folder, and repair whatever has drifted.
+
+    Items moved or renamed on Drive are put back. Items missing from Drive (e.g. deleted there) are forgotten, so
+    that the sync after this uploads them again. Items that are only on Drive are left alone.
+    Returns True if every repair went through. """
+    await drive.connect()
+    listing = await drive.list_tree()
+    items = Folder.state().drive_items()
+
+    plan = Plan(logger)
+    strays = plan_drive_repairs(plan, listing, items)
+    logger.info(f"Checked {len(items)} synced items against {len(listing)} items on Drive, "
+                f"{len(plan.operations)} need repairs")
+    if len(strays) > 0:
+        logger.info(f"Not synced from Remarkable, left alone: {strays}")
+
+    if dry_run:
+        plan.describe()
+        return True
+
+    if plan.call_counts()['notion'] > 0:
+        await notion.connect()
+    await plan.execute(parallelism)
+    Folder.state().commit()
+    return plan.succeeded
+
+
+async def run_update(parallelism=DEFAULT_PARALLELISM, dry_run=False, refresh=True, verify=False, budget=None):
+    """ Mirror every update in the tree once and log how it went. Returns True if every update went through.
+
+    With `verify`, first check Drive against the state store and repair it (see verify_drive). With a `budget`, no
+    updates are started after that many seconds (see mirror_updates). """
+    success = False
+    deadline = trio.current_time() + budget if budget is not None else None
     try:
-        root_folder = Folder('root',
-                             rm=dict(id_=rm.ROOT),
-                             drive=dict(id_=drive.ROOT),
-                             notion=dict(id_=notion.ROOT))
+        verified = await verify_drive(parallelism, dry_run) if verify else True
+
+        # Plan and run the updates for the whole tree
+        success = await mirror_updates(parallelism=parallelism, dry_run=dry_run, refresh=refresh,
+                                       deadline=deadline) and verified
 
-        # Run the mirror_updates recursion
-        trio.run(mirror_updates, root_folder)
+        with metrics.span('state.commit'):
+            Folder.state().commit()
     except Exception as e:
         logger.error("An unexpected error occurred while executing the update script.")
         logger.error(f"Error message: {e}")
 
+    try:
+        metrics.write(scheduler, success, profile.metrics_dir)
+    except OSError as e:
+        logger.error("Could not write the run's metrics.")
+        logger.error(f"Error message: {e}")
+
+    # How close we ran to each service's quota
+    for line in scheduler.summary():
+        logger.info(line)
+    scheduler.reset()
+
+    # Also sends the error email, if there are new errors
     logger.info("Update complete")
+    return success
+
+
+async def run_profiles(profiles, parallelism=DEFAULT_PARALLELISM, dry_run=False, verify=False, budget=None):
+    """ Sync each profile once, one after the other. Returns True if every update of every profile went through.
+
+    A `budget` covers all the profiles together, so the later ones get whatever time the earlier ones left. """
+    deadline = trio.current_time() + budget if budget is not None else None
+    results = []
+    for next_profile in profiles:
+        use_profile(next_profile)
+        logger.info(f"Syncing profile {profile.name}")
+        remaining = max(0, deadline - trio.current_time()) if deadline is not None else None
+        results.append(await run_update(parallelism, dry_run, verify=verify, budget=remaining))
+    return all(results)
+
+
+class Watcher:
+    """ Polls one profile's Remarkable, and syncs the profile whenever something has changed.
+
+    Polls every `min_interval` seconds after a change, doubling the interval up to `max_interval` while nothing
+    happens. A sync that didn't get everything across is tried again once polling has slowed all the way down.
+    With `verify`, Drive is checked before the first sync. With a `budget`, each sync stops starting updates after
+    that many seconds, and a sync that left some for later counts as not having got everything across. """
+    def __init__(self, watched, min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL, verify=False,
+                 budget=None):
+        self.profile = watched
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.verify = verify
+        self.budget = budget
+
+        self.interval = min_interval
+        self.seen = None
+        self.synced = True
+
+        # When to poll next, in trio time
+        self.due = 0
+
+    async def poll(self, parallelism):
+        use_profile(self.profile)
+
+        # Each run's metrics start with the poll that found its changes
+        metrics.reset()
+        try:
+            with metrics.span('rm.listing'):
+                await rm.refresh()
+            snapshot = rm.snapshot()
+        except Exception as e:
+            logger.error(f"Could not poll Remarkable for changes in profile {profile.name}.")
+            logger.error(f"Error message: {e}")
+            snapshot = self.seen
+
+        changed = snapshot != self.seen
+        if changed or (not self.synced and self.interval >= self.max_interval):
+            self.synced = await run_update(parallelism, refresh=False, verify=self.verify, budget=self.budget)
+            self.seen = snapshot
+            self.verify = False
+
+        self.interval = self.min_interval if changed else min(self.interval * 2, self.max_interval)
+        self.due = trio.current_time() + self.interval
+        logger.debug(f"Polling profile {profile.name} again in {self.interval}s")
+
+
+async def watch(parallelism=DEFAULT_PARALLELISM, min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL,
+                verify=False, profiles=None, budget=None):
+    """ Keep the clients and the RM item index around, and sync whenever polling turns up a change. Runs until killed.
+
+    Each profile, the current one if none are given, is polled on its own schedule (see Watcher). Whichever has been
+    due the longest goes next, and syncs take turns, so a busy profile can't keep the others waiting for long. """
+    watchers = [Watcher(watched, min_interval, max_interval, verify, budget)
+                for watched in (profiles if profiles else [profile])]
+    while True:
+        watcher = min(watchers, key=lambda each: each.due)
+        await trio.sleep_until(watcher.due)
+        await watcher.poll(parallelism)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Mirror Remarkable updates to Drive and Notion.")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="print the planned operations and estimated API calls without running them")
+    parser.add_argument('--parallelism', type=int, default=DEFAULT_PARALLELISM,
+                        help="maximum number of operations to run at once")
+    parser.add_argument('--watch', action='store_true',
+                        help="keep running, and sync whenever something changes on the Remarkable")
+    parser.add_argument('--min-interval', type=float, default=MIN_POLL_INTERVAL,
+                        help="seconds between polls right after a change, in watch mode")
+    parser.add_argument('--max-interval', type=float, default=MAX_POLL_INTERVAL,
+                        help="longest time between polls once nothing is changing, in watch mode")
+    parser.add_argument('--verify', action='store_true',
+                        help="first check that Drive still matches what was synced, and repair it where it doesn't")
+    parser.add_argument('--profiles', nargs='*', metavar='PROFILE',
+                        help="sync these profiles from the profiles file, or all of them if none are named, "
+                             "instead of the account in the environment")
+    parser.add_argument('--deadline', type=float, metavar='SECONDS',
+                        help="stop starting updates after this many seconds (per sync, in watch mode), and leave the "
+                             "rest for the next run; small and recent changes go first")
+    args = parser.parse_args()
+
+    profiles = None
+    if args.profiles is not None:
+        try:
+            profiles = load_profiles(args.profiles)
+        except (OSError, KeyError, TypeError, ValueError) as e:
+            parser.error(f"could not load profiles: {e}")
+
+    if args.watch:
+        trio.run(partial(watch, args.parallelism, args.min_interval, args.max_interval, args.verify, profiles,
+                         args.deadline))
+    elif profiles:
+        trio.run(partial(run_profiles, profiles, args.parallelism, args.dry_run, args.verify, args.deadline))
+    else:
+        trio.run(partial(run_update, args.parallelism, args.dry_run, verify=args.verify, budget=args.deadline))